@@ -0,0 +1,359 @@
+# -*- coding: utf8 -*-
+
+# Benchmarks for STiCViewer on synthetic cubes in the STiC file layout.
+#
+# For every requested size (nx,ny,nt,nw,ndep) the loading stages and the viewer
+# window are run in separate processes, so that the peak resident memory
+# reported for the window is that of a single viewer. Results are
+# written as JSON lines, one record per size, and can be compared between
+# commits with --compare, e.g.:
+#
+#   python3 benchmark.py --size 200,200,4,60,40 --output before.jsonl
+#   (switch commit)
+#   python3 benchmark.py --size 200,200,4,60,40 --output after.jsonl
+#   python3 benchmark.py --compare before.jsonl after.jsonl
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+import tempfile
+
+import numpy as np
+
+try:
+    import netCDF4
+except ImportError:
+    netCDF4 = None
+    try:
+        import h5py
+    except ImportError:
+        raise SystemExit('ImportError: netCDF4 or h5py is required to write '
+                'the benchmark cubes')
+
+DEFAULT_SIZES = ['100,100,2,40,30', '400,400,4,80,60']
+
+
+def peak_rss():
+    # Peak resident set size of this process in MB (ru_maxrss is in kB on
+    # Linux and in bytes on macOS)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2.**20 if sys.platform == 'darwin' else rss / 2.**10
+
+
+class H5Dataset(object):
+    # The part of netCDF4.Dataset used here, writing the same layout (HDF5
+    # datasets with dimension scales, as read by netCDF4) through h5py
+    def __init__(self, fname, mode='w'):
+        self.f = h5py.File(fname, mode)
+        self.sizes = {}
+        self.scales = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def createDimension(self, name, size):
+        self.sizes[name] = size
+
+    def scale(self, name, dtype='>f4', label=None):
+        # Dimension scale of a dimension, without values unless it is also a
+        # (coordinate) variable
+        if name not in self.scales:
+            dim = self.f.create_dataset(name, (self.sizes[name],),
+                    dtype=dtype)
+            dim.make_scale(label or 'This is a netCDF dimension but not a '
+                    'netCDF variable.{0:10d}'.format(self.sizes[name]))
+            dim.attrs['_Netcdf4Dimid'] = np.int32(list(self.sizes).index(
+                name))
+            self.scales[name] = dim
+        return self.scales[name]
+
+    def createVariable(self, name, dtype, dims):
+        if dims == (name,):
+            return self.scale(name, dtype=dtype, label=name)
+        var = self.f.create_dataset(name, tuple(self.sizes[dim] for dim in
+            dims), dtype=dtype)
+        for ii, dim in enumerate(dims):
+            var.dims[ii].attach_scale(self.scale(dim))
+        return var
+
+    def close(self):
+        for name in self.sizes:
+            self.scale(name)
+        self.f.close()
+
+def dataset(fname):
+    return netCDF4.Dataset(fname, 'w') if netCDF4 is not None else \
+            H5Dataset(fname, 'w')
+
+
+def write_profile(fname, nx, ny, nt, nw, seed, noise=0.):
+    # Gaussian absorption line with Zeeman-like Q, U and V signals
+    rng = np.random.default_rng(seed)
+    wav = 6302.5 + np.linspace(-0.5, 0.5, nw)
+    with dataset(fname) as f:
+        f.createDimension('time', nt)
+        f.createDimension('y', ny)
+        f.createDimension('x', nx)
+        f.createDimension('wav', nw)
+        f.createDimension('stokes', 4)
+        f.createVariable('wav', 'f8', ('wav',))[:] = wav
+        weights = f.createVariable('weights', 'f8', ('wav', 'stokes'))
+        weights[:] = np.array([5.e-3, 1.e-2, 1.e-2, 5.e-3])[None,:]
+        f.createVariable('pixel_weights', 'f8', ('time', 'y', 'x'))[:] = 1.
+        prof = f.createVariable('profiles', 'f8', ('time', 'y', 'x', 'wav',
+            'stokes'))
+        x = (wav - wav.mean()) / 0.1
+        for tt in range(nt):
+            shift = rng.normal(0., 0.3, size=(ny, nx, 1))
+            depth = rng.uniform(0.3, 0.7, size=(ny, nx, 1))
+            field = rng.normal(0., 0.05, size=(ny, nx, 1))
+            line = np.exp(-(x[None,None,:]-shift)**2)
+            dline = np.gradient(line, axis=2)
+            dat = np.empty((ny, nx, nw, 4))
+            dat[...,0] = 1. - depth*line
+            dat[...,1] = 0.1*field*dline**2
+            dat[...,2] = -0.1*field*dline**2
+            dat[...,3] = field*dline
+            if noise > 0.:
+                dat += rng.normal(0., noise, size=dat.shape)
+            prof[tt] = dat
+
+def write_model(fname, nx, ny, nt, ndep, seed):
+    rng = np.random.default_rng(seed)
+    ltau = np.linspace(-7., 1., ndep)
+    with dataset(fname) as f:
+        f.createDimension('time', nt)
+        f.createDimension('y', ny)
+        f.createDimension('x', nx)
+        f.createDimension('ndep', ndep)
+        dims = ('time', 'y', 'x', 'ndep')
+        # Variable names as written by STiC
+        names = ('ltau500', 'z', 'temp', 'vlos', 'vturb', 'blong', 'bhor',
+                'azi', 'pgas', 'rho', 'nne')
+        var = dict((name, f.createVariable(name, 'f8', dims)) for name in names)
+        for tt in range(nt):
+            shape = (ny, nx, 1)
+            grid = np.broadcast_to(ltau, (ny, nx, ndep))
+            var['ltau500'][tt] = grid
+            var['z'][tt] = -1.e7 * grid
+            var['temp'][tt] = 5.e3 + 1.e3*grid + rng.normal(0., 2.e2, shape)
+            var['vlos'][tt] = rng.normal(0., 2.e5, shape) * (1. - grid/8.)
+            var['vturb'][tt] = np.abs(rng.normal(1.e5, 5.e4, shape)) + 0.*grid
+            var['blong'][tt] = rng.normal(0., 3.e2, shape) + 0.*grid
+            var['bhor'][tt] = np.abs(rng.normal(0., 2.e2, shape)) + 0.*grid
+            var['azi'][tt] = rng.uniform(0., np.pi, shape) + 0.*grid
+            var['pgas'][tt] = 1.e5 * 10.**grid
+            var['rho'][tt] = 1.e-7 * 10.**grid
+            var['nne'][tt] = 1.e14 * 10.**grid
+
+def make_cubes(workdir, nx, ny, nt, nw, ndep):
+    # Reuse cubes of the same size from earlier runs
+    tag = '{0}x{1}x{2}x{3}x{4}'.format(nx, ny, nt, nw, ndep)
+    fnames = [os.path.join(workdir, '{0}_{1}.nc'.format(name, tag)) for name in
+            ('observed', 'synthetic', 'atmosout')]
+    if not os.path.exists(fnames[0]):
+        write_profile(fnames[0], nx, ny, nt, nw, seed=1, noise=2.e-3)
+    if not os.path.exists(fnames[1]):
+        write_profile(fnames[1], nx, ny, nt, nw, seed=1)
+    if not os.path.exists(fnames[2]):
+        write_model(fnames[2], nx, ny, nt, ndep, seed=2)
+    return fnames
+
+
+def timed(func, *args):
+    t0 = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - t0
+
+def summarise(times):
+    times = np.array(times)
+    return {'mean': times.mean(), 'median': np.median(times),
+            'p95': np.percentile(times, 95), 'n': len(times)}
+
+def run_stages(fnames, compact=False):
+    # Loading stages of a standalone CubeData; runs in its own process
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    t0 = time.perf_counter()
+    import sticviewer as sv
+    startup = {'import': time.perf_counter() - t0}
+    rss = {'import': peak_rss()}
+    if not hasattr(sv, 'CubeData'):
+        # Loading not yet split out of the window
+        return {'startup': startup, 'peak_rss_mb': rss}
+
+    data = sv.CubeData()
+    data.cache = None
+    data.dtype = 'float32' if compact else None
+    data.fname_obs, data.fname_synth, data.fname_atmos = fnames
+    # The stages run through loadData, as in the viewer; commits that report
+    # them through loadStage are timed per stage as well
+    marks = [time.perf_counter()]
+    def stage(name):
+        marks.append(time.perf_counter())
+        startup[name] = marks[-1] - marks[-2]
+        rss[name] = peak_rss()
+    data.loadStage = stage
+    # initModel and initSynth run for every run within the initRuns stage and
+    # are also reported on their own
+    def substage(name, func):
+        def wrapper():
+            startup[name] = startup.get(name, 0.) + timed(func)
+        return wrapper
+    for name in ('initModel', 'initSynth'):
+        setattr(data, name, substage(name, getattr(data, name)))
+    startup['loadData'] = timed(data.loadData)
+    rss['loadData'] = peak_rss()
+    if getattr(data, 'chi2engine', None) is not None:
+        startup['getChi2_total'] = startup['loadData'] + timed(
+                data.chi2engine.wait)
+    return {'startup': startup, 'peak_rss_mb': rss}
+
+def run_window(fnames, nrepeat, compact=False):
+    # Window creation and interaction; runs in its own process, so that the
+    # peak RSS is that of the window alone. Attributes added to the viewer
+    # since the baseline are looked up with getattr, so that any commit can
+    # be measured
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    import sticviewer as sv
+
+    app = sv.QApplication([sys.argv[0]])
+    t0 = time.perf_counter()
+    if hasattr(sv, 'parse_args'):
+        win = sv.Window(sv.parse_args(list(fnames) + ['--no-cache'] +
+            (['--compact'] if compact else [])))
+    else:
+        # The files are taken from the command line
+        sys.argv = [sys.argv[0]] + list(fnames)
+        win = sv.Window()
+    # A window that loads in a worker thread is ready after its first draw
+    while not getattr(win, 'ready', True):
+        if win.loaderror is not None:
+            raise SystemExit(win.loaderror)
+        app.processEvents()
+        time.sleep(1.e-3)
+    app.processEvents()
+    startup = {'window': time.perf_counter() - t0}
+    rss = {'window': peak_rss()}
+
+    scheduler = getattr(win, 'scheduler', None)
+    def step(action):
+        # Handler plus the repaint it schedules
+        action()
+        if scheduler is not None:
+            scheduler.flush()
+        app.processEvents()
+
+    rng = np.random.default_rng(0)
+    interaction = {}
+    for name, action in (('depth', win.incDepth), ('time', win.incTime),
+            ('wave', win.incWave)):
+        interaction[name] = summarise([timed(step, action) for ii in
+            range(nrepeat)])
+    if hasattr(win, 'changePixel'):
+        pixels = rng.integers(0, [win.nx, win.ny], size=(nrepeat, 2))
+        interaction['hover'] = summarise([timed(step, lambda: win.changePixel(
+            int(xx), int(yy))) for xx, yy in pixels])
+    rss['interaction'] = peak_rss()
+    if getattr(win, 'chi2engine', None) is not None:
+        win.chi2engine.cancel()
+    if getattr(win, 'slices', None) is not None:
+        win.slices.shutdown()
+
+    return {'startup': startup, 'interaction': interaction, 'peak_rss_mb': rss}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(fname_old, fname_new):
+    def load(fname):
+        with open(fname) as f:
+            return dict((tuple(rec['size']), rec) for rec in map(json.loads, f))
+    old = load(fname_old)
+    new = load(fname_new)
+    for size in sorted(set(old) & set(new)):
+        print('size (nx,ny,nt,nw,ndep)={0}: {1} -> {2}'.format(size,
+            old[size]['commit'], new[size]['commit']))
+        rows = [('startup/'+key, old[size]['startup'][key],
+            new[size]['startup'][key]) for key in new[size]['startup'] if key
+            in old[size]['startup']]
+        rows += [('interaction/'+key, old[size]['interaction'][key]['median'],
+            new[size]['interaction'][key]['median']) for key in
+            new[size]['interaction'] if key in old[size]['interaction']]
+        for name, vold, vnew in rows:
+            print('  {0:<24} {1:>10.4f}s {2:>10.4f}s {3:>7.2f}x'.format(name,
+                vold, vnew, vnew/vold if vold > 0 else np.inf))
+        for key in new[size]['peak_rss_mb']:
+            if key in old[size]['peak_rss_mb']:
+                print('  {0:<24} {1:>9.1f}MB {2:>9.1f}MB'.format('rss/'+key,
+                    old[size]['peak_rss_mb'][key], new[size]['peak_rss_mb'][key]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='STiCViewer benchmarks')
+    parser.add_argument('--size', action='append', metavar='NX,NY,NT,NW,NDEP',
+            help='cube size to benchmark (repeatable; default: {0})'.format(
+                ' and '.join(DEFAULT_SIZES)))
+    parser.add_argument('--workdir', default=os.path.join(
+        tempfile.gettempdir(), 'sticviewer-bench'),
+            help='directory for the generated cubes (reused between runs)')
+    parser.add_argument('--repeat', type=int, default=20,
+            help='number of repetitions of each interaction')
+    parser.add_argument('--output', help='append JSON lines records to this file')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+            help='compare two result files and exit')
+    parser.add_argument('--compact', action='store_true',
+            help='run the viewer with --compact (float32 slices)')
+    parser.add_argument('--single', nargs=3, help=argparse.SUPPRESS)
+    parser.add_argument('--part', choices=('stages', 'window'),
+            default='window', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.single:
+        if args.part == 'stages':
+            print(json.dumps(run_stages(args.single, args.compact)))
+        else:
+            print(json.dumps(run_window(args.single, args.repeat,
+                args.compact)))
+        return
+
+    os.makedirs(args.workdir, exist_ok=True)
+    for size in args.size or DEFAULT_SIZES:
+        dims = [int(ii) for ii in size.split(',')]
+        fnames = make_cubes(args.workdir, *dims)
+        record = {'commit': git_commit(), 'date': time.strftime(
+            '%Y-%m-%dT%H:%M:%S'), 'size': dims, 'compact': args.compact,
+            'startup': {}, 'interaction': {}, 'peak_rss_mb': {}}
+        # The loading stages and the window in separate processes, so that
+        # the window's peak RSS does not include the first copy of the data
+        for part in ('stages', 'window'):
+            out = subprocess.check_output([sys.executable,
+                os.path.abspath(__file__), '--repeat', str(args.repeat),
+                '--part', part, '--single'] + fnames +
+                (['--compact'] if args.compact else []))
+            result = json.loads(out.decode().strip().splitlines()[-1])
+            for key, value in result.items():
+                record[key].update(value)
+        print(json.dumps(record))
+        if args.output is not None:
+            with open(args.output, 'a') as f:
+                f.write(json.dumps(record)+'\n')
+
+
+if __name__ == '__main__':
+    main()
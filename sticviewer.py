@@ -2,12 +2,27 @@
 
 import os
 import sys
+import argparse
+import functools
+import hashlib
+import json
+import multiprocessing
+import shutil
+import signal
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
 
-import numpy as np
+# Start of the startup-time breakdown
+STARTUP_T0 = time.perf_counter()
 
-import matplotlib.pyplot as plt
-import matplotlib.cm as cm
-from matplotlib.colors import LinearSegmentedColormap
+import numpy as np
 
 #from ipdb import set_trace as stop
 
@@ -15,40 +30,1656 @@ if sys.version_info[0] < 3:
     raise SystemExit('Error: Python 3 or later is required to run STiCViewer')
 
 try:
-    from PyQt5 import QtCore
+    from PyQt5 import QtCore, QtGui
 except ImportError:
     raise SystemExit('ImportError: PyQt5 is required to run STiCViewer')
 else:
     from PyQt5.QtWidgets import (QMainWindow, QApplication, QAction, qApp,
     QVBoxLayout, QFileDialog, QWidget, QHBoxLayout, QVBoxLayout, QPushButton,
     QSlider, QLabel, QGridLayout, QSpacerItem, QSizePolicy, QRadioButton,
-    QButtonGroup, QGroupBox)
+    QButtonGroup, QGroupBox, QDockWidget, QComboBox, QCheckBox,
+    QDoubleSpinBox, QProgressBar)
+    from PyQt5.QtCore import QTimer
 
 try:
     import pyqtgraph as pg
 except ImportError:
     raise SystemExit('ImportError: pyqtgraph is required to run STiCViewer')
 
+# Optional backends for lazy, memory-mapped access to the input cubes; without
+# them the files are read in full through sparsetools
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+try:
+    import netCDF4
+except ImportError:
+    netCDF4 = None
+
 try:
     import sparsetools as sp
 except ImportError:
-    raise SystemExit('ImportError: sparsetools (comes with STiC distribution) is required to run STiCViewer')
+    if h5py is None and netCDF4 is None:
+        raise SystemExit('ImportError: sparsetools (comes with STiC distribution), h5py or netCDF4 is required to run STiCViewer')
+    sp = None
+
+# Maximum number of elements read per chunk when traversing a full cube
+CHUNK_ELEMENTS = 2**24
+
+# netCDF4 (and the HDF5 library underneath) must not be read from several
+# threads at once
+READ_LOCK = threading.Lock()
+
+# Sidecar directory, next to the input files, holding cached derived products
+CACHE_DIR = '.sticviewer'
+
+# Upper limit on the memory held by prefetched and recently shown image slices
+SLICE_CACHE_BYTES = 2**29
+
+# Bytes per sample of the summed-area tables of a time step: float64 sums of
+# the values and their squares, and int32 counts of finite values
+AREA_BYTES = 20
+
+# Upper limit on the disk space of summed-area tables too large for the slice
+# cache, which are memory-mapped from temporary files instead
+AREA_DISK_BYTES = 2**34
+
+# Progress shown while loading, by the stage just completed
+LOAD_MESSAGES = {'initObs': 'Reading the models and their ranges',
+        'initRuns': 'Computing chi2 of the first time step',
+        'getChi2': 'Collecting image ranges',
+        'vminmaxImage': 'Setting up the panels',
+        'loadRemote': 'Setting up the panels'}
+
+# Interval between checks of the synthetic and model files with --watch [s]
+WATCH_INTERVAL = 5.
+
+# Image levels from percentiles of a random sample of about this many pixels
+AUTOLEVEL_PERCENTILES = (0.5, 99.5)
+AUTOLEVEL_SAMPLES = 2**14
+
+# Frames of a batch movie sampled for the levels common to all its frames
+MOVIE_LEVEL_FRAMES = 8
+
+# Initial length of the ranking of the worst-fitting pixels of a time step;
+# extended when navigation runs past its end
+WORST_FITS = 4096
+
+# Number of value bins of the region density plots
+DENSITY_BINS = 128
+
+# Model variables shown in the image grid, in panel order
+MODEL_IMAGES = ('temp', 'vlos', 'vturb', 'Bln', 'Bho', 'azi')
+
+# Image grid: temp, vlos, vturb, Bln, Bho, azi, observed, synthetic, chi2
+IMAGE_ROWS = [0, 0, 0, 1, 1, 1, 2, 2, 2]
+IMAGE_COLS = [0, 1, 2] * 3
+IMAGE_CMAPS = ['gist_heat', 'bwr', 'gist_gray', 'RdGy_r', 'Oranges',
+        'Greens', 'Blues_r', 'Blues_r', 'copper']
+# Anchor colours of the matplotlib colormaps used for the images, from which
+# their colour tables are built without importing matplotlib: evenly spaced
+# colours, or (position, value) pairs per channel
+CMAP_COLORS = {'bwr': '0000ff ffffff ff0000',
+        'RdGy': '67001f b2182b d6604d f4a582 fddbc7 ffffff e0e0e0 bababa '
+        '878787 4d4d4d 1a1a1a',
+        'Oranges': 'fff5eb fee6ce fdd0a2 fdae6b fd8d3c f16913 d94801 a63603 '
+        '7f2704',
+        'Greens': 'f7fcf5 e5f5e0 c7e9c0 a1d99b 74c476 41ab5d 238b45 006d2c '
+        '00441b',
+        'Blues': 'f7fbff deebf7 c6dbef 9ecae1 6baed6 4292c6 2171b5 08519c '
+        '08306b'}
+CMAP_SEGMENTS = {'gist_gray': (((0., 0.), (1., 1.)),) * 3,
+        'gist_heat': (((0., 0.), (2./3., 1.), (1., 1.)),
+            ((0., 0.), (0.5, 0.), (1., 1.)), ((0., 0.), (0.75, 0.), (1., 1.))),
+        'copper': (((0., 0.), (0.809524, 1.), (1., 1.)),
+            ((0., 0.), (1., 0.7812)), ((0., 0.), (1., 0.4975)))}
+IMAGE_CH_COLORS = ['w', 'k', 'w', 'k', 'k', 'k', 'w', 'k', 'w']
+IMAGE_TITLES = ['T [kK]', 'vlos [km/s]', 'vturb [km/s]', 'Bln [kG]',
+        'Bho [kG]', 'azi [deg]', 'observed', 'synthetic', 'chi2']
+
+# Panels that can be marked for redrawing by the render scheduler
+DIRTY_MODEL = 1         # model images
+DIRTY_SPECTRAL = 2      # observed, synthetic and chi2 images
+DIRTY_MODELPROF = 4     # model stratification plots
+DIRTY_SPECPROF = 8      # observed and synthetic profile plots
+DIRTY_MARKERS = 16      # crosshairs, wavelength and depth markers
+DIRTY_STATUS = 32       # status bar
+DIRTY_REGION = 64       # region statistics in the plots
+DIRTY_MAPS = 128        # derived map images
+DIRTY_ALL = 255
+
+# Maps derived from the observed and synthetic profiles: line-core intensity,
+# centre-of-gravity velocity and wavelength-averaged |V|/I and
+# sqrt(Q^2+U^2)/I
+DERIVED_MAPS = ('core', 'cog', 'vi', 'lp')
+DERIVED_TITLES = {'core': 'line core I', 'cog': 'COG velocity [km/s]',
+        'vi': '|V|/I', 'lp': 'LP/I'}
+DERIVED_CMAPS = {'core': 'gist_gray', 'cog': 'bwr', 'vi': 'Blues_r',
+        'lp': 'Oranges'}
+
+# Speed of light [km/s]
+CLIGHT = 2.99792458e5
+
+# Depth axes the model can be resampled onto (--depth-grid): slider title,
+# slider units and plot axis title
+DEPTH_AXES = {'ltau': ('Optical depth', 'log('+u"τ"+')', 'log('+u"τ"+')'),
+        'z': ('Height', 'km', 'z [km]')}
+
+# Attributes of CubeData that belong to one synthetic/model run
+RUN_ATTRS = ('fname_synth', 'fname_atmos', 'm', 's', 'synprof', 'ltaus',
+        'dims', 'mstats', 'minmax_vlos', 'minmax_vlos_all', 'absmax_vlos',
+        'minmax_Bln', 'minmax_Bln_all', 'absmax_Bln', 'lutcache', 'chi2',
+        'chi2_stokes', 'stats_syn')
+
+# STiC atmosphere variables: attribute (as in sparsetools.model), variable name
+# in the file and the scaling to display units
+MODEL_VARS = {'ltau': ('ltau500', 1.), 'z': ('z', 1.e-5),
+        'temp': ('temp', 1.e-3), 'vlos': ('vlos', 1.e-5),
+        'vturb': ('vturb', 1.e-5), 'Bln': ('blong', 1.e-3),
+        'Bho': ('bhor', 1.e-3), 'azi': ('azi', 180./np.pi),
+        'pgas': ('pgas', 1.), 'rho': ('rho', 1.), 'nne': ('nne', 1.)}
+
+class ProfileStage(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, self.t0, time.perf_counter())
+
+
+class NullStage(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+class Profiler(object):
+    def __init__(self, window=200, maxevents=10**6):
+        # Rolling latencies per stage and a trace in the Chrome trace event
+        # format (chrome://tracing, https://ui.perfetto.dev)
+        self.enabled = False
+        self.window = window
+        self.latencies = {}
+        self.events = deque(maxlen=maxevents)
+        self.t0 = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def stage(self, name):
+        if not self.enabled:
+            return NullStage()
+        return ProfileStage(self, name)
+
+    def record(self, name, t0, t1):
+        with self.lock:
+            if name not in self.latencies:
+                self.latencies[name] = deque(maxlen=self.window)
+            self.latencies[name].append(t1-t0)
+            self.events.append({'name': name, 'ph': 'X', 'pid': os.getpid(),
+                'tid': threading.get_ident(), 'ts': (t0-self.t0)*1.e6,
+                'dur': (t1-t0)*1.e6})
+
+    def summary(self):
+        # (stage, number of calls, mean and maximum latency in ms) over the
+        # rolling window, slowest first
+        with self.lock:
+            rows = [(name, len(lat), 1.e3*np.mean(lat), 1.e3*np.max(lat)) for
+                    name, lat in self.latencies.items() if len(lat) > 0]
+        return sorted(rows, key=lambda row: -row[2])
+
+    def export(self, fname):
+        with self.lock:
+            events = list(self.events)
+        with open(fname, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        print("Profiler: wrote {0} events to {1}".format(len(events), fname))
+
+
+PROFILER = Profiler()
+
+def profiled(func):
+    # Time calls of func as a stage of PROFILER when profiling is enabled.
+    # The wrapper takes any arguments, so Qt passes all those of a signal:
+    # connect handlers that take fewer through a lambda
+    name = func.__qualname__
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not PROFILER.enabled:
+            return func(*args, **kwargs)
+        with ProfileStage(PROFILER, name):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class StartupTimer(object):
+    def __init__(self, t0=None):
+        self.t0 = self.last = time.perf_counter() if t0 is None else t0
+        self.stages = []
+
+    def mark(self, name):
+        # Time since the previous mark
+        now = time.perf_counter()
+        self.stages.append((name, now-self.last))
+        self.last = now
+
+    def report(self):
+        print("startup: {0} (total {1:.3f}s)".format(', '.join(
+            '{0} {1:.3f}s'.format(name, dt) for name, dt in self.stages),
+            self.last-self.t0))
+
+STARTUP = StartupTimer(STARTUP_T0)
+STARTUP.mark('imports')
+
+
+class TableColormap(object):
+    def __init__(self, name, n=256):
+        # Colour table of a bundled colormap, sampled as matplotlib does
+        base = name[:-2] if name.endswith('_r') else name
+        x = np.linspace(0., 1., n)
+        if base in CMAP_COLORS:
+            cols = np.array([[int(col[ii:ii+2], 16) for ii in (0, 2, 4)] for
+                col in CMAP_COLORS[base].split()]) / 255.
+            anchors = np.linspace(0., 1., len(cols))
+            rgb = [np.interp(x, anchors, cols[:,ii]) for ii in range(3)]
+        else:
+            rgb = [np.interp(x, *zip(*seg)) for seg in CMAP_SEGMENTS[base]]
+        self.lut = np.ones((n, 4))
+        self.lut[:,:3] = np.column_stack(rgb)
+        if name != base:
+            self.lut = self.lut[::-1]
+        self.name = name
+        self.N = n
+
+    def __call__(self, x):
+        idx = np.clip((np.asarray(x, dtype='float64')*self.N).astype(int), 0,
+                self.N-1)
+        return self.lut[idx]
+
+
+def get_cmap(name):
+    # Bundled colour table where available, so that matplotlib is only
+    # imported for other colormaps
+    base = name[:-2] if name.endswith('_r') else name
+    if base in CMAP_COLORS or base in CMAP_SEGMENTS:
+        return TableColormap(name)
+    import matplotlib
+    import matplotlib.cm
+    if hasattr(matplotlib, 'colormaps'):
+        return matplotlib.colormaps[name]
+    return matplotlib.cm.get_cmap(name)
 
 def mplcm_to_pglut(cmap):
-    cmap._init()
-    lut = (cmap._lut * 255).view(np.ndarray)[:256,:]
-    return lut
-
-def cmap_truncate(cmap, absmax=1.0, minmax=[0.1,0.9], n=256):
-    # from https://stackoverflow.com/questions/18926031/how-to-extract-a-subset-of-a-colormap-as-a-new-colormap-in-matplotlib
-    minmax_all = [-1.*absmax, absmax]
-    drange = np.diff(minmax_all)[0]
-    minval = (minmax[0]-minmax_all[0])/drange
-    maxval = 1.-(minmax_all[1]-minmax[1])/drange
-    new_cmap = LinearSegmentedColormap.from_list(
-        'trunc({n},{a:.2f},{b:.2f})'.format(n=cmap.name, a=minval, b=maxval),
-        cmap(np.linspace(minval, maxval, n)))
-    return new_cmap
+    return cmap(np.linspace(0., 1., 256)) * 255
+
+@profiled
+def cmap_truncate_luts(cmap, absmax=1.0, minmax=[[0.1],[0.9]], n=256):
+    # Colour tables of the parts of cmap over the ranges minmax[:,i] of the
+    # interval [-absmax,absmax], sampled at n points, as stacked
+    # (len(minmax[0]),n,4) LUTs
+    minmax = np.asarray(minmax, dtype='float64')
+    drange = 2.*absmax if absmax > 0 else 1.
+    minval = (minmax[0]+absmax)/drange
+    maxval = 1.-(absmax-minmax[1])/drange
+    frac = np.linspace(0., 1., n)
+    pos = minval[:,None] + (maxval-minval)[:,None]*frac[None,:]
+    return cmap(pos) * 255
+
+
+class LUTCache(object):
+    def __init__(self):
+        self.luts = {}
+
+    @profiled
+    def build(self, name, absmax, minmax):
+        # LUTs for all depths of one colormap in a single pass
+        self.luts[name] = cmap_truncate_luts(get_cmap(name), absmax=absmax,
+                minmax=minmax)
+
+    def get(self, name, itau):
+        return self.luts[name][itau]
+
+    @classmethod
+    def fromArrays(cls, luts):
+        cache = cls()
+        cache.luts.update(luts)
+        return cache
+
+    def toArrays(self):
+        return dict(self.luts)
+
+def as_selection(idx):
+    # Express an index array as a range where possible so that reads can use
+    # plain slices (views) instead of fancy indexing (copies)
+    if isinstance(idx, range):
+        return idx
+    idx = np.asarray(idx, dtype=np.intp).ravel()
+    if idx.size == 1:
+        return range(int(idx[0]), int(idx[0])+1)
+    if idx.size > 1:
+        step = int(idx[1] - idx[0])
+        if step > 0 and np.all(np.diff(idx) == step):
+            return range(int(idx[0]), int(idx[-1])+1, step)
+    return idx
+
+def outer_index(arr, key):
+    # Index an array as h5py and netCDF4 do: an index array selects along its
+    # own axis, where numpy would move that axis to the front when integers
+    # elsewhere in the key remove other axes
+    iarr = [ii for ii, k in enumerate(key) if isinstance(k, np.ndarray)]
+    if not iarr:
+        return arr[key]
+    dat = arr[tuple(slice(None) if ii in iarr else k for ii, k in
+        enumerate(key))]
+    for ii in iarr:
+        axis = ii - sum(1 for k in key[:ii] if isinstance(k, int))
+        dat = dat.take(key[ii], axis=axis)
+    return dat
+
+def cube_stats(cubes, stats=None, times=None):
+    # Ranges of several equally shaped cubes in a single chunked traversal,
+    # optionally of some time steps only and added to earlier stats
+    if stats is None:
+        stats = dict((name, CubeStats(cube.shape)) for name, cube in
+                cubes.items())
+    first = list(cubes.values())[0]
+    for key in first.chunks(maxsize=CHUNK_ELEMENTS//len(cubes)):
+        if times is not None and key[0] not in times:
+            continue
+        for name, cube in cubes.items():
+            stats[name].update(key, cube[key])
+    return stats
+
+
+class CubeStats(object):
+    def __init__(self, shape):
+        # Running ranges over all but the last axis (depth or Stokes), kept
+        # per time step so that partial traversals are usable as well
+        self.tmin = np.full((shape[0], shape[-1]), np.inf)
+        self.tmax = np.full((shape[0], shape[-1]), -np.inf)
+        self.lock = threading.Lock()
+
+    def update(self, key, dat):
+        dat = dat.reshape(-1, dat.shape[-1])
+        # NaN-ignoring reductions, also quiet for all-NaN columns (depths
+        # outside a resampled grid)
+        vmin = np.fmin.reduce(dat, axis=0)
+        vmax = np.fmax.reduce(dat, axis=0)
+        tt = key[0]
+        with self.lock:
+            np.fmin(self.tmin[tt], vmin, out=self.tmin[tt])
+            np.fmax(self.tmax[tt], vmax, out=self.tmax[tt])
+
+    @classmethod
+    def fromArray(cls, arr):
+        stats = cls((arr.shape[1], arr.shape[2]))
+        stats.tmin[:] = arr[0]
+        stats.tmax[:] = arr[1]
+        return stats
+
+    def toArray(self):
+        return np.array([self.tmin, self.tmax])
+
+    def minmax(self):
+        return np.array([self.tmin.min(axis=0), self.tmax.max(axis=0)])
+
+    def minmaxAll(self):
+        return (self.tmin.min(), self.tmax.max())
+
+    def absmax(self):
+        minmax = self.minmax()
+        return np.abs(minmax[np.isfinite(minmax)]).max()
+
+
+def row_slices(ny, rowsize, maxsize=CHUNK_ELEMENTS):
+    # Blocks of rows of rowsize elements each, of at most maxsize elements
+    nrow = max(1, min(ny, maxsize // max(rowsize, 1)))
+    return [slice(y0, min(y0+nrow, ny)) for y0 in range(0, ny, nrow)]
+
+
+def cube_chunks(shape, maxsize=CHUNK_ELEMENTS):
+    # Keys of (time, row block) slabs of at most maxsize elements of a cube
+    # (t,y,...) of the given shape
+    for tt in range(shape[0]):
+        for rows in row_slices(shape[1], int(np.prod(shape[2:])), maxsize):
+            yield (tt, rows)
+
+
+class LazyCube(object):
+    def __init__(self, var, scale=1., wsel=None, dtype=None):
+        # var may be an in-memory array, a np.memmap or a file variable
+        # (h5py/netCDF4) that only reads the requested slice. Slices are
+        # converted to dtype (if given) and scaled only when read
+        self.var = var
+        self.scale = scale
+        self.wsel = wsel
+        self.dtype = dtype
+        shape = list(var.shape)
+        if wsel is not None:
+            shape[3] = len(wsel)
+        self.shape = tuple(shape)
+        self.ndim = len(shape)
+        self.size = int(np.prod(shape))
+
+    def take(self, wsel):
+        # Select wavelengths (axis 3) without reading or copying any data
+        if self.wsel is not None:
+            wsel = np.asarray(self.wsel)[np.asarray(wsel)]
+        return LazyCube(self.var, scale=self.scale, wsel=as_selection(wsel),
+                dtype=self.dtype)
+
+    def normKey(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            iell = [k is Ellipsis for k in key].index(True)
+            key = key[:iell] + (slice(None),) * (self.ndim-len(key)+1) + \
+                    key[iell+1:]
+        key = key + (slice(None),) * (self.ndim-len(key))
+        if len(key) > self.ndim:
+            raise IndexError('LazyCube: too many indices')
+        out = []
+        for axis, (k, n) in enumerate(zip(key, self.shape)):
+            if isinstance(k, slice):
+                k = slice(*k.indices(n))
+            elif np.ndim(k) == 0:
+                k = int(k)
+                if k < 0: k += n
+                if k < 0 or k >= n:
+                    raise IndexError('LazyCube: index out of range')
+            else:
+                k = np.asarray(k, dtype=np.intp)
+                k = np.where(k < 0, k+n, k)
+            if axis == 3 and self.wsel is not None:
+                k = self.selectWave(k)
+            out.append(k)
+        return tuple(out)
+
+    def selectWave(self, k):
+        if isinstance(self.wsel, range):
+            k = self.wsel[k]
+            if isinstance(k, range):
+                k = slice(k.start, k.stop, k.step) if len(k) > 0 else slice(0, 0)
+            return k
+        if isinstance(k, slice):
+            return self.wsel[k]
+        return self.wsel[k] if np.ndim(k) else int(self.wsel[k])
+
+    @profiled
+    def __getitem__(self, key):
+        key = self.normKey(key)
+        if isinstance(self.var, np.ndarray):
+            dat = np.asarray(outer_index(self.var, key))
+        else:
+            with READ_LOCK:
+                dat = np.asarray(self.var[key])
+        if self.dtype is not None:
+            dat = dat.astype(self.dtype, copy=False)
+        if self.scale != 1.:
+            dat = dat * self.scale
+        return dat[()] if dat.ndim == 0 else dat
+
+    def chunks(self, maxsize=CHUNK_ELEMENTS):
+        return cube_chunks(self.shape, maxsize)
+
+
+def chi2_chunk(obs, syn, iwts2):
+    # chi2 per Stokes parameter of a chunk of profiles (...,wav,stokes)
+    diff = obs - syn
+    diff *= diff
+    diff *= iwts2
+    return diff.sum(axis=-2) / diff.shape[-2]
+
+
+class Chi2Engine(object):
+    def __init__(self, obs, syns, weights, nthreads=None, dtype='float64'):
+        # chi2 of one or more synthetic cubes (runs) against the same
+        # observations, read once per chunk. Weights are kept as (nw,ns) and
+        # broadcast against each chunk
+        self.obs = obs
+        self.syns = syns
+        self.iwts2 = (1. / np.asarray(weights, dtype='float64')**2).astype(
+                dtype)
+        self.nt, self.ny, self.nx, self.nw, self.ns = obs.shape
+        self.nthreads = nthreads or os.cpu_count() or 1
+        self.chi2_stokes = [np.zeros((self.nt, self.ny, self.nx, self.ns),
+            dtype=dtype) for syn in syns]
+        self.chi2 = [np.zeros((self.nt, self.ny, self.nx), dtype=dtype) for
+                syn in syns]
+        self.done = np.zeros(self.nt, dtype=bool)
+        self.failed = np.zeros(self.nt, dtype=bool)
+        self.error = None
+        self.stats_obs = CubeStats(obs.shape)
+        self.stats_syn = [CubeStats(syn.shape) for syn in syns]
+        self.cancelled = False
+        self.lock = threading.Lock()
+        self.keys = [[] for tt in range(self.nt)]
+        for key in obs.chunks():
+            self.keys[key[0]].append(key)
+
+    @profiled
+    def computeChunk(self, key):
+        if self.cancelled:
+            return
+        obs = self.obs[key]
+        # Collect the image ranges in the same pass
+        self.stats_obs.update(key, obs)
+        for ii, syncube in enumerate(self.syns):
+            syn = syncube[key]
+            self.stats_syn[ii].update(key, syn)
+            self.chi2_stokes[ii][key] = chi2_chunk(obs, syn, self.iwts2)
+
+    def finishTime(self, tt):
+        for chi2, chi2_stokes in zip(self.chi2, self.chi2_stokes):
+            chi2[tt] = chi2_stokes[tt].sum(axis=-1) / self.ns
+        self.done[tt] = True
+
+    def computeTime(self, tt):
+        # Synchronous computation of a single time step
+        if not self.done[tt]:
+            for key in self.keys[tt]:
+                self.computeChunk(key)
+            self.finishTime(tt)
+
+    def start(self, callback=None):
+        # Compute the remaining time steps in a thread pool; callback(tt) is
+        # called from a worker thread as soon as time step tt is complete, or
+        # has failed (failed[tt], with the first error in error)
+        self.pending = [len(keys) for keys in self.keys]
+        pool = ThreadPoolExecutor(max_workers=self.nthreads)
+        for tt in range(self.nt):
+            if self.done[tt]:
+                continue
+            for key in self.keys[tt]:
+                pool.submit(self.runChunk, key, callback)
+        pool.shutdown(wait=False)
+        self.pool = pool
+
+    def runChunk(self, key, callback):
+        tt = key[0]
+        try:
+            self.computeChunk(key)
+        except Exception as err:
+            # Read errors (e.g. of a file truncated while watched) and
+            # MemoryError fail the time step instead of leaving it pending
+            print("Chi2Engine: time step {0}: {1}".format(tt, err))
+            with self.lock:
+                self.failed[tt] = True
+                if self.error is None:
+                    self.error = str(err) or err.__class__.__name__
+        with self.lock:
+            self.pending[tt] -= 1
+            finished = self.pending[tt] == 0
+        if finished and not self.cancelled:
+            if not self.failed[tt]:
+                self.finishTime(tt)
+            if callback is not None:
+                callback(tt)
+
+    def finished(self):
+        # All time steps done or failed
+        return bool((self.done | self.failed).all())
+
+    def wait(self):
+        if getattr(self, 'pool', None) is not None:
+            self.pool.shutdown(wait=True)
+        if self.error is not None:
+            raise RuntimeError('Chi2Engine: {0}'.format(self.error))
+
+    def cancel(self):
+        self.cancelled = True
+
+
+def file_identity(fname, nblock=16, blocksize=2**16):
+    # Path, size, modification time and a hash of evenly spaced blocks of the
+    # file content (hashing multi-GB cubes in full would defeat the cache)
+    st = os.stat(fname)
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for offset in np.linspace(0, max(0, st.st_size-blocksize), nblock):
+            f.seek(int(offset))
+            h.update(f.read(blocksize))
+    return '{0}|{1}|{2}|{3}'.format(os.path.abspath(fname), st.st_size,
+            st.st_mtime_ns, h.hexdigest())
+
+
+class DerivedCache(object):
+    def __init__(self, dtype=None):
+        # Each entry is a .npy file (memory-mapped on load) next to the last
+        # of its input files, plus a .id file with the identity of the inputs.
+        # Entries derived from slices of reduced precision (--compact) are
+        # named after the dtype, apart from the full-precision ones
+        self.dtype = dtype
+        self.identities = {}
+
+    def identity(self, fnames):
+        for fname in fnames:
+            if fname not in self.identities:
+                self.identities[fname] = file_identity(fname)
+        return '\n'.join(self.identities[fname] for fname in fnames)
+
+    def path(self, name, fnames):
+        tag = hashlib.sha1('|'.join(os.path.abspath(fname) for fname in
+            fnames).encode('utf8')).hexdigest()[:16]
+        if self.dtype is not None:
+            name = '{0}-{1}'.format(name, np.dtype(self.dtype).name)
+        return os.path.join(os.path.dirname(os.path.abspath(fnames[-1])),
+                CACHE_DIR, '{0}-{1}'.format(name, tag))
+
+    def load(self, name, fnames):
+        path = self.path(name, fnames)
+        try:
+            with open(path+'.id', 'r') as f:
+                if f.read() != self.identity(fnames):
+                    return None
+            return np.load(path+'.npy', mmap_mode='c')
+        except (IOError, OSError, ValueError):
+            return None
+
+    def save(self, name, fnames, arr):
+        path = self.path(name, fnames)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            np.save(path+'.tmp.npy', np.asarray(arr))
+        except (IOError, OSError) as err:
+            print("DerivedCache: could not write {0}: {1}".format(path, err))
+            return
+        self.commit(name, fnames)
+
+    def create(self, name, fnames, shape, dtype):
+        # Writable memory-mapped entry, filled by the caller and made visible
+        # to later loads by commit
+        path = self.path(name, fnames)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return np.lib.format.open_memmap(path+'.tmp.npy', mode='w+',
+                dtype=dtype, shape=shape)
+
+    def commit(self, name, fnames, identity=None):
+        # With the identity of the inputs taken before they were read, an
+        # entry whose inputs changed while it was filled is dropped instead
+        path = self.path(name, fnames)
+        if identity is not None and identity != '\n'.join(file_identity(fname)
+                for fname in fnames):
+            print("DerivedCache: {0} changed while {1} was written, not "
+                    "cached".format(', '.join(fnames), name))
+            try:
+                os.remove(path+'.tmp.npy')
+            except OSError:
+                pass
+            return
+        try:
+            os.replace(path+'.tmp.npy', path+'.npy')
+            with open(path+'.id', 'w') as f:
+                f.write(identity or self.identity(fnames))
+        except (IOError, OSError) as err:
+            print("DerivedCache: could not write {0}: {1}".format(path, err))
+
+
+class PixelCache(object):
+    def __init__(self, cache, name, fnames, cubes, tt0=0, block=16,
+            maxbytes=2**26, dtype='float64'):
+        # Pixel-major copy of several (time,y,x,...) cubes in dtype, so that
+        # everything shown for a pixel is one contiguous record. It is built
+        # in a background thread into the derived-product cache, starting
+        # with time step tt0; blocks of recently hovered pixels are kept in
+        # an LRU in front of it
+        self.names = [cname for cname, cube in cubes]
+        self.cubes = [cube for cname, cube in cubes]
+        self.shapes = [cube.shape[3:] for cube in self.cubes]
+        self.offsets = np.cumsum([0] + [int(np.prod(shape)) for shape in
+            self.shapes])
+        nt, ny, nx = self.cubes[0].shape[:3]
+        shape = (nt, ny, nx, int(self.offsets[-1]))
+        self.block = block
+        self.maxbytes = maxbytes
+        self.blocks = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self.dat = cache.load(name, fnames)
+        if self.dat is not None and self.dat.shape == shape and \
+                self.dat.dtype == np.dtype(dtype):
+            self.done = np.ones((nt, ny), dtype=bool)
+            return
+        self.done = np.zeros((nt, ny), dtype=bool)
+        identity = cache.identity(fnames)
+        try:
+            self.dat = cache.create(name, fnames, shape, dtype)
+        except (IOError, OSError) as err:
+            print("PixelCache: could not create {0}: {1}".format(name, err))
+            self.dat = None
+            return
+        self.thread = threading.Thread(target=self.build, args=(cache, name,
+            fnames, identity, tt0), daemon=True)
+        self.thread.start()
+
+    def build(self, cache, name, fnames, identity, tt0):
+        keys = sorted(self.cubes[0].chunks(CHUNK_ELEMENTS//len(self.cubes)),
+                key=lambda key: key[0] != tt0)
+        for tt, rows in keys:
+            if self.cancelled:
+                return
+            self.fill(tt, rows)
+        self.dat.flush()
+        cache.commit(name, fnames, identity)
+
+    def fill(self, tt, rows):
+        for cube, start, stop in zip(self.cubes, self.offsets[:-1],
+                self.offsets[1:]):
+            dat = cube[tt,rows]
+            self.dat[tt,rows,:,start:stop] = dat.reshape(dat.shape[:2] +
+                    (-1,))
+        self.done[tt,rows] = True
+
+    def update(self, cubes, keys):
+        # Refill the rows (tt, rows) of reopened input files that changed
+        if self.dat is None:
+            return
+        self.cubes = [cube for cname, cube in cubes]
+        for tt, rows in keys:
+            self.fill(tt, rows)
+        with self.lock:
+            self.blocks.clear()
+            self.nbytes = 0
+
+    def cancel(self):
+        self.cancelled = True
+
+    @profiled
+    def pixel(self, tt, yy, xx):
+        # Record of one pixel split per cube, or None if not built yet
+        if self.dat is None or not self.done[tt,yy]:
+            return None
+        nb = self.block
+        key = (tt, yy//nb, xx//nb)
+        with self.lock:
+            blk = self.blocks.get(key)
+            if blk is not None:
+                self.blocks.move_to_end(key)
+        if blk is None:
+            y0, x0 = key[1]*nb, key[2]*nb
+            if not self.done[tt,y0:y0+nb].all():
+                return self.split(np.array(self.dat[tt,yy,xx]))
+            blk = np.array(self.dat[tt,y0:y0+nb,x0:x0+nb])
+            with self.lock:
+                self.blocks[key] = blk
+                self.nbytes += blk.nbytes
+                while self.nbytes > self.maxbytes and len(self.blocks) > 1:
+                    _, old = self.blocks.popitem(last=False)
+                    self.nbytes -= old.nbytes
+        return self.split(blk[yy%nb,xx%nb])
+
+    def split(self, rec):
+        return dict((name, rec[start:stop].reshape(shape)) for name, start,
+                stop, shape in zip(self.names, self.offsets[:-1],
+                    self.offsets[1:], self.shapes))
+
+
+def sample_levels(dat, percentiles=AUTOLEVEL_PERCENTILES,
+        nsample=AUTOLEVEL_SAMPLES):
+    # Percentile levels from a stratified random sample (one pixel drawn from
+    # each stretch of the flattened image), so that a few hot pixels do not
+    # set the contrast and large images are not scanned in full
+    flat = np.asarray(dat).ravel()
+    stride = max(1, flat.size // nsample)
+    idx = np.arange(0, flat.size, stride)
+    if stride > 1:
+        rng = np.random.default_rng(flat.size)
+        idx = np.minimum(idx + rng.integers(0, stride, idx.size), flat.size-1)
+    sample = flat[idx]
+    sample = sample[np.isfinite(sample)]
+    if sample.size == 0:
+        return (0., 1.)
+    vmin, vmax = np.percentile(sample, percentiles)
+    if vmax <= vmin:
+        return (vmin-0.5, vmin+0.5)
+    return (vmin, vmax)
+
+
+class ImagePyramid(object):
+    def __init__(self, dat, minsize=256):
+        # Full-resolution image plus 2x2 block-averaged levels down to minsize
+        self.levels = [np.asarray(dat)]
+        while max(self.levels[-1].shape) > minsize and \
+                min(self.levels[-1].shape) >= 2:
+            prev = self.levels[-1]
+            ny, nx = prev.shape[0]//2, prev.shape[1]//2
+            self.levels.append(prev[:2*ny,:2*nx].reshape(ny, 2, nx, 2).mean(
+                axis=(1,3)))
+        self.nbytes = sum(level.nbytes for level in self.levels)
+        self.minmax = None
+        self.auto = sample_levels(self.levels[0])
+
+    def range(self):
+        # Full data range, only scanned for when asked for, as the levels are
+        # normally those of the sample
+        if self.minmax is None:
+            finite = np.isfinite(self.levels[0])
+            if finite.any():
+                self.minmax = (self.levels[0][finite].min(),
+                        self.levels[0][finite].max())
+            else:
+                self.minmax = (0., 1.)
+        return self.minmax
+
+    def level(self, ratio):
+        # Coarsest level with at least one image pixel per screen pixel, given
+        # the number of full-resolution pixels per screen pixel
+        if ratio <= 1.:
+            return 0
+        return min(int(np.log2(ratio)), len(self.levels)-1)
+
+
+class SummedArea(object):
+    def __init__(self, cube, tt, tmpdir=None):
+        # Summed-area tables of time step tt of cube(t,y,x,...) and its
+        # square, with a leading row and column of zeros, so that the sum over
+        # any box of pixels costs four lookups per sample. Filled over blocks
+        # of rows read in the dtype of the cube, so that only the tables are
+        # held in full; these stay float64, as float32 sums over millions of
+        # pixels lose the precision of the standard deviation. Non-finite
+        # values are left out and counted separately. With tmpdir set, the
+        # tables are memory-mapped from temporary files in that directory,
+        # for time steps whose tables do not fit in memory
+        self.tmpdir = tmpdir
+        ny, nx = cube.shape[1:3]
+        tail = tuple(cube.shape[3:])
+        self.sum = self.zeros((ny+1, nx+1) + tail, 'float64')
+        self.sum2 = self.zeros((ny+1, nx+1) + tail, 'float64')
+        self.count = None
+        for rows in row_slices(ny, nx*int(np.prod(tail))):
+            dat = np.asarray(cube[tt,rows])
+            finite = np.isfinite(dat)
+            if self.count is None and not finite.all():
+                # The rows above had no non-finite values
+                self.count = self.zeros((ny+1, nx+1) + tail, np.int32)
+                self.count[:rows.start+1] = np.multiply.outer(
+                        np.arange(rows.start+1), np.arange(nx+1)).reshape(
+                        (rows.start+1, nx+1) + (1,)*len(tail))
+            if self.count is not None:
+                dat = np.where(finite, dat, 0)
+                self.accumulate(self.count, finite, rows)
+            self.accumulate(self.sum, dat, rows)
+            self.accumulate(self.sum2, np.square(dat, dtype='float64'), rows)
+        self.nbytes = self.sum.nbytes + self.sum2.nbytes + \
+                (self.count.nbytes if self.count is not None else 0)
+
+    def zeros(self, shape, dtype):
+        if self.tmpdir is None:
+            return np.zeros(shape, dtype=dtype)
+        # Unlinked file, removed with the last reference to the table
+        os.makedirs(self.tmpdir, exist_ok=True)
+        with tempfile.TemporaryFile(dir=self.tmpdir) as f:
+            return np.memmap(f, dtype=dtype, mode='w+', shape=shape)
+
+    def accumulate(self, tab, dat, rows):
+        # Rows of the table from those of dat, continuing the sums above
+        blk = tab[rows.start+1:rows.stop+1,1:]
+        np.cumsum(dat, axis=1, dtype=tab.dtype, out=blk)
+        np.cumsum(blk, axis=0, out=blk)
+        blk += tab[rows.start,1:]
+
+    def boxSum(self, tab, boxes):
+        y0, y1, x0, x1 = boxes
+        return (tab[y1,x1] - tab[y0,x1] - tab[y1,x0] + tab[y0,x0]).sum(axis=0)
+
+    def stats(self, boxes):
+        # Number of pixels, mean and standard deviation over a region given as
+        # boxes (y0,y1,x0,x1), per remaining sample
+        if self.count is None:
+            y0, y1, x0, x1 = boxes
+            n = np.full(self.sum.shape[2:], ((y1-y0)*(x1-x0)).sum(), dtype=float)
+        else:
+            n = self.boxSum(self.count, boxes)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self.boxSum(self.sum, boxes) / n
+            var = self.boxSum(self.sum2, boxes) / n - mean**2
+        return n, mean, np.sqrt(np.maximum(var, 0.))
+
+
+def region_boxes(region, ny, nx):
+    # Pixels with their centre inside a rectangle ('rect', x, y, w, h) or a
+    # polygon ('poly', [(x,y), ...]), as arrays of boxes (y0,y1,x0,x1): a
+    # single box for a rectangle, one per run of pixels along a row otherwise
+    if region[0] == 'rect':
+        x, y, w, h = region[1:]
+        x0, y0 = int(np.ceil(min(x, x+w)-0.5)), int(np.ceil(min(y, y+h)-0.5))
+        x1 = int(np.floor(max(x, x+w)-0.5)) + 1
+        y1 = int(np.floor(max(y, y+h)-0.5)) + 1
+        x0, y0 = min(max(x0, 0), nx-1), min(max(y0, 0), ny-1)
+        x1, y1 = min(max(x1, x0+1), nx), min(max(y1, y0+1), ny)
+        return tuple(np.array([ii]) for ii in (y0, y1, x0, x1))
+    verts = np.asarray(region[1], dtype='float64')
+    xa = int(np.clip(np.floor(verts[:,0].min()), 0, nx-1))
+    xb = int(np.clip(np.ceil(verts[:,0].max()), xa+1, nx))
+    ya = int(np.clip(np.floor(verts[:,1].min()), 0, ny-1))
+    yb = int(np.clip(np.ceil(verts[:,1].max()), ya+1, ny))
+    yy, xx = np.mgrid[ya:yb,xa:xb] + 0.5
+    # Even-odd rule: count the polygon edges crossed to the right of each
+    # pixel centre
+    inside = np.zeros(xx.shape, dtype=bool)
+    xj, yj = verts[-1]
+    for xi, yi in verts:
+        if yi != yj:
+            cross = (yi > yy) != (yj > yy)
+            inside ^= cross & (xx < xi + (xj-xi)*(yy-yi)/(yj-yi))
+        xj, yj = xi, yi
+    if not inside.any():
+        inside[(yb-ya)//2,(xb-xa)//2] = True
+    edges = np.diff(np.pad(inside.astype(np.int8), ((0,0),(1,1))), axis=1)
+    rows, x0 = np.nonzero(edges == 1)
+    _, x1 = np.nonzero(edges == -1)
+    return (rows+ya, rows+ya+1, x0+xa, x1+xa)
+
+
+def region_mask(boxes):
+    # Pixel mask of boxes (y0,y1,x0,x1) over their bounding window, and the
+    # origin (y,x) of the window
+    y0, y1, x0, x1 = boxes
+    ya, xa = y0.min(), x0.min()
+    mask = np.zeros((y1.max()-ya, x1.max()-xa), dtype=bool)
+    for yb, ye, xb, xe in zip(y0-ya, y1-ya, x0-xa, x1-xa):
+        mask[yb:ye,xb:xe] = True
+    return mask, ya, xa
+
+
+def region_stats(cube, tt, boxes):
+    # As SummedArea.stats, but summing the pixels of the region directly from
+    # time step tt of cube, over blocks of rows of its bounding window: for
+    # cubes whose tables are not at hand
+    mask, ya, xa = region_mask(boxes)
+    tail = tuple(cube.shape[3:])
+    n, total, total2 = np.zeros(tail), np.zeros(tail), np.zeros(tail)
+    for rows in row_slices(mask.shape[0], mask.shape[1]*int(np.prod(tail))):
+        inside = mask[rows]
+        if not inside.any():
+            continue
+        dat = np.asarray(cube[tt,ya+rows.start:ya+rows.stop,
+            xa:xa+mask.shape[1]])[inside]
+        finite = np.isfinite(dat)
+        dat = np.where(finite, dat, 0)
+        n += finite.sum(axis=0)
+        total += dat.sum(axis=0, dtype='float64')
+        total2 += np.square(dat, dtype='float64').sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / n
+        var = total2 / n - mean**2
+    return n, mean, np.sqrt(np.maximum(var, 0.))
+
+
+class FitRanking(object):
+    def __init__(self, chi2, k=WORST_FITS, mask=None, y0=0, x0=0):
+        # Pixels of the k largest chi2 values of a map, in decreasing order,
+        # found with a partial sort so that maps of millions of pixels are
+        # not sorted in full. Non-finite values are left out, as are pixels
+        # outside mask (a window with origin y0,x0) when given
+        chi2 = np.asarray(chi2, dtype='float64')
+        if mask is not None:
+            ny, nx = mask.shape
+            chi2 = np.where(mask, chi2[y0:y0+ny,x0:x0+nx], np.nan)
+        flat = chi2.ravel()
+        valid = np.nonzero(np.isfinite(flat))[0]
+        self.total = valid.size
+        self.k = k
+        k = min(k, valid.size)
+        top = valid[np.argpartition(flat[valid], valid.size-k)[valid.size-k:]] \
+                if k > 0 else valid
+        top = top[np.argsort(flat[top])[::-1]]
+        self.values = flat[top]
+        self.yy, self.xx = np.divmod(top, chi2.shape[1])
+        self.yy += y0
+        self.xx += x0
+        self.nbytes = self.values.nbytes + self.yy.nbytes + self.xx.nbytes
+
+    def count(self, threshold=None):
+        # Number of ranked pixels with chi2 of at least threshold
+        if threshold is None:
+            return self.values.size
+        return int(np.searchsorted(-self.values, -threshold, side='right'))
+
+    def complete(self):
+        return self.values.size == self.total
+
+
+def step_sample(cube, tt, nsample=AUTOLEVEL_SAMPLES):
+    # About nsample pixels on a regular grid over time step tt of
+    # cube(t,y,x,...), for levels of a whole time step without reading it
+    ny, nx = cube.shape[1:3]
+    step = max(1, int(np.sqrt(ny*nx / nsample)))
+    return np.asarray(cube[tt,step//2::step,step//2::step])
+
+
+class BinnedCube(object):
+    def __init__(self, cubes, tt, vmin, vmax, rows=None, cols=None,
+            nbins=DENSITY_BINS):
+        # Value bin of every sample of time step tt of cubes(t,y,x,...),
+        # stacked along a last axis, from vmin to vmax (which broadcast
+        # against the trailing axes), as uint8; values outside are put in the
+        # outer bins and non-finite ones in an extra bin nbins. Densities over
+        # any set of pixels are then a single bincount. Filled over blocks of
+        # rows, of the whole time step or of the window rows, cols only
+        self.vmin = np.asarray(vmin, dtype='float64')
+        self.vmax = np.asarray(vmax, dtype='float64')
+        self.nbins = nbins
+        ny, nx = cubes[0].shape[1:3]
+        rows = rows or slice(0, ny)
+        cols = cols or slice(0, nx)
+        self.y0, self.x0 = rows.start, cols.start
+        tail = tuple(cubes[0].shape[3:]) + (len(cubes),)
+        self.bins = np.empty((rows.stop-rows.start, cols.stop-cols.start) +
+                tail, dtype=np.uint8)
+        vmin = np.broadcast_to(self.vmin, tail)
+        scale = nbins / (np.broadcast_to(self.vmax, tail) - vmin)
+        for blk in row_slices(self.bins.shape[0], int(np.prod(
+                self.bins.shape[1:]))):
+            for ii, cube in enumerate(cubes):
+                dat = cube[tt,self.y0+blk.start:self.y0+blk.stop,cols]
+                with np.errstate(invalid='ignore'):
+                    ib = (dat - vmin[...,ii]) * scale[...,ii]
+                finite = np.isfinite(ib)
+                np.clip(ib, 0, nbins-1, out=ib)
+                ib[~finite] = nbins
+                self.bins[blk,...,ii] = ib
+        self.nbytes = self.bins.nbytes
+
+    @profiled
+    def density(self, mask, y0, x0):
+        # Counts (...,ncubes,nbins) per trailing sample over the pixels of
+        # mask, a window with origin (y0,x0) inside the binned one
+        ny, nx = mask.shape
+        y0, x0 = y0-self.y0, x0-self.x0
+        sel = self.bins[y0:y0+ny,x0:x0+nx][mask]
+        shape = sel.shape[1:]
+        sel = sel.reshape(sel.shape[0], -1)
+        ncol = sel.shape[1]
+        idx = sel + (self.nbins+1) * np.arange(ncol)
+        counts = np.bincount(idx.ravel(), minlength=ncol*(self.nbins+1))
+        return counts.reshape(shape + (self.nbins+1,))[...,:self.nbins]
+
+
+def derived_maps(dat, wav):
+    # Derived maps (DERIVED_MAPS order) of profiles dat(...,wav,stokes); the
+    # centre of gravity is returned as a wavelength
+    stokesI = dat[...,0]
+    depth = stokesI.max(axis=-1)[...,None] - stokesI
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cog = (depth*wav).sum(axis=-1) / depth.sum(axis=-1)
+        vi = (np.abs(dat[...,3]) / stokesI).mean(axis=-1)
+        lp = (np.sqrt(dat[...,1]**2 + dat[...,2]**2) / stokesI).mean(axis=-1)
+    return np.array([stokesI.min(axis=-1), cog, vi, lp])
+
+@profiled
+def compute_maps(cube, wav, tt, nthreads=None, dtype='float64'):
+    # Derived maps of one time step in dtype, computed over row blocks in
+    # parallel
+    ny, nx = cube.shape[1:3]
+    out = np.empty((len(DERIVED_MAPS), ny, nx), dtype=dtype)
+    def run(key):
+        out[:,key[1]] = derived_maps(cube[key], wav)
+    keys = [key for key in cube.chunks() if key[0] == tt]
+    with ThreadPoolExecutor(max_workers=nthreads or os.cpu_count() or 1) as \
+            pool:
+        list(pool.map(run, keys))
+    return out
+
+
+class MapSet(object):
+    def __init__(self, maps):
+        # Image pyramids of the derived maps of one time step
+        self.pyramids = dict((name, ImagePyramid(dat)) for name, dat in
+                zip(DERIVED_MAPS, maps))
+        self.nbytes = sum(pyr.nbytes for pyr in self.pyramids.values())
+
+
+def slice_runs(key):
+    # Runs a SliceCache key depends on (none for the observations) and its
+    # time step
+    if key[0] in ('maps', 'area', 'bins', 'levels', 'worst'):
+        return ([] if key[1] == 'obs' else [key[1]]), key[-1]
+    if key[0] == 'obs':
+        return [], key[1]
+    if isinstance(key[1], str):
+        return [key[0]], key[2]
+    return [key[0], key[1]], key[3]
+
+
+class SliceCache(object):
+    def __init__(self, maxbytes=SLICE_CACHE_BYTES):
+        # LRU of image slices, filled on demand and by a prefetch thread
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.items = OrderedDict()
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=1)
+
+    def get(self, key, load):
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                self.hits += 1
+                return self.items[key]
+            future = self.pending.get(key)
+            if future is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if future is not None:
+            return future.result()
+        dat = load()
+        self.put(key, dat)
+        return dat
+
+    def put(self, key, dat):
+        # Slices larger than the whole cache are not kept, as the newest slice
+        # is never evicted
+        if dat.nbytes > self.maxbytes:
+            return
+        with self.lock:
+            if key in self.items:
+                return
+            self.items[key] = dat
+            self.nbytes += dat.nbytes
+            while self.nbytes > self.maxbytes and len(self.items) > 1:
+                _, old = self.items.popitem(last=False)
+                self.nbytes -= old.nbytes
+
+    def prefetch(self, requests):
+        # Queue (key, load) pairs, dropping earlier predictions not yet started
+        wanted = set(key for key, load in requests)
+        with self.lock:
+            for key in list(self.pending):
+                if key not in wanted and self.pending[key].cancel():
+                    del self.pending[key]
+            for key, load in requests:
+                if key not in self.items and key not in self.pending:
+                    self.pending[key] = self.pool.submit(self.fetch, key, load)
+
+    @profiled
+    def fetch(self, key, load):
+        try:
+            dat = load()
+            self.put(key, dat)
+            return dat
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+
+    def ready(self, keys):
+        with self.lock:
+            return all(key in self.items for key in keys)
+
+    def peek(self, key):
+        # Cached slice or None, without loading it or counting a hit
+        with self.lock:
+            return self.items.get(key)
+
+    def discard(self, stale):
+        # Drop the slices, and predictions not yet started, whose key
+        # satisfies stale(key)
+        with self.lock:
+            for key in [key for key in self.items if stale(key)]:
+                self.nbytes -= self.items.pop(key).nbytes
+            for key in [key for key in self.pending if stale(key)]:
+                if self.pending[key].cancel():
+                    del self.pending[key]
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.nbytes = 0
+
+    def shutdown(self):
+        self.prefetch([])
+        self.pool.shutdown(wait=False)
+
+
+class CubeFile(object):
+    # File locking is turned off to read files still being written (--watch)
+    locking = True
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.generation = 0
+        self.open()
+
+    def open(self):
+        self.h5 = None
+        self.nc = None
+        if h5py is not None:
+            try:
+                if self.locking:
+                    self.h5 = h5py.File(self.fname, 'r')
+                else:
+                    self.h5 = h5py.File(self.fname, 'r', locking=False)
+            except (IOError, OSError):
+                self.h5 = None
+        if self.h5 is None:
+            if netCDF4 is None:
+                raise IOError('CubeFile: {0} is not an HDF5 file, netCDF4 is '
+                        'required to open it lazily'.format(self.fname))
+            self.nc = netCDF4.Dataset(self.fname, 'r')
+
+    def reopen(self):
+        # HDF5 hands a second open of a file that is still open the same
+        # file, with its metadata and chunk caches, so the old handles are
+        # closed first. Variables handed out by var() switch to the new
+        # handles on their next read; call with READ_LOCK held
+        if self.h5 is not None:
+            self.h5.close()
+        if self.nc is not None:
+            self.nc.close()
+        self.open()
+        self.generation += 1
+
+    def __contains__(self, name):
+        if self.h5 is not None:
+            return name in self.h5
+        return name in self.nc.variables
+
+    def dataset(self, name):
+        if self.h5 is not None:
+            return self.h5[name]
+        var = self.nc.variables[name]
+        var.set_auto_maskandscale(False)
+        return var
+
+    def var(self, name):
+        if self.h5 is not None:
+            ds = self.h5[name]
+            # Uncompressed contiguous HDF5 data can be memory-mapped directly
+            offset = ds.id.get_offset()
+            if ds.chunks is None and ds.compression is None and \
+                    offset is not None and ds.size > 0:
+                return np.memmap(self.fname, dtype=ds.dtype, mode='r',
+                        offset=offset, shape=ds.shape)
+        return FileVar(self, name)
+
+
+class FileVar(object):
+    def __init__(self, f, name):
+        # Variable of a CubeFile that follows the file when it is reopened
+        self.f = f
+        self.name = name
+        self.generation = f.generation
+        self.ds = f.dataset(name)
+        self.dtype = self.ds.dtype
+
+    def current(self):
+        if self.generation != self.f.generation:
+            self.ds = self.f.dataset(self.name)
+            self.generation = self.f.generation
+        return self.ds
+
+    @property
+    def shape(self):
+        return self.current().shape
+
+    def __getitem__(self, key):
+        return self.current()[key]
+
+
+class LazyProfile(object):
+    def __init__(self, fname, dtype=None):
+        self.fname = fname
+        self.f = CubeFile(fname)
+        self.dat = LazyCube(self.f.var('profiles'), dtype=dtype)
+        self.nt, self.ny, self.nx, self.nw, self.ns = self.dat.shape
+        self.wav = np.asarray(self.f.var('wav')[:], dtype='float64')
+        self.weights = np.asarray(self.f.var('weights')[:], dtype='float64')
+
+
+class LazyModel(object):
+    def __init__(self, fname, dtype=None):
+        self.fname = fname
+        self.f = CubeFile(fname)
+        for key, (name, scale) in MODEL_VARS.items():
+            if name in self.f:
+                setattr(self, key, LazyCube(self.f.var(name), scale=scale,
+                    dtype=dtype))
+        self.nt, self.ny, self.nx, self.ndep = self.temp.shape
+
+
+def resample_depth(coord, grid, cubes):
+    # Linear interpolation of cubes(...,ndep) from the depth coordinate
+    # coord(...,ndep) of every pixel onto the common grid, NaN outside the
+    # range of a pixel. The bracketing depth points and weights are found
+    # once, by counting the depth points below each grid point, and applied
+    # to all cubes
+    if np.nanmean(coord[...,-1] - coord[...,0]) < 0:
+        coord = coord[...,::-1]
+        cubes = [cube[...,::-1] for cube in cubes]
+    ndep = coord.shape[-1]
+    idx = np.zeros(coord.shape[:-1] + grid.shape, dtype=np.intp)
+    for k in range(ndep):
+        idx += coord[...,k,None] <= grid
+    i0 = np.clip(idx-1, 0, ndep-2)
+    x0 = np.take_along_axis(coord, i0, axis=-1)
+    x1 = np.take_along_axis(coord, i0+1, axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        w = (grid - x0) / (x1 - x0)
+    w[(idx == 0) | (grid > coord[...,-1:])] = np.nan
+    out = []
+    for cube in cubes:
+        v0 = np.take_along_axis(cube, i0, axis=-1)
+        v1 = np.take_along_axis(cube, i0+1, axis=-1)
+        out.append(v0 + w*(v1-v0))
+    return out
+
+
+class ResampledModel(object):
+    def __init__(self, m, axis, grid, cache=None, fnames=None, dtype=None,
+            nthreads=None):
+        # Model variables interpolated per pixel onto a common grid of log
+        # tau or height (axis 'ltau' or 'z'), so that a depth index selects
+        # a true iso-tau or iso-height slice. Computed over chunks in a
+        # thread pool into the derived-product cache, one entry per grid, or
+        # memory-mapped from it
+        self.raw = m
+        self.axis = axis
+        self.grid = np.asarray(grid, dtype='float64')
+        self.tag = '{0}-{1}'.format(axis, hashlib.sha1(
+            self.grid.tobytes()).hexdigest()[:12])
+        self.nt, self.ny, self.nx = m.nt, m.ny, m.nx
+        self.ndep = self.grid.size
+        shape = (len(MODEL_IMAGES), self.nt, self.ny, self.nx, self.ndep)
+        self.stats = None
+        self.arrays = None
+        if cache is not None:
+            self.arrays = cache.load('depth-'+self.tag, fnames)
+        if self.arrays is None or self.arrays.shape != shape:
+            self.stats = dict((name, CubeStats(shape[1:])) for name in
+                    MODEL_IMAGES)
+            self.arrays = None
+            if cache is not None:
+                identity = cache.identity(fnames)
+                try:
+                    self.arrays = cache.create('depth-'+self.tag, fnames,
+                            shape, dtype or 'float64')
+                except (IOError, OSError) as err:
+                    print("ResampledModel: could not cache {0}: {1}".format(
+                        self.tag, err))
+            if self.arrays is None:
+                self.arrays = np.empty(shape, dtype=dtype or 'float64')
+            keys = list(m.temp.chunks(CHUNK_ELEMENTS//(len(MODEL_IMAGES)+1)))
+            with ThreadPoolExecutor(max_workers=nthreads or os.cpu_count() or
+                    1) as pool:
+                list(pool.map(self.fill, keys))
+            if isinstance(self.arrays, np.memmap):
+                self.arrays.flush()
+                cache.commit('depth-'+self.tag, fnames, identity)
+        for ii, name in enumerate(MODEL_IMAGES):
+            setattr(self, name, LazyCube(self.arrays[ii], dtype=dtype))
+
+    @profiled
+    def fill(self, key):
+        dats = resample_depth(getattr(self.raw, self.axis)[key], self.grid,
+                [getattr(self.raw, name)[key] for name in MODEL_IMAGES])
+        for ii, (name, dat) in enumerate(zip(MODEL_IMAGES, dats)):
+            self.arrays[ii][key] = dat
+            if self.stats is not None:
+                self.stats[name].update(key, dat)
+
+    def update(self, m, keys):
+        # Resample the blocks (tt, rows) of a reopened model file again
+        self.raw = m
+        for key in keys:
+            self.fill(key)
+
+
+def compact_array(arr, dtype):
+    # sparsetools reads whole cubes into memory; keep a single compact copy
+    if dtype is None:
+        return arr
+    return np.asarray(arr).astype(dtype, copy=False)
+
+def lazy_readable(fname):
+    # h5py only reads netCDF4 (HDF5) files; netCDF3 (classic) files need
+    # netCDF4, or are read in full through sparsetools
+    if netCDF4 is not None:
+        return True
+    return h5py is not None and h5py.is_hdf5(fname)
+
+def require_sparsetools(fname):
+    if sp is None:
+        raise SystemExit('ImportError: sparsetools (comes with STiC '
+                'distribution) or netCDF4 is required to read {0}'.format(
+                    fname))
+
+def read_profile(fname, dtype=None):
+    if lazy_readable(fname):
+        return LazyProfile(fname, dtype=dtype)
+    require_sparsetools(fname)
+    p = sp.profile(fname)
+    p.dat = LazyCube(compact_array(p.dat, dtype), dtype=dtype)
+    return p
+
+def read_model(fname, dtype=None):
+    if lazy_readable(fname):
+        return LazyModel(fname, dtype=dtype)
+    require_sparsetools(fname)
+    m = sp.model(fname)
+    for key, (name, scale) in MODEL_VARS.items():
+        if hasattr(m, key):
+            setattr(m, key, LazyCube(compact_array(getattr(m, key), dtype),
+                scale=scale, dtype=dtype))
+    return m
+
+
+def file_stamp(fnames):
+    # Sizes and modification times, to notice files being written to
+    try:
+        return tuple((st.st_size, st.st_mtime_ns) for st in map(os.stat,
+            fnames))
+    except OSError:
+        return None
+
+def watch_probe(synprof, m, tt):
+    # One value per pixel of time step tt of each file of a run: Stokes I at
+    # the first wavelength and the temperature at the bottom of the
+    # atmosphere (of the model as read, before any resampling). STiC writes
+    # whole pixels, so a changed pixel shows up in both
+    m = getattr(m, 'raw', m)
+    return np.array([synprof[tt,:,:,0,0], m.temp[tt,:,:,-1]])
+
+def row_blocks(rows, nrow):
+    # Slices of contiguous runs of the sorted indices rows, of at most nrow
+    # rows each
+    blocks = []
+    for run in np.split(rows, np.nonzero(np.diff(rows) != 1)[0]+1):
+        for y0 in range(0, run.size, nrow):
+            blocks.append(slice(int(run[y0]), int(run[min(y0+nrow,
+                run.size)-1])+1))
+    return blocks
+
+
+def share_array(arr):
+    # Copy of arr in a named shared memory block, plus what is needed to
+    # attach to it from another process
+    from multiprocessing import shared_memory
+    arr = np.ascontiguousarray(arr)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, arr.nbytes))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+    return shm, (shm.name, arr.shape, arr.dtype.str)
+
+def attach_array(spec):
+    # Attach to a block created by share_array without taking ownership: the
+    # serving process unlinks it
+    from multiprocessing import shared_memory
+    name, shape, dtype = spec
+    try:
+        shm = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+def server_key(address):
+    # Key file written next to the socket by the server, readable by its
+    # owner only unless access is granted explicitly
+    with open(address+'.key', 'rb') as f:
+        return f.read()
+
+def remove_server_files(address):
+    # Socket and key file left behind by a SliceServer that was killed; a
+    # socket that still accepts connections belongs to a running server
+    if os.path.exists(address):
+        sock = socket.socket(socket.AF_UNIX)
+        try:
+            sock.connect(address)
+        except (ConnectionRefusedError, FileNotFoundError):
+            pass
+        else:
+            raise SystemExit('Error: a server is already running on '
+                    '{0}'.format(address))
+        finally:
+            sock.close()
+    for fname in (address, address+'.key'):
+        if os.path.exists(fname):
+            os.remove(fname)
+
+
+class SliceClient(object):
+    def __init__(self, address):
+        # Connection to a SliceServer, shared by the GUI and prefetch threads
+        self.conn = Client(address, family='AF_UNIX',
+                authkey=server_key(address))
+        self.lock = threading.Lock()
+        self.shm = []
+
+    def request(self, *args):
+        with self.lock:
+            self.conn.send(args)
+            reply = self.conn.recv()
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    def attach(self, spec):
+        shm, arr = attach_array(spec)
+        self.shm.append(shm)
+        return arr
+
+
+class RemoteCube(object):
+    def __init__(self, client, cid, shape):
+        # Cube held by a SliceServer; only the requested slices are transferred
+        self.client = client
+        self.cid = cid
+        self.shape = tuple(shape)
+        self.ndim = len(self.shape)
+        self.size = int(np.prod(self.shape))
+
+    @profiled
+    def __getitem__(self, key):
+        return self.client.request('get', self.cid, key)
+
+    def chunks(self, maxsize=CHUNK_ELEMENTS):
+        return cube_chunks(self.shape, maxsize)
+
+
+class RemoteModel(object):
+    def __init__(self, client, irun, shapes):
+        for key, shape in shapes.items():
+            setattr(self, key, RemoteCube(client, ('m', irun, key), shape))
+        self.nt, self.ny, self.nx, self.ndep = self.temp.shape
+
+
+class RenderScheduler(QtCore.QObject):
+    def __init__(self, render, parent=None):
+        # Collect dirty flags from event handlers and repaint once per
+        # event-loop tick
+        super(RenderScheduler, self).__init__(parent)
+        self.render = render
+        self.dirty = 0
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(0)
+        self.timer.timeout.connect(self.flush)
+
+    def mark(self, flags):
+        self.dirty |= flags
+        if not self.timer.isActive():
+            self.timer.start()
+
+    def flush(self):
+        dirty, self.dirty = self.dirty, 0
+        if dirty:
+            self.render(dirty)
+
+
+class Player(QtCore.QObject):
+    def __init__(self, window, parent=None):
+        # Timer-driven playback along the time, wavelength or depth axis. Frames
+        # are taken from the slice cache, which is kept filled ahead of the
+        # playback position; frames that are not ready or not due are dropped
+        super(Player, self).__init__(parent)
+        self.window = window
+        self.axis = 'time'
+        self.fps = 10
+        self.timer = QTimer(self)
+        self.timer.setTimerType(QtCore.Qt.PreciseTimer)
+        self.timer.timeout.connect(self.tick)
+        self.shown = deque(maxlen=64)
+        self.dropped = 0
+
+    def isPlaying(self):
+        return self.timer.isActive()
+
+    def setFps(self, fps):
+        self.fps = max(1, fps)
+        if self.isPlaying():
+            self.start()
+
+    def start(self):
+        self.t0 = time.perf_counter()
+        self.frame0 = self.last = self.window.axisIndex(self.axis)
+        self.shown.clear()
+        self.dropped = 0
+        self.window.prefetch(self.axis, self.lookahead())
+        # Poll at twice the frame rate to keep the timing jitter small
+        self.timer.start(max(1, int(500./self.fps)))
+
+    def stop(self):
+        self.timer.stop()
+
+    def lookahead(self):
+        # About a second of frames, limited to half of the slice cache
+        nframe = self.window.axisLength(self.axis)
+        nfit = self.window.slices.maxbytes // (2*self.window.frameBytes(self.axis))
+        return range(1, max(1, min(nframe, max(2, self.fps), nfit))+1)
+
+    @profiled
+    def tick(self):
+        now = time.perf_counter()
+        target = self.frame0 + int((now-self.t0)*self.fps)
+        if target <= self.last:
+            return
+        # Newest due frame whose slices are in memory
+        for frame in range(target, self.last, -1):
+            if self.window.frameReady(self.axis, frame):
+                break
+        else:
+            return
+        self.dropped += frame - self.last - 1
+        self.last = frame
+        self.shown.append(now)
+        self.window.showFrame(self.axis, frame)
+        self.window.prefetch(self.axis, self.lookahead())
+
+    def achievedFps(self):
+        if len(self.shown) < 2 or self.shown[-1] == self.shown[0]:
+            return 0.
+        return (len(self.shown)-1) / (self.shown[-1]-self.shown[0])
 
 
 class CWImage(QWidget):
@@ -57,7 +1688,8 @@ class CWImage(QWidget):
         super(CWImage, self).__init__(parent=parent)
         self.box = canvas.addPlot(row=row, col=col)
         self.img = pg.ImageItem()
-        self.img.setLookupTable(mplcm_to_pglut(cm_name))
+        self.lut = mplcm_to_pglut(cm_name)
+        self.img.setLookupTable(self.lut)
         if xtitle is not None:
             self.box.setLabel('bottom', xtitle)
         if ytitle is not None:
@@ -68,6 +1700,11 @@ class CWImage(QWidget):
             self.box.setLimits(xMin=0, xMax=parent.nx, yMin=0, yMax=parent.ny,
                     minXRange=parent.nx/10, minYRange=parent.ny/10,
                     maxXRange=parent.nx, maxYRange=parent.ny)
+            # The image item only covers the displayed crop, so the view range
+            # is set to the full field of view rather than auto-ranged
+            self.box.vb.disableAutoRange()
+            self.box.vb.setRange(xRange=(0, parent.nx), yRange=(0, parent.ny),
+                    padding=0)
 
         # Handle crosshairs
         self.vLine = pg.InfiniteLine(pen=pg.mkPen(ch_color), angle=90, movable=False)
@@ -84,23 +1721,96 @@ class CWImage(QWidget):
         self.proxy = pg.SignalProxy(self.box.scene().sigMouseMoved, rateLimit=60,
                     slot=self.mouseMoved)
 
+        # Region of interest, shared by all images
+        self.roi = None
+
+        # Pyramid level and region (in level pixels) currently displayed
+        self.pyr = None
+        self.shown = None
+        self.box.vb.sigRangeChanged.connect(self.updateView)
+        self.box.vb.sigResized.connect(self.updateView)
+
+    @profiled
+    def setImage(self, pyr, levels=None, lut=None):
+        if not isinstance(pyr, ImagePyramid):
+            pyr = ImagePyramid(pyr)
+        self.pyr = pyr
+        # Levels of the full slice, so that contrast does not change with zoom
+        self.levels = pyr.range() if levels is None else levels
+        self.img.setLookupTable(self.lut if lut is None else lut)
+        self.shown = None
+        self.updateView()
+
+    @profiled
+    def updateView(self, *args):
+        # Show the pyramid level matching the zoom, cropped to the visible
+        # region plus a margin
+        if self.pyr is None:
+            return
+        (x0, x1), (y0, y1) = self.box.vb.viewRange()
+        width = self.box.vb.width()
+        ratio = (x1-x0)/width if width > 0 else 1.
+        level = self.pyr.level(ratio)
+        fac = 2**level
+        if self.shown is not None and self.shown[0] == level:
+            sx0, sx1, sy0, sy1 = [fac*ii for ii in self.shown[1:]]
+            if x0 >= sx0 and x1 <= sx1 and y0 >= sy0 and y1 <= sy1:
+                return
+        dat = self.pyr.levels[level]
+        mx = 0.25*(x1-x0)
+        my = 0.25*(y1-y0)
+        xa = int(np.clip(np.floor((x0-mx)/fac), 0, dat.shape[1]))
+        xb = int(np.clip(np.ceil((x1+mx)/fac), xa, dat.shape[1]))
+        ya = int(np.clip(np.floor((y0-my)/fac), 0, dat.shape[0]))
+        yb = int(np.clip(np.ceil((y1+my)/fac), ya, dat.shape[0]))
+        if xb == xa or yb == ya:
+            return
+        with PROFILER.stage('ImageItem.setImage'):
+            self.img.setImage(dat[ya:yb,xa:xb], levels=self.levels,
+                    autoLevels=False)
+        self.img.setRect(QtCore.QRectF(xa*fac, ya*fac, (xb-xa)*fac,
+            (yb-ya)*fac))
+        self.shown = (level, xa, xb, ya, yb)
+
+    def setRoi(self, kind, xc, yc, radius):
+        if self.roi is not None:
+            self.box.removeItem(self.roi)
+            self.roi = None
+        pen = pg.mkPen(self.vLine.pen.color(), width=2)
+        if kind == 'rect':
+            self.roi = pg.RectROI([xc-radius, yc-radius], [2*radius, 2*radius],
+                    pen=pen)
+        elif kind == 'poly':
+            phi = np.linspace(0., 2*np.pi, 6, endpoint=False)
+            self.roi = pg.PolyLineROI(list(zip(xc+radius*np.cos(phi),
+                yc+radius*np.sin(phi))), closed=True, pen=pen)
+        if self.roi is not None:
+            self.box.addItem(self.roi)
+            self.roi.sigRegionChanged.connect(self.roiMoved)
+
+    def roiShape(self):
+        # Region in pixel coordinates, as used by region_boxes
+        if isinstance(self.roi, pg.PolyLineROI):
+            return ('poly', [(pt.x(), pt.y()) for pt in (self.roi.mapToParent(
+                pos) for name, pos in self.roi.getLocalHandlePositions())])
+        pos, size = self.roi.pos(), self.roi.size()
+        return ('rect', pos.x(), pos.y(), size.x(), size.y())
+
+    def roiMoved(self, roi):
+        self.parent().changeRegion(self)
+
     def mouseMoved(self, event):
         pos = event[0]
         if self.box.sceneBoundingRect().contains(pos):
             mousePoint = self.box.vb.mapSceneToView(pos)
-            self.xx = np.int(np.round(mousePoint.x()))
-            self.yy = np.int(np.round(mousePoint.y()))
+            self.xx = int(np.round(mousePoint.x()))
+            self.yy = int(np.round(mousePoint.y()))
             # Ensure crosshairs within map
             self.xx = 0 if self.xx < 0 else self.nx-1 if self.xx >= self.nx else self.xx
             self.yy = 0 if self.yy < 0 else self.ny-1 if self.yy >= self.ny else self.yy
-            # Export cursor position 
-            self.parent().xx = self.xx
-            self.parent().yy = self.yy
-            # Update plots and crosshairs
-            self.parent().plotModel()
-            self.parent().plotSynth()
-            self.parent().plotObs()
-            self.parent().updateCrosshairs()
+            # Export cursor position; plots and crosshairs are only redrawn
+            # when it moves to another pixel
+            self.parent().changePixel(self.xx, self.yy)
 
 class CWPlot(QWidget):
     def __init__(self, canvas, row=0, col=0, plotwidth=200, xGrid=False,
@@ -110,6 +1820,7 @@ class CWPlot(QWidget):
         self.obsplot = self.box.plot()
         self.invplot = self.box.plot()
         self.invplot2 = self.box.plot()
+        self.cmpplot = self.box.plot()
         self.box.setFixedWidth(plotwidth)
         self.box.showGrid(x=xGrid, y=yGrid)
         if xtitle is not None:
@@ -121,6 +1832,60 @@ class CWPlot(QWidget):
             self.line = pg.InfiniteLine(pen=pg.mkPen('b'), angle=90, movable=False)
             self.box.addItem(self.line)
 
+        self.regions = {}
+
+    def setRegion(self, name, x, mean, std, color):
+        # Region mean with a band of one standard deviation either side
+        if name not in self.regions:
+            meanplot = self.box.plot(pen=pg.mkPen(color, width=2,
+                style=QtCore.Qt.DashLine))
+            lower = pg.PlotCurveItem(pen=pg.mkPen(None))
+            upper = pg.PlotCurveItem(pen=pg.mkPen(None))
+            brush = pg.mkColor(color)
+            brush.setAlpha(50)
+            band = pg.FillBetweenItem(lower, upper, brush=brush)
+            self.box.addItem(band)
+            self.regions[name] = (meanplot, lower, upper, band)
+        meanplot, lower, upper, band = self.regions[name]
+        meanplot.setData(x, mean)
+        lower.setData(x, mean-std)
+        upper.setData(x, mean+std)
+        for item in (meanplot, band):
+            item.setVisible(True)
+
+    def clearRegions(self):
+        for meanplot, lower, upper, band in self.regions.values():
+            meanplot.setVisible(False)
+            band.setVisible(False)
+
+
+class DensityPlot(QWidget):
+    def __init__(self, canvas, row=0, col=0, title=None, xtitle=None,
+            lut=None, parent=None):
+        super(DensityPlot, self).__init__(parent=parent)
+        self.box = canvas.addPlot(row=row, col=col, title=title)
+        self.image = pg.ImageItem()
+        self.image.setLookupTable(lut)
+        self.box.addItem(self.image)
+        if xtitle is not None:
+            self.box.setLabel('bottom', xtitle)
+
+    def setDensity(self, counts, x, vmin, vmax, cmax):
+        # counts (ncol,nbins) in bins from vmin to vmax, per column at x
+        # (evenly spaced), on a logarithmic scale up to cmax counts
+        if x[-1] < x[0]:
+            x, counts = x[::-1], counts[::-1]
+        dx = (x[-1]-x[0]) / max(1, len(x)-1) or 1.
+        with PROFILER.stage('ImageItem.setImage'):
+            self.image.setImage(np.log1p(counts.T), levels=(0.,
+                max(np.log1p(cmax), 1.)))
+        self.image.setRect(QtCore.QRectF(x[0]-dx/2, vmin, x[-1]-x[0]+dx,
+            (vmax-vmin) or 1.))
+        self.image.setVisible(True)
+
+    def clear(self):
+        self.image.setVisible(False)
+
 
 class Slider(QWidget):
     def __init__(self, label, vmin, vmax, step, initval, values=None, units='', intslider=False, parent=None):
@@ -157,14 +1922,14 @@ class Slider(QWidget):
         self.labelname.setText(label)
 
     def getValue(self, value):
-        self.sval = np.int(self.vmin + (float(self.slider.value()) /
+        self.sval = int(self.vmin + (float(self.slider.value()) /
             np.abs(self.slider.maximum() - self.slider.minimum())) * np.abs(self.vmax -
                 self.vmin))
         self.setLabelValue(intslider=True)
 
     def setValue(self, value):
         self.sval = value
-        slidervalue = np.int((self.sval - self.vmin) / np.abs(self.vmax - self.vmin) \
+        slidervalue = int((self.sval - self.vmin) / np.abs(self.vmax - self.vmin) \
             * np.abs(self.slider.maximum() - self.slider.minimum()))
         self.slider.setValue(slidervalue)
         self.setLabelValue(intslider=True)
@@ -192,16 +1957,544 @@ class Slider(QWidget):
             self.labelvalue.setText("{0}".format(self.sval))
 
 
-class Window(QMainWindow):
-    def __init__(self):
+class Run(object):
+    def __init__(self, data):
+        # Snapshot of the per-run attributes of a CubeData instance
+        for name in RUN_ATTRS:
+            setattr(self, name, getattr(data, name, None))
+
+
+class CubeData(object):
+    # Loading of the input cubes and derived products, shared by the viewer
+    # window and the headless batch renderer. With dtype set (--compact),
+    # slices and derived maps are held in that precision. Several runs
+    # (fname_runs: synthetic and model file pairs) can be loaded against the
+    # same observations; the attributes of the active run are swapped in by
+    # selectRun. With progressive set, model ranges not in the cache are
+    # completed in the background, after the time step on display
+    dtype = None
+    fname_runs = None
+    depthgrid = None
+    progressive = False
+
+    @profiled
+    def loadData(self):
+        self.initObs()
+        self.loadStage('initObs')
+        self.cog0 = {}
+        self.runs = []
+        for fname_synth, fname_atmos in self.fname_runs or \
+                [(self.fname_synth, self.fname_atmos)]:
+            self.fname_synth = fname_synth
+            self.fname_atmos = fname_atmos
+            self.initModel()
+            self.initSynth()
+            if self.runs and (self.nt, self.ny, self.nx, self.ndep) != \
+                    self.runs[0].dims:
+                raise SystemExit('Error: {0} does not match the dimensions '
+                        'of {1}'.format(self.fname_atmos,
+                            self.runs[0].fname_atmos))
+            self.dims = (self.nt, self.ny, self.nx, self.ndep)
+            self.runs.append(Run(self))
+        self.loadStage('initRuns')
+        self.irun = 0
+        self.jrun = None
+        self.getChi2()
+        self.loadStage('getChi2')
+        self.selectRun(0)
+        self.loadStage('vminmaxImage')
+
+    @profiled
+    def loadRemote(self, address):
+        # State and derived products from a SliceServer; the cubes stay with
+        # the server and chi2 is mapped from its shared memory
+        self.client = SliceClient(address)
+        state = self.client.request('state')
+        for name in ('fname_obs', 'depthaxis', 'wsel', 'wav', 'plot_iwav',
+                'plot_wav'):
+            setattr(self, name, state[name])
+        self.obsprof = RemoteCube(self.client, 'obs', state['obsshape'])
+        self.cog0 = {}
+        self.stats_obs = CubeStats.fromArray(state['stats_obs'])
+        self.runs = []
+        for irun, runstate in enumerate(state['runs']):
+            run = Run(self)
+            for name in RUN_ATTRS:
+                setattr(run, name, runstate.get(name))
+            run.m = RemoteModel(self.client, irun, runstate['mshapes'])
+            run.synprof = RemoteCube(self.client, ('syn', irun),
+                    runstate['synshape'])
+            run.chi2 = self.client.attach(runstate['chi2'])
+            run.chi2_stokes = self.client.attach(runstate['chi2_stokes'])
+            run.stats_syn = CubeStats.fromArray(runstate['stats_syn'])
+            run.lutcache = LUTCache.fromArrays(runstate['luts'])
+            self.runs.append(run)
+        self.nt, self.ny, self.nx, self.ndep = self.runs[0].dims
+        self.nw = self.wsel.size
+        self.itau = -1
+        self.tt = 0
+        self.xx = self.nx//2
+        self.yy = self.ny//2
+        self.ww = 0
+        self.istokes = 0
+        self.chi2engine = None
+        self.chi2runs = []
+        self.irun = 0
+        self.jrun = None
+        self.selectRun(0)
+        self.loadStage('loadRemote')
+        print("loadRemote: {0} run(s) with dimensions (nx,ny)=({1},{2}) from "
+                "{3}".format(len(self.runs), self.nx, self.ny, address))
+
+    def loadStage(self, name):
+        STARTUP.mark(name)
+
+    def selectRun(self, irun):
+        self.irun = irun
+        for name in RUN_ATTRS:
+            setattr(self, name, getattr(self.runs[irun], name))
+        self.vminmaxImage()
+
+    def runLabel(self, irun):
+        return '{0}: {1}'.format(irun+1, os.path.basename(
+            self.runs[irun].fname_synth))
+
+    @profiled
+    def initModel(self):
+        self.m = read_model(self.fname_atmos, dtype=self.dtype)
+        self.nx = self.m.nx
+        self.ny = self.m.ny
+        self.itau = -1
+        self.tt = 0
+        self.xx = self.nx//2
+        self.yy = self.ny//2
+        self.nt = self.m.nt
+        self.ltaus = self.m.ltau[0,self.ny//2,self.nx//2,:]
+        self.ndep = self.m.ndep
+        self.depthaxis = 'ltau'
+        if self.depthgrid is not None:
+            self.resampleModel()
+        else:
+            self.mstats = self.modelStats('mstats')
+        self.modelRanges(self)
+        print("initModel: Model has dimensions (nx,ny)=({0},{1})".format(self.nx,
+            self.ny))
+
+    def modelStats(self, cname):
+        names = MODEL_IMAGES
+        fnames = (self.fname_atmos,)
+        cached = self.loadCache(cname, fnames)
+        if cached is not None:
+            return dict((name, CubeStats.fromArray(cached[ii])) for ii, name
+                    in enumerate(names))
+        cubes = dict((name, getattr(self.m, name)) for name in names)
+        if not self.progressive:
+            mstats = cube_stats(cubes)
+            self.saveCache(cname, fnames, [mstats[name].toArray() for name in
+                names])
+            return mstats
+        # Time step on display first, the others in a background thread
+        tt0 = self.tt
+        mstats = cube_stats(cubes, times=(tt0,))
+        def finish():
+            cube_stats(cubes, stats=mstats, times=set(range(self.nt)) -
+                    set([tt0]))
+            self.saveCache(cname, fnames, [mstats[name].toArray() for name in
+                names])
+            self.statsDone(mstats)
+        self.statsjobs = getattr(self, 'statsjobs', 0) + 1
+        threading.Thread(target=finish, daemon=True).start()
+        return mstats
+
+    def statsDone(self, mstats):
+        # Called from a worker thread when the model ranges mstats are
+        # complete
+        pass
+
+    @profiled
+    def resampleModel(self):
+        # Model on the common depth grid of --depth-grid, by default spanning
+        # the depth range of the centre pixel with the same number of points
+        axis, grid = self.depthgrid
+        if not hasattr(self.m, axis):
+            raise SystemExit('Error: {0} has no {1} variable to resample the '
+                    'model on'.format(self.fname_atmos, MODEL_VARS[axis][0]))
+        if grid is None:
+            centre = getattr(self.m, axis)[0,self.ny//2,self.nx//2,:]
+            grid = np.linspace(centre[0], centre[-1], self.ndep)
+        self.m = ResampledModel(self.m, axis, grid, cache=self.cache,
+                fnames=(self.fname_atmos,), dtype=self.dtype)
+        self.ltaus = self.m.grid
+        self.ndep = self.m.ndep
+        self.depthaxis = axis
+        cname = 'mstats-' + self.m.tag
+        if self.m.stats is not None:
+            self.mstats = self.m.stats
+            self.saveCache(cname, (self.fname_atmos,), [self.mstats[
+                name].toArray() for name in MODEL_IMAGES])
+        else:
+            self.mstats = self.modelStats(cname)
+
+    def modelRanges(self, run):
+        # Velocity and field ranges and colour tables of run (this instance
+        # or a Run) from its model statistics
+        run.minmax_vlos = run.mstats['vlos'].minmax()
+        run.minmax_vlos_all = run.mstats['vlos'].minmaxAll()
+        run.absmax_vlos = run.mstats['vlos'].absmax()
+        run.lutcache = LUTCache()
+        run.lutcache.build('bwr', run.absmax_vlos, run.minmax_vlos)
+
+        run.minmax_Bln = run.mstats['Bln'].minmax()
+        run.minmax_Bln_all = run.mstats['Bln'].minmaxAll()
+        run.absmax_Bln = run.mstats['Bln'].absmax()
+        run.lutcache.build('RdGy_r', run.absmax_Bln, run.minmax_Bln)
+
+    @profiled
+    def initSynth(self):
+        self.s = read_profile(self.fname_synth, dtype=self.dtype)
+        self.synprof = self.s.dat.take(self.wsel)
+        self.nw = self.wsel.size
+        self.ww = 0
+        self.istokes = 0
+
+    @profiled
+    def initObs(self):
+        self.o = read_profile(self.fname_obs, dtype=self.dtype)
+        self.wsel = self.loadCache('wsel', (self.fname_obs,))
+        if self.wsel is None:
+            self.wsel = np.where(self.o.dat[0,self.o.ny//2,self.o.nx//2,:,0] > 0)[0]
+            self.saveCache('wsel', (self.fname_obs,), self.wsel)
+        self.wsel = np.asarray(self.wsel)
+        self.wav = self.o.wav[self.wsel]
+        self.plot_iwav = np.diff(self.wav).max() > 50.
+        if self.plot_iwav:
+            self.plot_wav = np.arange(self.wsel.size)
+        else:
+            self.plot_wav = self.wav
+        self.obsprof = self.o.dat.take(self.wsel)
+
+    def loadCache(self, name, fnames):
+        if self.cache is not None:
+            return self.cache.load(name, fnames)
+
+    def saveCache(self, name, fnames, arr):
+        if self.cache is not None:
+            self.cache.save(name, fnames, arr)
+
+    @profiled
+    def getChi2(self):
+        # Cached results where available, the other runs in a single pass
+        # over the observations
+        self.chi2runs = []
+        for run in self.runs:
+            fnames = (self.fname_obs, run.fname_synth)
+            cached = [self.loadCache(name, fnames) for name in ('chi2_stokes',
+                'chi2', 'stats_obs', 'stats_syn')]
+            if all(arr is not None for arr in cached):
+                run.chi2_stokes, run.chi2 = cached[:2]
+                self.stats_obs = CubeStats.fromArray(cached[2])
+                run.stats_syn = CubeStats.fromArray(cached[3])
+            else:
+                self.chi2runs.append(run)
+        self.chi2engine = None
+        if not self.chi2runs:
+            return
+
+        self.chi2engine = Chi2Engine(self.obsprof, [run.synprof for run in
+            self.chi2runs], self.o.weights[self.wsel,:],
+            dtype=self.dtype or 'float64')
+        for ii, run in enumerate(self.chi2runs):
+            run.chi2_stokes = self.chi2engine.chi2_stokes[ii]
+            run.chi2 = self.chi2engine.chi2[ii]
+            run.stats_syn = self.chi2engine.stats_syn[ii]
+        self.stats_obs = self.chi2engine.stats_obs
+        self.chi2final = False
+        # Time step on display first, the others in the background
+        self.chi2engine.computeTime(self.tt)
+        if self.chi2engine.done.all():
+            self.chi2final = True
+            self.saveChi2()
+        else:
+            self.chi2engine.start(callback=self.chi2Done)
+
+    def chi2Done(self, tt):
+        # Called from a worker thread when time step tt of chi2 is complete
+        pass
+
+    def saveChi2(self):
+        for run in self.chi2runs:
+            fnames = (self.fname_obs, run.fname_synth)
+            self.saveCache('chi2_stokes', fnames, run.chi2_stokes)
+            self.saveCache('chi2', fnames, run.chi2)
+            self.saveCache('stats_obs', fnames, self.stats_obs.toArray())
+            self.saveCache('stats_syn', fnames, run.stats_syn.toArray())
+
+    def initWatch(self):
+        for run in self.runs:
+            self.probeRun(run)
+
+    def probeRun(self, run):
+        # Probes of all time steps to compare reloads against
+        run.stamp = file_stamp((run.fname_synth, run.fname_atmos))
+        run.probe = [watch_probe(run.synprof, run.m, tt) for tt in
+                range(self.nt)]
+        run.front = 0
+
+    @profiled
+    def reloadRun(self, irun):
+        # Incremental reload of a run whose files are still being written:
+        # the files are reopened, and only the rows of pixels that differ in
+        # the probe are read again, to update chi2, the image ranges (which
+        # can only widen) and the model statistics. Returns the keys (tt,
+        # rows) of the updated blocks
+        run = self.runs[irun]
+        fnames = (run.fname_synth, run.fname_atmos)
+        stamp = file_stamp(fnames)
+        if getattr(run, 'probe', None) is None:
+            self.probeRun(run)
+            return []
+        if stamp is None or stamp == run.stamp:
+            return []
+        if self.cache is not None:
+            # Taken before reading, so that nothing read later is cached
+            # under an identity older than its content
+            for fname in fnames:
+                self.cache.identities[fname] = file_identity(fname)
+        s, m = run.s, getattr(run.m, 'raw', run.m)
+        if isinstance(s, LazyProfile) and isinstance(m, LazyModel):
+            # Reopened in place, so that the cubes of the run held elsewhere
+            # read the new content as well
+            with READ_LOCK:
+                s.f.reopen()
+                m.f.reopen()
+            synprof = run.synprof
+            resized = s.dat.var.shape != s.dat.shape or \
+                    m.temp.var.shape != m.temp.shape
+        else:
+            m = read_model(run.fname_atmos, dtype=self.dtype)
+            s = read_profile(run.fname_synth, dtype=self.dtype)
+            synprof = s.dat.take(self.wsel)
+            resized = synprof.shape != run.synprof.shape or \
+                    m.temp.shape != getattr(run.m, 'raw', run.m).temp.shape
+        if resized:
+            print("reloadRun: dimensions of {0} changed, not reloaded".format(
+                run.fname_synth))
+            return []
+        # Probing reads the chunks of a whole time step of both files, so
+        # only the time steps from the first that changed on the last reload
+        # are probed, up to the first unchanged one after a change: STiC
+        # fills the files in order of time step. If none of those changed,
+        # the remaining time steps are probed as well, which costs as much as
+        # reading the files in full. The time steps not probed are left to
+        # the next poll, which reads the files again even if they have not
+        # changed since
+        probe = list(run.probe)
+        changed = {}
+        complete = True
+        for tt in list(range(run.front, self.nt)) + list(range(run.front)):
+            if changed and (tt < run.front or tt-1 not in changed):
+                complete = False
+                break
+            probe[tt] = watch_probe(synprof, m, tt)
+            with np.errstate(invalid='ignore'):
+                diff = ((probe[tt] != run.probe[tt]) & ~(np.isnan(probe[tt]) &
+                    np.isnan(run.probe[tt]))).any(axis=0)
+            if diff.any():
+                changed[tt] = diff
+        nrow = max(1, CHUNK_ELEMENTS // max(1, synprof.size //
+            (self.nt*self.ny)))
+        keys = []
+        for tt in sorted(changed):
+            rows = np.nonzero(changed[tt].any(axis=1))[0]
+            keys += [(tt, rows) for rows in row_blocks(rows, nrow)]
+        if isinstance(run.m, ResampledModel):
+            run.m.update(m, keys)
+            m = run.m
+        run.probe = probe
+        if complete:
+            run.stamp = stamp
+        if changed:
+            run.front = min(changed)
+        run.m, run.s, run.synprof = m, s, synprof
+        iwts2 = (1. / self.o.weights[self.wsel,:]**2).astype(
+                run.chi2_stokes.dtype)
+        for key in keys:
+            syn = synprof[key]
+            run.stats_syn.update(key, syn)
+            run.chi2_stokes[key] = chi2_chunk(self.obsprof[key], syn, iwts2)
+            run.chi2[key] = run.chi2_stokes[key].sum(axis=-1) / \
+                    run.chi2_stokes.shape[-1]
+            for name in MODEL_IMAGES:
+                run.mstats[name].update(key, getattr(m, name)[key])
+        self.modelRanges(run)
+        return keys
+
+    @profiled
+    def vminmaxImage(self):
+        # Ranges are collected by the chi2 engine; until it has finished they
+        # cover only the time steps done so far
+        min_syn, max_syn = self.stats_syn.minmax()
+        min_obs, max_obs = self.stats_obs.minmax()
+        self.vminmax = []
+        for ii in range(4):
+            self.vminmax.append((np.minimum(min_syn[ii], min_obs[ii]),
+                np.maximum(max_syn[ii], max_obs[ii])))
+
+    def modelSlice(self, name, tt, itau, jrun=None):
+        # Slice of the active run, or its difference with run jrun
+        itau %= self.ndep
+        cube = getattr(self.m, name)
+        if jrun is None:
+            return (self.irun, name, tt, itau), lambda: ImagePyramid(
+                    cube[tt,:,:,itau])
+        other = getattr(self.runs[jrun].m, name)
+        return (self.irun, jrun, name, tt, itau), lambda: ImagePyramid(
+                cube[tt,:,:,itau] - other[tt,:,:,itau])
+
+    def profSlice(self, name, tt, ww, istokes, jrun=None):
+        if name == 'obs':
+            return (name, tt, ww, istokes), lambda: ImagePyramid(
+                    self.obsprof[tt,:,:,ww,istokes])
+        cube = self.synprof
+        if jrun is None:
+            return (self.irun, name, tt, ww, istokes), lambda: ImagePyramid(
+                    cube[tt,:,:,ww,istokes])
+        other = self.runs[jrun].synprof
+        return (self.irun, jrun, name, tt, ww, istokes), lambda: ImagePyramid(
+                cube[tt,:,:,ww,istokes] - other[tt,:,:,ww,istokes])
+
+    def chi2Slice(self, tt, jrun=None):
+        # chi2 of the active run, or its difference with run jrun
+        chi2 = self.chi2
+        if jrun is None:
+            return (self.irun, 'chi2', tt), lambda: ImagePyramid(
+                    chi2[tt,:,:])
+        other = self.runs[jrun].chi2
+        return (self.irun, jrun, 'chi2', tt), lambda: ImagePyramid(
+                chi2[tt,:,:] - other[tt,:,:])
+
+    def chi2Complete(self, tt):
+        # chi2 of time step tt is final, so that slices of it can be cached
+        return self.chi2engine is None or bool(self.chi2engine.done[tt])
+
+    def mapSlice(self, kind, tt):
+        # Derived maps of the observed ('obs') or the active synthetic ('syn')
+        # cube. Velocities are relative to the mean observed centre of gravity
+        # of the time step, for both
+        if kind == 'obs':
+            return ('maps', kind, tt), lambda: MapSet(self.derivedMaps(
+                self.obsprof, (self.fname_obs,), tt))
+        cube, fnames = self.synprof, (self.fname_obs, self.fname_synth)
+        return ('maps', self.irun, tt), lambda: MapSet(self.derivedMaps(
+            cube, fnames, tt))
+
+    def rawMaps(self, cube, fnames, tt):
+        name = 'maps{0}'.format(tt)
+        maps = self.loadCache(name, fnames)
+        if maps is None:
+            maps = compute_maps(cube, self.wav, tt,
+                    dtype=self.dtype or 'float64')
+            self.saveCache(name, fnames, maps)
+        maps = np.array(maps)
+        if cube is self.obsprof:
+            self.cog0[tt] = np.nanmean(maps[1])
+        return maps
+
+    @profiled
+    def derivedMaps(self, cube, fnames, tt):
+        maps = self.rawMaps(cube, fnames, tt)
+        if tt not in self.cog0:
+            self.rawMaps(self.obsprof, (self.fname_obs,), tt)
+        maps[1] = CLIGHT * (maps[1]-self.cog0[tt]) / self.cog0[tt]
+        return maps
+
+    def binCubes(self, name):
+        # The observed ('obs') and synthetic ('syn') profiles of the active run
+        # are binned together ('prof')
+        if name == 'prof':
+            return [self.obsprof, self.synprof]
+        return [getattr(self.m, name)]
+
+    def levelSlice(self, name, tt):
+        # Levels of the region density plots of a time step, from a grid of
+        # pixels over all of it, so that they do not change as the region
+        # moves. Common to the observed and synthetic profiles per Stokes
+        # parameter
+        cubes = self.binCubes(name)
+        def load():
+            samples = [step_sample(cube, tt) for cube in cubes]
+            if name != 'prof':
+                return np.array(sample_levels(samples[0]))
+            levels = np.array([[sample_levels(sample[...,ii]) for sample in
+                samples] for ii in range(samples[0].shape[-1])])
+            return np.array([levels[:,:,0].min(axis=1)[:,None],
+                levels[:,:,1].max(axis=1)[:,None]])
+        return ('levels', self.irun, name, tt), load
+
+    def binSlice(self, name, tt, levels):
+        # Value bins of a whole time step on levels from levelSlice, for the
+        # region density plots
+        cubes = self.binCubes(name)
+        return ('bins', self.irun, name, tt), lambda: BinnedCube(cubes, tt,
+                levels[0], levels[1])
+
+    def rankSlice(self, stokes, tt, k):
+        # Ranking of the worst fits of a time step, by total chi2 (stokes
+        # None) or by that of one Stokes parameter
+        chi2 = self.chi2 if stokes is None else self.chi2_stokes
+        if stokes is None:
+            return ('worst', self.irun, stokes, k, tt), lambda: FitRanking(
+                    chi2[tt], k)
+        return ('worst', self.irun, stokes, k, tt), lambda: FitRanking(
+                chi2[tt,:,:,stokes], k)
+
+    def areaCube(self, name):
+        cube = {'obs': self.obsprof, 'syn': self.synprof,
+                'chi2': self.chi2}.get(name)
+        return getattr(self.m, name) if cube is None else cube
+
+    def areaSlice(self, name, tt, tmpdir=None):
+        # Summed-area tables of a whole time step, for region statistics
+        cube = self.areaCube(name)
+        load = lambda: SummedArea(cube, tt, tmpdir=tmpdir)
+        if name == 'obs':
+            return ('area', name, tt), load
+        return ('area', self.irun, name, tt), load
+
+
+class Window(CubeData, QMainWindow):
+    chi2Ready = QtCore.pyqtSignal(int)
+    watchReady = QtCore.pyqtSignal(int, object)
+    statsReady = QtCore.pyqtSignal(object)
+    sliceBuilt = QtCore.pyqtSignal(object)
+    loadProgress = QtCore.pyqtSignal(str)
+    loadDone = QtCore.pyqtSignal(str)
+    progressive = True
+
+    def __init__(self, args=None):
         super(Window, self).__init__()
 
         pg.setConfigOptions(imageAxisOrder='row-major')
+        if args is None:
+            args = parse_args()
+        PROFILER.enabled = args.profile
+        self.dtype = 'float32' if args.compact else None
+        self.cache = None if args.no_cache or args.server else \
+                DerivedCache(self.dtype)
+        self.depthgrid = args.depth_grid
+        if args.watch is not None:
+            # HDF5 locks the files it opens, which would keep the running
+            # inversion from writing to them
+            CubeFile.locking = False
+            os.environ.setdefault('HDF5_USE_FILE_LOCKING', 'FALSE')
 
         # ---- get input ----
         self.cwd = os.getcwd()
-        if len(sys.argv) == 4:
-            self.fname_obs, self.fname_synth, self.fname_atmos = sys.argv[1:]
+        if args.server is not None:
+            pass
+        elif len(args.files) >= 3 and len(args.files) % 2 == 1:
+            self.fname_obs = args.files[0]
+            self.fname_runs = list(zip(args.files[1::2], args.files[2::2]))
         else:
             self.filetypes = {\
                  'atm': {'name': 'atmosout', 'fullname': 'atmosphere model',
@@ -215,43 +2508,162 @@ class Window(QMainWindow):
             self.fname_atmos = self.getFileName(typedict=self.filetypes['atm'])
 
         # ---- initialise input ----
-        self.initObs()
-        self.initModel()
-        self.initSynth()
-        self.getChi2()
-        self.vminmaxImage()
+        # Read in a worker thread while the window shows the progress; the
+        # panels are set up once the time step on display is available
+        self.args = args
+        self.ready = False
+        self.loaderror = None
+        self.loadcancelled = False
+        self.statsfinished = []
+        self.showLoading()
+        qApp.aboutToQuit.connect(self.quitLoading)
+        self.loadProgress.connect(self.loadlabel.setText)
+        self.loadDone.connect(self.finishInit)
+        threading.Thread(target=self.loadInput, daemon=True).start()
+
+    def showLoading(self):
+        self.setGeometry(0, 0, 1400, 1000)
+        self.setWindowTitle('STiC Viewer')
+        layout = QVBoxLayout()
+        layout.addStretch()
+        files = [self.args.server] if self.args.server is not None else \
+                [self.fname_obs] + [fname for pair in self.fname_runs or
+                        [(self.fname_synth, self.fname_atmos)] for fname in pair]
+        label = QLabel('Loading {0}'.format(', '.join(os.path.basename(fname)
+            for fname in files)))
+        label.setAlignment(QtCore.Qt.AlignCenter)
+        layout.addWidget(label)
+        bar = QProgressBar()
+        bar.setRange(0, 0)
+        bar.setFixedWidth(400)
+        layout.addWidget(bar, alignment=QtCore.Qt.AlignCenter)
+        self.loadlabel = QLabel('Opening files')
+        self.loadlabel.setAlignment(QtCore.Qt.AlignCenter)
+        layout.addWidget(self.loadlabel)
+        button = QPushButton('Cancel')
+        button.clicked.connect(self.cancelLoad)
+        layout.addWidget(button, alignment=QtCore.Qt.AlignCenter)
+        layout.addStretch()
+        widget = QWidget()
+        widget.setLayout(layout)
+        self.setCentralWidget(widget)
+        self.show()
+
+    def loadInput(self):
+        # Runs in the loader thread; errors are reported by finishInit
+        try:
+            if self.args.server is not None:
+                self.loadRemote(self.args.server)
+            else:
+                self.loadData()
+        except (Exception, SystemExit) as err:
+            self.loadDone.emit(str(err) or err.__class__.__name__)
+            return
+        self.loadDone.emit('')
+
+    def loadStage(self, name):
+        # Reads and reductions in the loader thread cannot be interrupted, so
+        # a cancelled load stops at the end of the stage
+        super(Window, self).loadStage(name)
+        if self.loadcancelled:
+            if getattr(self, 'chi2engine', None) is not None:
+                self.chi2engine.cancel()
+            raise SystemExit('Window: loading cancelled')
+        self.loadProgress.emit(LOAD_MESSAGES[name])
+
+    def quitLoading(self):
+        if not self.ready and self.loaderror is None:
+            self.cancelLoad()
+
+    def cancelLoad(self):
+        # The loader thread stops at the end of its stage and reports back to
+        # finishInit, which quits; cache entries are only ever written
+        # complete
+        if self.loadcancelled:
+            return
+        self.loadcancelled = True
+        self.loadlabel.setText('Cancelling')
+        if getattr(self, 'chi2engine', None) is not None:
+            self.chi2engine.cancel()
+
+    def finishInit(self, error):
+        if error:
+            print(error)
+            self.loaderror = error
+            qApp.exit(1)
+            return
+        args = self.args
+        self.pixelkey = None
+        self.pixelcaches = None
+        if args.pixel_cache and self.cache is not None:
+            self.pixelcaches = self.openPixelCaches()
+            for cache in self.pixelcaches.values():
+                qApp.aboutToQuit.connect(cache.cancel)
 
         # ---- initialise UI ----
         self.initUI()
+        STARTUP.mark('initUI')
+        self.scheduler = RenderScheduler(self.render, parent=self)
+        self.slices = SliceCache()
+        qApp.aboutToQuit.connect(self.slices.shutdown)
+        self.diskslices = SliceCache(AREA_DISK_BYTES)
+        qApp.aboutToQuit.connect(self.diskslices.shutdown)
+        self.buildpool = ThreadPoolExecutor(max_workers=1)
+        self.buildjobs = {}
+        self.sliceBuilt.connect(self.sliceDone)
+        qApp.aboutToQuit.connect(functools.partial(self.buildpool.shutdown,
+            wait=False, cancel_futures=True))
+        if args.profile_trace is not None:
+            qApp.aboutToQuit.connect(functools.partial(PROFILER.export,
+                args.profile_trace))
+        self.chi2Ready.connect(self.updateChi2)
+        self.statsReady.connect(self.updateStats)
+        if self.chi2engine is not None:
+            qApp.aboutToQuit.connect(self.chi2engine.cancel)
+            if self.chi2engine.finished():
+                # Finished before the signal was connected
+                failed = np.nonzero(self.chi2engine.failed)[0]
+                self.updateChi2(int(failed[0]) if failed.size else self.tt)
+        for mstats in list(self.statsfinished):
+            self.updateStats(mstats)
+        if args.watch is not None:
+            if args.server is not None:
+                print("Window: --watch is ignored with --server")
+            else:
+                self.startWatch(args.watch)
 
         # ---- initial draw ----
-        self.drawModel()
-        self.drawSynth()
-        self.drawObs()
-        self.plotModel()
-        self.plotObs()
-        self.plotSynth()
+        self.render(DIRTY_ALL)
+        STARTUP.mark('render')
+        self.ready = True
+        self.updateProgress()
+        QTimer.singleShot(0, self.firstPaint)
 
+    def firstPaint(self):
+        # Called once the event loop has painted the window
+        STARTUP.mark('paint')
+        STARTUP.report()
 
-    def initUI(self):
-        # ----- initialise window ----
-        self.setGeometry(0, 0, 1400, 1000)
-        self.setWindowTitle('STiC Viewer')
 
+    def initUI(self):
         # ---- set up control panel ----
         cpanel_layout = QVBoxLayout()
 
-        self.zslider = Slider('Optical depth [index: log('+u"τ"+')]', 0,
-                self.ndep-1, 1, self.ndep-1, values=self.ltaus, intslider=True)
-        self.zslider.slider.valueChanged.connect(self.updateDepth)
+        self.zslider = Slider('{0} [index: {1}]'.format(*DEPTH_AXES[
+            self.depthaxis][:2]), 0, self.ndep-1, 1, self.ndep-1,
+            values=self.ltaus, intslider=True)
+        self.zslider.slider.valueChanged.connect(lambda value:
+                self.updateDepth())
         self.tslider = Slider('Time [index]', 0, self.nt-1, 1, 0, intslider=True)
         if self.nt == 1:
             self.tslider.setDisabled(True)
-        self.tslider.slider.valueChanged.connect(self.updateTime)
+        self.tslider.slider.valueChanged.connect(lambda value:
+                self.updateTime())
 
         self.wslider = Slider('Wavelength [index: value]', 0, self.nw-1, 1, 0,
                 values=self.wav, units=u'Å', intslider=True)
-        self.wslider.slider.valueChanged.connect(self.updateWave)
+        self.wslider.slider.valueChanged.connect(lambda value:
+                self.updateWave())
 
         # Stokes button group
         self.labels_stokes = 'IQUV'
@@ -266,14 +2678,127 @@ class Window(QMainWindow):
             if ii == 0: button.setChecked(True)
             self.bgroup_stokes.addButton(button, ii)
             layout.addWidget(button)
-            button.clicked.connect(self.updateStokes)
+            button.clicked.connect(lambda checked: self.updateStokes())
         self.bgroup.setLayout(layout)
 
+        # Derived maps, shown in extra panels below the image grid
+        self.mapname = None
+        self.mapimages = []
+        self.mapbox = QComboBox()
+        self.mapbox.addItem('Derived maps: none')
+        for name in DERIVED_MAPS:
+            self.mapbox.addItem('Derived maps: '+DERIVED_TITLES[name])
+        if self.plot_iwav:
+            # A centre of gravity over several lines, far apart, means nothing
+            item = self.mapbox.model().item(DERIVED_MAPS.index('cog')+1)
+            item.setEnabled(False)
+            item.setToolTip('Not available for observations of several lines')
+        self.mapbox.currentIndexChanged.connect(self.changeMap)
+
+        # Playback controls
+        self.player = Player(self, parent=self)
+        self.pgroup = QGroupBox('Playback')
+        layout = QVBoxLayout()
+        self.playbutton = QPushButton('Play')
+        self.playbutton.clicked.connect(self.togglePlay)
+        layout.addWidget(self.playbutton)
+        axislayout = QHBoxLayout()
+        self.bgroup_axis = QButtonGroup()
+        self.labels_axis = ['time', 'wave', 'depth']
+        for ii, label in enumerate(['Time', 'Wavelength', 'Depth']):
+            button = QRadioButton(label)
+            if ii == 0: button.setChecked(True)
+            self.bgroup_axis.addButton(button, ii)
+            axislayout.addWidget(button)
+            button.clicked.connect(self.updatePlayAxis)
+        layout.addLayout(axislayout)
+        self.fpsslider = Slider('Frame rate [fps]', 1, 30, 1, self.player.fps,
+                intslider=True)
+        self.fpsslider.slider.valueChanged.connect(self.updateFps)
+        layout.addWidget(self.fpsslider)
+        self.fpslabel = QLabel('Achieved: - fps')
+        layout.addWidget(self.fpslabel)
+        self.pgroup.setLayout(layout)
+
+        # Region of interest controls
+        self.region = None
+        self.region_chi2 = None
+        self.rgroup = QGroupBox('Region')
+        layout = QHBoxLayout()
+        self.bgroup_region = QButtonGroup()
+        self.labels_region = [None, 'rect', 'poly']
+        for ii, label in enumerate(['Off', 'Rectangle', 'Polygon']):
+            button = QRadioButton(label)
+            if ii == 0: button.setChecked(True)
+            self.bgroup_region.addButton(button, ii)
+            layout.addWidget(button)
+            button.clicked.connect(self.updateRegionMode)
+        self.densitybox = QCheckBox('Density')
+        self.densitybox.setToolTip('Show all profiles in the region as '
+                'density histograms')
+        self.densitybox.toggled.connect(self.toggleDensity)
+        layout.addWidget(self.densitybox)
+        self.rgroup.setLayout(layout)
+
+        # Navigation through the worst fits of the time step
+        self.worstk = WORST_FITS
+        self.worstkey = None
+        self.worstpos = -1
+        self.wfgroup = QGroupBox('Worst fits')
+        layout = QGridLayout()
+        self.rankbox = QComboBox()
+        self.rankbox.addItems(['Total chi2'] + ['chi2 of Stokes '+stokes for
+            stokes in self.labels_stokes])
+        layout.addWidget(self.rankbox, 0, 0, 1, 2)
+        layout.addWidget(QLabel('chi2 at least'), 1, 0)
+        self.rankmin = QDoubleSpinBox()
+        self.rankmin.setRange(0., 1.e9)
+        self.rankmin.setDecimals(2)
+        self.rankmin.setSpecialValueText('any')
+        layout.addWidget(self.rankmin, 1, 1)
+        self.rankregion = QCheckBox('Within region only')
+        layout.addWidget(self.rankregion, 2, 0, 1, 2)
+        button = QPushButton('Previous')
+        button.clicked.connect(self.prevWorst)
+        layout.addWidget(button, 3, 0)
+        button = QPushButton('Next')
+        button.clicked.connect(self.nextWorst)
+        layout.addWidget(button, 3, 1)
+        self.worstlabel = QLabel('-')
+        layout.addWidget(self.worstlabel, 4, 0, 1, 2)
+        self.wfgroup.setLayout(layout)
+
+        # Run selection and comparison, with several synthetic/model pairs
+        self.showdiff = False
+        self.cgroup = QGroupBox('Runs')
+        layout = QVBoxLayout()
+        self.runbox = QComboBox()
+        self.cmpbox = QComboBox()
+        self.cmpbox.addItem('Compare with: none')
+        for irun in range(len(self.runs)):
+            self.runbox.addItem(self.runLabel(irun))
+            self.cmpbox.addItem('Compare with '+self.runLabel(irun))
+        self.runbox.currentIndexChanged.connect(self.changeRun)
+        self.cmpbox.currentIndexChanged.connect(self.changeCompareRun)
+        self.diffbox = QCheckBox('Show difference in images')
+        self.diffbox.setEnabled(False)
+        self.diffbox.toggled.connect(self.toggleDiff)
+        layout.addWidget(self.runbox)
+        layout.addWidget(self.cmpbox)
+        layout.addWidget(self.diffbox)
+        self.cgroup.setLayout(layout)
+        self.cgroup.setVisible(len(self.runs) > 1)
+
         # Add widgets to control panel
         cpanel_layout.addWidget(self.zslider)
         cpanel_layout.addWidget(self.tslider)
         cpanel_layout.addWidget(self.wslider)
         cpanel_layout.addWidget(self.bgroup)
+        cpanel_layout.addWidget(self.mapbox)
+        cpanel_layout.addWidget(self.pgroup)
+        cpanel_layout.addWidget(self.rgroup)
+        cpanel_layout.addWidget(self.wfgroup)
+        cpanel_layout.addWidget(self.cgroup)
         spacerItem = QSpacerItem(50, 50, QSizePolicy.Minimum,
                 QSizePolicy.Expanding)
         cpanel_layout.addItem(spacerItem)
@@ -287,6 +2812,10 @@ class Window(QMainWindow):
         pg.setConfigOption('foreground', 'k')
         self.invpen = pg.mkPen('r', width=3)
         self.invpen2 = pg.mkPen('b', width=3)
+        self.cmppen = pg.mkPen('m', width=2, style=QtCore.Qt.DashLine)
+        self.difflut = mplcm_to_pglut(get_cmap('bwr'))
+        self.maplut = dict((name, mplcm_to_pglut(get_cmap(DERIVED_CMAPS[name])))
+                for name in DERIVED_MAPS)
 
         self.icanvas = pg.GraphicsLayoutWidget()
         self.pcanvas = pg.GraphicsLayoutWidget()
@@ -299,11 +2828,10 @@ class Window(QMainWindow):
         widget.setLayout(layout)
         self.setCentralWidget(widget)
 
-        rows = [0, 0, 0, 1, 1, 1, 2, 2, 2]
-        cols = [0, 1, 2] * 3
-        cm_names = ['gist_heat', 'bwr', 'gist_gray', 'RdGy_r', 'Oranges',
-        'Greens', 'Blues_r', 'Blues_r', 'copper']
-        ch_colors = ['w', 'k', 'w', 'k', 'k', 'k', 'w', 'k', 'w']
+        rows = IMAGE_ROWS
+        cols = IMAGE_COLS
+        cm_names = IMAGE_CMAPS
+        ch_colors = IMAGE_CH_COLORS
 
         self.cwimages = []
         for ii in range(len(cols)):
@@ -313,7 +2841,7 @@ class Window(QMainWindow):
             if cols[ii] == 0:
                 ytitle = 'pixel'
             cwimage = CWImage(self.icanvas, row=rows[ii], col=cols[ii],
-                    cm_name=cm.get_cmap(cm_names[ii]), ch_color=ch_colors[ii],
+                    cm_name=get_cmap(cm_names[ii]), ch_color=ch_colors[ii],
                     xtitle=xtitle, ytitle=ytitle, parent=self)
             self.cwimages.append(cwimage)
 
@@ -323,7 +2851,7 @@ class Window(QMainWindow):
         # Fill plot canvas
         rows = [0, 0, 1, 1, 2, 2]
         cols = [0, 1] * 3
-        xtitles_mod = ['log('+u"τ"+')'] * 2
+        xtitles_mod = [DEPTH_AXES[self.depthaxis][2]] * 2
         if self.plot_iwav:
             self.wunit = 'index'
         else:
@@ -391,123 +2919,636 @@ class Window(QMainWindow):
         fnameButton.triggered.connect(self.showFname)
         viewmenu.addAction(fnameButton)
 
+        nextButton = QAction('Next worst fit', self)
+        nextButton.setShortcut('Shift+N')
+        nextButton.triggered.connect(self.nextWorst)
+        viewmenu.addAction(nextButton)
+        prevButton = QAction('Previous worst fit', self)
+        prevButton.setShortcut('Shift+M')
+        prevButton.triggered.connect(self.prevWorst)
+        viewmenu.addAction(prevButton)
+
+        playButton = QAction('Play/Pause', self)
+        playButton.setShortcut('Shift+P')
+        playButton.triggered.connect(self.togglePlay)
+        viewmenu.addAction(playButton)
+
+        self.autolevels = True
+        levelButton = QAction('Percentile auto-levels', self, checkable=True)
+        levelButton.setChecked(self.autolevels)
+        levelButton.toggled.connect(self.toggleAutoLevels)
+        viewmenu.addAction(levelButton)
+
+        self.profButton = QAction('Profiling', self, checkable=True)
+        self.profButton.setChecked(PROFILER.enabled)
+        self.profButton.toggled.connect(self.toggleProfiling)
+        viewmenu.addAction(self.profButton)
+
+        traceButton = QAction('Export profiling trace...', self)
+        traceButton.triggered.connect(self.exportTrace)
+        viewmenu.addAction(traceButton)
+
+        cacheButton = QAction('Show slice cache statistics', self)
+        cacheButton.triggered.connect(self.showCacheStats)
+        viewmenu.addAction(cacheButton)
+
         # ---- initialise statusbar ----
         self.status = self.statusBar()
+        self.progress = QProgressBar()
+        self.progress.setFormat('chi2 and ranges: %p%')
+        self.progress.setFixedWidth(200)
+        self.progress.setVisible(False)
+        self.status.addPermanentWidget(self.progress)
+
+        # ---- initialise profiling dock ----
+        self.profdock = QDockWidget('Profiling', self)
+        self.proflabel = QLabel()
+        self.proflabel.setFont(QtGui.QFontDatabase.systemFont(
+            QtGui.QFontDatabase.FixedFont))
+        self.proflabel.setAlignment(QtCore.Qt.AlignTop | QtCore.Qt.AlignLeft)
+        self.profdock.setWidget(self.proflabel)
+        self.addDockWidget(QtCore.Qt.BottomDockWidgetArea, self.profdock)
+        self.profdock.setVisible(PROFILER.enabled)
+        self.proftimer = QTimer(self)
+        self.proftimer.timeout.connect(self.updateProfiling)
+        if PROFILER.enabled:
+            self.proftimer.start(500)
+
+        # ---- initialise region density dock ----
+        # Depth against value for the model, wavelength against value for
+        # the observed and synthetic profiles side by side
+        self.densitydock = QDockWidget('Region density', self)
+        self.dcanvas = pg.GraphicsLayoutWidget()
+        self.densitydock.setWidget(self.dcanvas)
+        self.addDockWidget(QtCore.Qt.RightDockWidgetArea, self.densitydock)
+        self.densitydock.setVisible(False)
+        self.densitydock.visibilityChanged.connect(self.densityVisible)
+        lut = mplcm_to_pglut(get_cmap('Blues'))
+        self.densityplots = {}
+        for ii, (name, title) in enumerate((('temp', 'T [kK]'), ('vlos',
+                'vlos [km/s]'))):
+            self.densityplots[name] = DensityPlot(self.dcanvas, row=0,
+                    col=ii, title=title, xtitle=DEPTH_AXES[self.depthaxis][2],
+                    lut=lut)
+        for ii, stokes in enumerate(self.labels_stokes):
+            for jj, (name, title) in enumerate((('obs', 'observed'), ('syn',
+                    'synthetic'))):
+                self.densityplots[(name, ii)] = DensityPlot(self.dcanvas,
+                        row=ii+1, col=jj, title='{0} {1}'.format(title,
+                            stokes), xtitle='wavelength [{0}]'.format(
+                                self.wunit), lut=lut)
+                if jj == 1:
+                    self.linkviews(self.densityplots[('obs', ii)].box,
+                            self.densityplots[(name, ii)].box)
 
         # ---- show GUI ----
         self.show()
 
-    def initModel(self):
-        self.m = sp.model(self.fname_atmos)
-        self.nx = self.m.nx
-        self.ny = self.m.ny
-        self.itau = -1
-        self.tt = 0
-        self.xx = np.int(self.nx/2)
-        self.yy = np.int(self.ny/2)
-        self.nt = self.m.nt
-        self.ltaus = self.m.ltau[0,self.ny//2,self.nx//2,:]
-        self.ndep = self.m.ndep
+    @profiled
+    def getSlice(self, request):
+        return self.slices.get(*request)
 
-        self.m.azi *= 180./np.pi
-        self.m.vturb *= 1.e-5  # in km/s
-        self.m.vlos *= 1.e-5
-        self.m.temp /= 1.e3 # in kK
-        self.m.Bln /= 1.e3 # in kG
-        self.m.Bho /= 1.e3 # in kG
-
-        self.minmax_vlos = np.zeros((2, self.m.ndep), dtype='float64')
-        self.minmax_vlos[0,:] = np.min(self.m.vlos, axis=(0,1,2))
-        self.minmax_vlos[1,:] = np.max(self.m.vlos, axis=(0,1,2))
-        self.minmax_vlos_all = (self.minmax_vlos[0].min(), self.minmax_vlos[1].max())
-        self.absmax_vlos = np.abs(self.m.vlos).max()
-        self.lut_vlos = mplcm_to_pglut(cmap_truncate(cm.get_cmap('bwr'),
-            absmax=self.absmax_vlos, minmax=(self.m.vlos[:,:,:,self.itau].min(),
-                self.m.vlos[:,:,:,self.itau].max()) ) )
-
-        self.minmax_Bln = np.zeros((2, self.m.ndep), dtype='float64')
-        self.minmax_Bln[0,:] = np.min(self.m.Bln, axis=(0,1,2))
-        self.minmax_Bln[1,:] = np.max(self.m.Bln, axis=(0,1,2))
-        self.minmax_Bln_all = (self.minmax_Bln[0].min(), self.minmax_Bln[1].max())
-        self.absmax_Bln = np.abs(self.m.Bln).max()
-        self.lut_Bln = mplcm_to_pglut(cmap_truncate(cm.get_cmap('RdGy_r'),
-            absmax=self.absmax_Bln, minmax=(self.m.Bln[:,:,:,self.itau].min(),
-                self.m.Bln[:,:,:,self.itau].max()) ) )
-        print("initModel: Model has dimensions (nx,ny)=({0},{1})".format(self.nx,
-            self.ny))
+    def backgroundSlice(self, request, nbytes, slices=None):
+        # Slice built in a worker thread the first time it is asked for, and
+        # None until it is in the slice cache (or slices); slices of more than
+        # half the cache are not built at all
+        key, load = request
+        slices = self.slices if slices is None else slices
+        if nbytes > slices.maxbytes // 2:
+            return None
+        if slices.ready([key]):
+            return slices.get(*request)
+        if key not in self.buildjobs:
+            # Builds for other time steps not started yet are dropped
+            tt = slice_runs(key)[1]
+            for other in [other for other, job in self.buildjobs.items()
+                    if slice_runs(other)[1] != tt and job.cancel()]:
+                del self.buildjobs[other]
+            self.buildjobs[key] = self.buildpool.submit(self.buildSlice,
+                    request, slices)
+        return None
 
-    def initSynth(self):
-        self.s = sp.profile(self.fname_synth)
-        self.synprof = self.s.dat[:,:,:,self.wsel,:]
-        self.nw = self.wsel.size
-        self.ww = 0
-        self.istokes = 0
+    def buildSlice(self, request, slices):
+        # A failed build stays in buildjobs, so that it is not tried again
+        try:
+            slices.get(*request)
+        except Exception as err:
+            print("buildSlice: {0}".format(err))
+            return
+        self.sliceBuilt.emit(request[0])
 
-    def initObs(self):
-        self.o = sp.profile(self.fname_obs)
-        self.wsel = np.where(self.o.dat[0,self.o.ny//2,self.o.nx//2,:,0] > 0)[0]
-        self.wav = self.o.wav[self.wsel]
-        self.plot_iwav = np.diff(self.wav).max() > 50.
-        if self.plot_iwav:
-            self.plot_wav = np.arange(self.wsel.size)
-        else:
-            self.plot_wav = self.wav
-        self.obsprof = self.o.dat[:,:,:,self.wsel,:]
+    def sliceDone(self, key):
+        self.buildjobs.pop(key, None)
+        self.scheduler.mark(DIRTY_REGION | DIRTY_STATUS)
 
-    def getChi2(self):
-        self.wts = np.zeros(self.obsprof.shape)
-        self.wts[:,:,:] = self.o.weights[self.wsel,:]
-        self.chi2_stokes = np.sum(((self.obsprof - self.synprof)/self.wts)**2,
-                axis=3) / self.nw
-        self.chi2 = np.sum(self.chi2_stokes, axis=3) / self.o.ns
+    def openPixelCaches(self):
+        # In the precision of the slices, so that hover shows the same values
+        # with the pixel cache as without
+        dtype = self.dtype or 'float64'
+        caches = {'obs': PixelCache(self.cache, 'pixels', (self.fname_obs,),
+            [('obs', self.obsprof)], tt0=self.tt, dtype=dtype)}
+        for irun, run in enumerate(self.runs):
+            name = 'pixels-'+run.m.tag if isinstance(run.m, ResampledModel) \
+                    else 'pixels'
+            caches[irun] = PixelCache(self.cache, name, (self.fname_obs,
+                run.fname_synth, run.fname_atmos), self.pixelCubes(run),
+                tt0=self.tt, dtype=dtype)
+        return caches
 
-    def vminmaxImage(self):
-        min_syn = np.min(self.s.dat[:,:,:,self.wsel,:], axis=(0,1,2,3))
-        max_syn = np.max(self.s.dat[:,:,:,self.wsel,:], axis=(0,1,2,3))
-        min_obs = np.min(self.o.dat[:,:,:,self.wsel,:], axis=(0,1,2,3))
-        max_obs = np.max(self.o.dat[:,:,:,self.wsel,:], axis=(0,1,2,3))
-        self.vminmax = []
-        for ii in range(4):
-            self.vminmax.append((np.minimum(min_syn[ii], min_obs[ii]),
-                np.maximum(max_syn[ii], max_obs[ii])))
+    def pixelCubes(self, run):
+        return [('syn', run.synprof)] + [(name, getattr(run.m, name)) for
+                name in MODEL_IMAGES]
+
+    @profiled
+    def pixelData(self):
+        # Profiles and stratifications of the current pixel, read once per
+        # pixel and from the pixel-major caches where these are built
+        key = (self.irun, self.tt, self.yy, self.xx)
+        if key == self.pixelkey:
+            return self.pixeldata
+        data = None
+        if self.pixelcaches is not None:
+            obs = self.pixelcaches['obs'].pixel(self.tt, self.yy, self.xx)
+            run = self.pixelcaches[self.irun].pixel(self.tt, self.yy, self.xx)
+            if obs is not None and run is not None:
+                data = dict(obs, **run)
+        if data is None:
+            data = {'obs': self.obsprof[self.tt,self.yy,self.xx,:,:],
+                    'syn': self.synprof[self.tt,self.yy,self.xx,:,:]}
+            for name in MODEL_IMAGES:
+                data[name] = getattr(self.m, name)[self.tt,self.yy,self.xx,:]
+        self.pixelkey = key
+        self.pixeldata = data
+        return data
+
+    def sliceRequests(self, tt, itau, ww, model=True, prof=True):
+        jrun = self.jrun if self.showdiff else None
+        requests = []
+        if model:
+            requests += [self.modelSlice(name, tt, itau, jrun=jrun) for name
+                    in MODEL_IMAGES]
+        if prof:
+            requests += [self.profSlice(name, tt, ww, self.istokes, jrun=jrun)
+                    for name in ('obs', 'syn')]
+            if self.mapname is not None:
+                requests += [self.mapSlice(kind, tt) for kind in ('obs',
+                    'syn')]
+            if self.chi2Complete(tt):
+                requests.append(self.chi2Slice(tt, jrun))
+        return requests
+
+    def imageLevels(self, pyr):
+        return pyr.auto if self.autolevels else pyr.range()
+
+    def spectralLevels(self):
+        # Common levels of the observed and synthetic images
+        if not self.autolevels:
+            return self.vminmax[self.istokes]
+        pyrs = [self.getSlice(self.profSlice(name, self.tt, self.ww,
+            self.istokes)) for name in ('obs', 'syn')]
+        return (min(pyr.auto[0] for pyr in pyrs), max(pyr.auto[1] for pyr in
+            pyrs))
+
+    def setDiffImage(self, cwimage, pyr):
+        # Differences between runs on a symmetric scale
+        vmin, vmax = self.imageLevels(pyr)
+        amax = max(abs(vmin), abs(vmax)) or 1.
+        cwimage.setImage(pyr, levels=(-amax, amax), lut=self.difflut)
+
+    def axisIndex(self, axis):
+        return {'time': self.tt, 'depth': self.itau % self.ndep,
+                'wave': self.ww}[axis]
+
+    def axisLength(self, axis):
+        return {'time': self.nt, 'depth': self.ndep, 'wave': self.nw}[axis]
+
+    def frameRequests(self, axis, index):
+        # Slices that change when stepping along axis to index
+        index %= self.axisLength(axis)
+        if axis == 'time':
+            return self.sliceRequests(index, self.itau, self.ww)
+        elif axis == 'depth':
+            return self.sliceRequests(self.tt, index, self.ww, prof=False)
+        return self.sliceRequests(self.tt, self.itau, index, model=False)
 
+    def frameBytes(self, axis):
+        # Slice plus its pyramid levels
+        itemsize = np.dtype(self.dtype or 'float64').itemsize
+        return self.nx * self.ny * itemsize * 4//3 * \
+                len(self.frameRequests(axis, 0))
+
+    def frameReady(self, axis, index):
+        return self.slices.ready([key for key, load in
+            self.frameRequests(axis, index)])
+
+    def prefetch(self, axis, steps):
+        # Queue the slices expected next, given the direction of navigation
+        index = self.axisIndex(axis)
+        requests = []
+        for step in steps:
+            requests += self.frameRequests(axis, index+step)
+        self.slices.prefetch(requests)
+
+    @profiled
     def drawModel(self):
-        self.cwimages[0].img.setImage(self.m.temp[self.tt,:,:,self.itau])
-        self.cwimages[1].img.setImage(self.m.vlos[self.tt,:,:,self.itau],
-                levels=self.minmax_vlos[:,self.itau], lut=self.lut_vlos)
-        self.cwimages[2].img.setImage(self.m.vturb[self.tt,:,:,self.itau])
-        self.cwimages[3].img.setImage(self.m.Bln[self.tt,:,:,self.itau],
-                levels=self.minmax_Bln[:,self.itau], lut=self.lut_Bln)
-        self.cwimages[4].img.setImage(self.m.Bho[self.tt,:,:,self.itau])
-        self.cwimages[5].img.setImage(self.m.azi[self.tt,:,:,self.itau])
+        ims = [self.getSlice(request) for request in self.sliceRequests(
+            self.tt, self.itau, self.ww, prof=False)]
+        if self.showdiff:
+            for ii, im in enumerate(ims):
+                self.setDiffImage(self.cwimages[ii], im)
+            return
+        self.cwimages[0].setImage(ims[0], levels=self.imageLevels(ims[0]))
+        self.cwimages[1].setImage(ims[1],
+                levels=self.minmax_vlos[:,self.itau],
+                lut=self.lutcache.get('bwr', self.itau))
+        self.cwimages[2].setImage(ims[2], levels=self.imageLevels(ims[2]))
+        self.cwimages[3].setImage(ims[3],
+                levels=self.minmax_Bln[:,self.itau],
+                lut=self.lutcache.get('RdGy_r', self.itau))
+        self.cwimages[4].setImage(ims[4], levels=self.imageLevels(ims[4]))
+        self.cwimages[5].setImage(ims[5], levels=self.imageLevels(ims[5]))
 
+    @profiled
     def plotModel(self):
-        self.cwplots[0].invplot.setData(self.ltaus, self.m.temp[self.tt,self.yy,self.xx,:],
-                pen=self.invpen)
-        self.cwplots[1].invplot.setData(self.ltaus, self.m.vlos[self.tt,self.yy,self.xx,:],
-                pen=self.invpen)
-        self.cwplots[1].invplot2.setData(self.ltaus, self.m.vturb[self.tt,self.yy,self.xx,:],
-                pen=self.invpen2)
+        pixel = self.pixelData()
+        temp, vlos, vturb = pixel['temp'], pixel['vlos'], pixel['vturb']
+        with PROFILER.stage('PlotDataItem.setData'):
+            self.cwplots[0].invplot.setData(self.ltaus, temp, pen=self.invpen)
+            self.cwplots[1].invplot.setData(self.ltaus, vlos, pen=self.invpen)
+            self.cwplots[1].invplot2.setData(self.ltaus, vturb, pen=self.invpen2)
+        if self.jrun is not None:
+            other = self.runs[self.jrun].m
+            with PROFILER.stage('PlotDataItem.setData'):
+                self.cwplots[0].cmpplot.setData(self.runs[self.jrun].ltaus,
+                        other.temp[self.tt,self.yy,self.xx,:], pen=self.cmppen)
+                self.cwplots[1].cmpplot.setData(self.runs[self.jrun].ltaus,
+                        other.vlos[self.tt,self.yy,self.xx,:], pen=self.cmppen)
 
+    @profiled
     def drawSynth(self):
-        self.cwimages[7].img.setImage(self.synprof[self.tt,:,:,self.ww,self.istokes],
-                levels=self.vminmax[self.istokes])
+        if self.showdiff:
+            self.setDiffImage(self.cwimages[7], self.getSlice(self.profSlice(
+                'syn', self.tt, self.ww, self.istokes, jrun=self.jrun)))
+            return
+        self.cwimages[7].setImage(self.getSlice(self.profSlice('syn',
+            self.tt, self.ww, self.istokes)), levels=self.spectralLevels())
 
+    @profiled
     def plotSynth(self):
-        for ii in range(4):
-            self.cwplots[ii+2].invplot.setData(self.plot_wav,
-                    self.synprof[self.tt,self.yy,self.xx,:,ii], pen=self.invpen)
+        prof = self.pixelData()['syn']
+        with PROFILER.stage('PlotDataItem.setData'):
+            for ii in range(4):
+                self.cwplots[ii+2].invplot.setData(self.plot_wav, prof[:,ii],
+                        pen=self.invpen)
+        if self.jrun is not None:
+            prof = self.runs[self.jrun].synprof[self.tt,self.yy,self.xx,:,:]
+            with PROFILER.stage('PlotDataItem.setData'):
+                for ii in range(4):
+                    self.cwplots[ii+2].cmpplot.setData(self.plot_wav,
+                            prof[:,ii], pen=self.cmppen)
 
+    @profiled
     def drawObs(self):
-        self.cwimages[6].img.setImage(self.obsprof[self.tt,:,:,self.ww,self.istokes],
-                levels=self.vminmax[self.istokes])
-        self.cwimages[8].img.setImage(self.chi2[self.tt,:,:])
+        self.cwimages[6].setImage(self.getSlice(self.profSlice('obs',
+            self.tt, self.ww, self.istokes)), levels=self.spectralLevels())
+        request = self.chi2Slice(self.tt, self.jrun if self.showdiff else None)
+        if self.chi2Complete(self.tt):
+            pyr = self.getSlice(request)
+        else:
+            # Not cached until chi2 of the time step is complete
+            pyr = request[1]()
+        if self.showdiff:
+            self.setDiffImage(self.cwimages[8], pyr)
+        else:
+            self.cwimages[8].setImage(pyr, levels=self.imageLevels(pyr))
+
+    @profiled
+    def drawMaps(self):
+        if self.mapname is None:
+            return
+        pyrs = [self.getSlice(self.mapSlice(kind, self.tt)).pyramids[
+            self.mapname] for kind in ('obs', 'syn')]
+        # Common levels, so that observed and synthetic maps compare directly
+        vmin = min(self.imageLevels(pyr)[0] for pyr in pyrs)
+        vmax = max(self.imageLevels(pyr)[1] for pyr in pyrs)
+        if self.mapname == 'cog':
+            vmax = max(abs(vmin), abs(vmax)) or 1.
+            vmin = -vmax
+        for cwimage, pyr in zip(self.mapimages, pyrs):
+            cwimage.setImage(pyr, levels=(vmin, vmax),
+                    lut=self.maplut[self.mapname])
+
+    def changeMap(self, index):
+        self.mapname = DERIVED_MAPS[index-1] if index > 0 else None
+        if self.mapname is not None and not self.mapimages:
+            for col, kind in enumerate(('observed', 'synthetic')):
+                cwimage = CWImage(self.icanvas, row=3, col=col,
+                        cm_name=get_cmap('gist_gray'), ch_color='k',
+                        xtitle='pixel', ytitle='pixel' if col == 0 else None,
+                        parent=self)
+                self.linkviews(self.cwimages[0].box, cwimage.box)
+                if self.cwimages[0].roi is not None:
+                    cwimage.setRoi(self.labels_region[
+                        self.bgroup_region.checkedId()], 0., 0., 1.)
+                    cwimage.roi.blockSignals(True)
+                    cwimage.roi.setState(self.cwimages[0].roi.saveState())
+                    cwimage.roi.blockSignals(False)
+                self.mapimages.append(cwimage)
+                self.cwimages.append(cwimage)
+        elif self.mapname is None:
+            for cwimage in self.mapimages:
+                # Otherwise the scene and the linked views keep the panel alive
+                cwimage.proxy.disconnect()
+                cwimage.box.setXLink(None)
+                cwimage.box.setYLink(None)
+                self.icanvas.removeItem(cwimage.box)
+                self.cwimages.remove(cwimage)
+            self.mapimages = []
+        for cwimage, kind in zip(self.mapimages, ('observed', 'synthetic')):
+            cwimage.box.setTitle('{0}: {1}'.format(kind,
+                DERIVED_TITLES[self.mapname]))
+        self.scheduler.mark(DIRTY_MAPS | DIRTY_MARKERS | DIRTY_STATUS)
+
+    def chi2Done(self, tt):
+        self.chi2Ready.emit(tt)
+
+    def startWatch(self, interval):
+        # Poll the synthetic and model files (--watch) from a worker thread;
+        # the first pass only takes the probes to compare against
+        self.watchbusy = True
+        self.watchpool = ThreadPoolExecutor(max_workers=1)
+        self.watchpool.submit(self.watchRuns, True)
+        self.watchReady.connect(self.applyWatch)
+        self.watchtimer = QTimer(self)
+        self.watchtimer.timeout.connect(self.pollWatch)
+        self.watchtimer.start(int(interval*1000))
+        qApp.aboutToQuit.connect(self.watchtimer.stop)
+        print("startWatch: checking {0} every {1:g} s".format(', '.join(
+            os.path.basename(run.fname_synth) for run in self.runs), interval))
+
+    def pollWatch(self):
+        # chi2 is updated in place, so wait for the initial pass to finish
+        if self.watchbusy or (self.chi2engine is not None and not
+                self.chi2engine.finished()):
+            return
+        self.watchbusy = True
+        self.watchpool.submit(self.watchRuns)
+
+    def watchRuns(self, init=False):
+        try:
+            if init:
+                self.initWatch()
+                return
+            for irun in range(len(self.runs)):
+                keys = self.reloadRun(irun)
+                if not keys:
+                    continue
+                if self.pixelcaches is not None:
+                    self.pixelcaches[irun].update(self.pixelCubes(
+                        self.runs[irun]), keys)
+                self.watchReady.emit(irun, keys)
+        except (IOError, OSError, RuntimeError, ValueError) as err:
+            # Files caught in the middle of a write are read on the next poll
+            print("watchRuns: {0}".format(err))
+        finally:
+            self.watchbusy = False
+
+    @profiled
+    def applyWatch(self, irun, keys):
+        times = set(tt for tt, rows in keys)
+        def stale(key):
+            runs, tt = slice_runs(key)
+            return irun in runs and tt in times
+        self.slices.discard(stale)
+        self.diskslices.discard(stale)
+        self.pixelkey = None
+        if irun == self.irun:
+            self.selectRun(irun)
+        if irun in (self.irun, self.jrun):
+            self.scheduler.mark(DIRTY_ALL)
+        print("applyWatch: run {0}: {1} row(s) of {2} time step(s) "
+                "updated".format(irun+1, sum(rows.stop-rows.start for tt, rows
+                    in keys), len(times)))
+
+    @profiled
+    def updateChi2(self, tt):
+        # Image ranges grow with every time step done
+        self.vminmaxImage()
+        self.updateProgress()
+        if self.chi2engine.failed[tt]:
+            self.status.showMessage('Error: chi2 of time step {0} failed: '
+                    '{1}'.format(tt, self.chi2engine.error))
+        elif self.chi2engine.done.all() and not self.chi2final:
+            self.chi2final = True
+            if not self.chi2engine.cancelled:
+                self.saveChi2()
+            self.scheduler.mark(DIRTY_SPECTRAL | DIRTY_REGION | DIRTY_STATUS)
+        elif tt == self.tt:
+            self.scheduler.mark(DIRTY_SPECTRAL | DIRTY_REGION | DIRTY_STATUS)
+        elif not self.autolevels:
+            self.scheduler.mark(DIRTY_SPECTRAL)
 
+    def statsDone(self, mstats):
+        self.statsfinished.append(mstats)
+        self.statsReady.emit(mstats)
+
+    def updateStats(self, mstats):
+        # Velocity and field ranges of a run are complete
+        for run in self.runs:
+            if run.mstats is mstats:
+                self.modelRanges(run)
+        if self.mstats is mstats:
+            self.modelRanges(self)
+            self.scheduler.mark(DIRTY_MODEL)
+        self.updateProgress()
+
+    def updateProgress(self):
+        # Background reductions still running after the first paint
+        total = getattr(self, 'statsjobs', 0)
+        done = len(self.statsfinished)
+        if self.chi2engine is not None and not self.chi2engine.cancelled:
+            total += self.nt
+            done += int((self.chi2engine.done | self.chi2engine.failed).sum())
+        self.progress.setRange(0, max(total, 1))
+        self.progress.setValue(done)
+        self.progress.setVisible(done < total)
+
+    @profiled
     def plotObs(self):
-        for ii in range(4):
-            self.cwplots[ii+2].obsplot.setData(self.plot_wav,
-                    self.obsprof[self.tt,self.yy,self.xx,:,ii], symbol='o',
-                    symbolPen='k')
+        prof = self.pixelData()['obs']
+        with PROFILER.stage('PlotDataItem.setData'):
+            for ii in range(4):
+                self.cwplots[ii+2].obsplot.setData(self.plot_wav, prof[:,ii],
+                        symbol='o', symbolPen='k')
+
+    def updateRegionMode(self):
+        kind = self.labels_region[self.bgroup_region.checkedId()]
+        radius = max(2, min(self.nx, self.ny)//10)
+        xc = min(max(self.xx+0.5, radius), self.nx-radius)
+        yc = min(max(self.yy+0.5, radius), self.ny-radius)
+        for cwimage in self.cwimages:
+            cwimage.setRoi(kind, xc, yc, radius)
+        if kind is None:
+            self.region = None
+            self.scheduler.mark(DIRTY_REGION | DIRTY_STATUS)
+        else:
+            self.changeRegion(self.cwimages[0])
+
+    @profiled
+    def changeRegion(self, source):
+        # Follow the region dragged on one image with the others
+        state = source.roi.saveState()
+        for cwimage in self.cwimages:
+            if cwimage is not source:
+                cwimage.roi.blockSignals(True)
+                cwimage.roi.setState(state)
+                cwimage.roi.blockSignals(False)
+        self.region = region_boxes(source.roiShape(), self.ny, self.nx)
+        self.scheduler.mark(DIRTY_REGION | DIRTY_STATUS)
+
+    def regionStats(self, name):
+        # From the summed-area tables of the time step once they are built in
+        # the background, summing the region's own pixels until then, and
+        # always for chi2 that is not final yet. Tables too large for the slice
+        # cache are memory-mapped from temporary files next to the cache
+        # entries, or in the system's temporary directory
+        cube = self.areaCube(name)
+        area = None
+        nbytes = AREA_BYTES*cube.size//cube.shape[0]
+        if name != 'chi2' or self.chi2Complete(self.tt):
+            if nbytes <= self.slices.maxbytes // 2:
+                area = self.backgroundSlice(self.areaSlice(name, self.tt),
+                        nbytes)
+            else:
+                tmpdir = tempfile.gettempdir() if self.cache is None else \
+                        os.path.join(os.path.dirname(os.path.abspath(
+                            self.fname_obs)), CACHE_DIR)
+                area = self.backgroundSlice(self.areaSlice(name, self.tt,
+                    tmpdir), nbytes, self.diskslices)
+        if area is None:
+            return region_stats(cube, self.tt, self.region)
+        return area.stats(self.region)
+
+    @profiled
+    def plotRegion(self):
+        if self.region is None:
+            self.region_chi2 = None
+            for cwplot in self.cwplots:
+                cwplot.clearRegions()
+            for plot in self.densityplots.values():
+                plot.clear()
+            return
+        for ii, (name, color) in enumerate((('temp', 'r'), ('vlos', 'r'),
+                ('vturb', 'b'))):
+            n, mean, std = self.regionStats(name)
+            self.cwplots[min(ii, 1)].setRegion(name, self.ltaus, mean, std,
+                    color)
+        for name, color in (('obs', 'k'), ('syn', 'r')):
+            n, mean, std = self.regionStats(name)
+            for ii in range(4):
+                self.cwplots[ii+2].setRegion(name, self.plot_wav, mean[:,ii],
+                        std[:,ii], color)
+        self.region_chi2 = self.regionStats('chi2')
+        if self.densitydock.isVisible():
+            self.plotDensity()
+
+    def densityBins(self, name, mask, y0, x0):
+        # Bins of the whole time step once they are built in the background;
+        # until then, and for bins that would take up much of the slice
+        # cache, those of the region's window alone
+        levels = self.getSlice(self.levelSlice(name, self.tt))
+        binned = self.backgroundSlice(self.binSlice(name, self.tt, levels),
+                sum(cube.size for cube in self.binCubes(name))//self.nt)
+        if binned is None:
+            binned = BinnedCube(self.binCubes(name), self.tt, levels[0],
+                    levels[1], rows=slice(y0, y0+mask.shape[0]),
+                    cols=slice(x0, x0+mask.shape[1]))
+        return binned
+
+    @profiled
+    def plotDensity(self):
+        mask, y0, x0 = region_mask(self.region)
+        for name in ('temp', 'vlos'):
+            binned = self.densityBins(name, mask, y0, x0)
+            counts = binned.density(mask, y0, x0)[:,0]
+            self.densityplots[name].setDensity(counts, self.ltaus,
+                    binned.vmin, binned.vmax, mask.sum())
+        binned = self.densityBins('prof', mask, y0, x0)
+        counts = binned.density(mask, y0, x0)
+        for ii in range(counts.shape[1]):
+            for jj, name in enumerate(('obs', 'syn')):
+                self.densityplots[(name, ii)].setDensity(counts[:,ii,jj],
+                        self.plot_wav, binned.vmin[ii,0], binned.vmax[ii,0],
+                        mask.sum())
+
+    def toggleDensity(self, checked):
+        self.densitydock.setVisible(checked)
+
+    def densityVisible(self, visible):
+        self.densitybox.blockSignals(True)
+        self.densitybox.setChecked(visible)
+        self.densitybox.blockSignals(False)
+        if not visible or self.region is None:
+            for plot in self.densityplots.values():
+                plot.clear()
+        self.scheduler.mark(DIRTY_REGION)
+
+    def worstRanking(self):
+        stokes = self.rankbox.currentIndex()-1 if \
+                self.rankbox.currentIndex() > 0 else None
+        if self.rankregion.isChecked() and self.region is not None:
+            mask, y0, x0 = region_mask(self.region)
+            chi2 = self.chi2[self.tt] if stokes is None else \
+                    self.chi2_stokes[self.tt,:,:,stokes]
+            return FitRanking(chi2, self.worstk, mask=mask, y0=y0, x0=x0)
+        request = self.rankSlice(stokes, self.tt, self.worstk)
+        if not self.chi2Complete(self.tt):
+            # Not cached until chi2 of the time step is complete
+            return request[1]()
+        return self.getSlice(request)
+
+    @profiled
+    def jumpWorst(self, step):
+        # Move the crosshairs to the next (step 1) or previous (-1) pixel in
+        # the ranking; changing any of the options starts from the worst
+        threshold = self.rankmin.value() or None
+        key = (self.irun, self.tt, self.rankbox.currentIndex(), threshold,
+                self.rankregion.isChecked() and self.region is not None and
+                tuple(map(tuple, self.region)))
+        if key != self.worstkey:
+            self.worstkey = key
+            self.worstpos = -1
+            self.worstk = WORST_FITS
+        ranking = self.worstRanking()
+        pos = max(self.worstpos + step, 0)
+        while pos >= ranking.count(threshold) and not ranking.complete() \
+                and ranking.count(threshold) == ranking.values.size:
+            self.worstk *= 4
+            ranking = self.worstRanking()
+        n = ranking.count(threshold)
+        if n == 0:
+            self.worstlabel.setText('No pixels')
+            return
+        self.worstpos = min(pos, n-1)
+        xx = int(ranking.xx[self.worstpos])
+        yy = int(ranking.yy[self.worstpos])
+        self.worstlabel.setText('#{0} of {1}{2}: chi2={3:.3g} at ({4},{5})'.
+                format(self.worstpos+1, n, '' if ranking.complete() or n <
+                    ranking.values.size else '+', ranking.values[
+                        self.worstpos], xx, yy))
+        # Pan the (linked) images if the pixel is out of view
+        view = self.cwimages[0].box.vb
+        rect = view.viewRect()
+        if not rect.contains(xx+0.5, yy+0.5):
+            view.translateBy(x=xx+0.5-rect.center().x(),
+                    y=yy+0.5-rect.center().y())
+        self.changePixel(xx, yy)
+
+    def nextWorst(self):
+        self.jumpWorst(1)
+
+    def prevWorst(self):
+        self.jumpWorst(-1)
 
     def linkviews(self, anchorview, view):
         view.setXLink(anchorview)
@@ -532,141 +3573,669 @@ class Window(QMainWindow):
                     "STiCViewer".format(inam, typedict['fullname']))
             sys.exit()
 
+    @profiled
+    def render(self, dirty):
+        if dirty & DIRTY_MODEL:
+            self.drawModel()
+        if dirty & DIRTY_SPECTRAL:
+            self.drawSynth()
+            self.drawObs()
+        if dirty & DIRTY_MAPS:
+            self.drawMaps()
+        if dirty & DIRTY_MODELPROF:
+            self.plotModel()
+        if dirty & DIRTY_SPECPROF:
+            self.plotSynth()
+            self.plotObs()
+        if dirty & DIRTY_REGION:
+            self.plotRegion()
+        if dirty & DIRTY_MARKERS:
+            self.updateCrosshairs()
+            self.updateWMarker()
+            self.updateTauMarker()
+        if dirty & DIRTY_STATUS:
+            self.updateStatus()
+
+    @profiled
+    def changePixel(self, xx, yy):
+        if (xx, yy) != (self.xx, self.yy):
+            self.xx = xx
+            self.yy = yy
+            self.scheduler.mark(DIRTY_MODELPROF | DIRTY_SPECPROF |
+                    DIRTY_MARKERS | DIRTY_STATUS)
+
+    def stepDirection(self, new, old, n):
+        # Direction of navigation, taking wrap-around at either end into account
+        step = new - old
+        if abs(step) > n/2:
+            step = -step
+        return int(np.sign(step))
+
+    @profiled
     def updateDepth(self):
+        step = self.stepDirection(self.zslider.sval, self.itau % self.ndep,
+                self.ndep)
         self.itau = self.zslider.sval 
-        self.lut_vlos = mplcm_to_pglut(cmap_truncate(cm.get_cmap('bwr'),
-            absmax=self.absmax_vlos, minmax=(self.m.vlos[:,:,:,self.itau].min(),
-                self.m.vlos[:,:,:,self.itau].max()) ) )
-        self.lut_Bln = mplcm_to_pglut(cmap_truncate(cm.get_cmap('RdGy_r'),
-            absmax=self.absmax_Bln, minmax=(self.m.Bln[:,:,:,self.itau].min(),
-                self.m.Bln[:,:,:,self.itau].max()) ) )
-        self.drawModel()
-        self.updateTauMarker()
-        self.updateStatus()
+        self.scheduler.mark(DIRTY_MODEL | DIRTY_MARKERS | DIRTY_STATUS)
+        if step != 0:
+            self.prefetch('depth', (step, 2*step))
 
+    @profiled
     def updateTime(self):
+        step = self.stepDirection(self.tslider.sval, self.tt, self.nt)
         self.tt = self.tslider.sval
-        self.drawModel()
-        self.drawSynth()
-        self.drawObs()
-        self.plotModel()
-        self.updateStatus()
+        self.scheduler.mark(DIRTY_MODEL | DIRTY_SPECTRAL | DIRTY_MAPS |
+                DIRTY_MODELPROF | DIRTY_SPECPROF | DIRTY_REGION | DIRTY_STATUS)
+        if step != 0:
+            self.prefetch('time', (step, 2*step))
 
+    @profiled
     def updateWave(self):
+        step = self.stepDirection(self.wslider.sval, self.ww, self.nw)
         self.ww = self.wslider.sval
-        self.drawSynth()
-        self.drawObs()
-        self.updateWMarker()
-        self.updateStatus()
+        self.scheduler.mark(DIRTY_SPECTRAL | DIRTY_MARKERS | DIRTY_STATUS)
+        if step != 0:
+            self.prefetch('wave', (step, 2*step))
 
+    @profiled
     def updateWMarker(self):
         for ii in range(4):
             self.cwplots[ii+2].line.setPos(self.plot_wav[self.ww])
 
+    @profiled
     def updateTauMarker(self):
         for ii in range(2):
             self.cwplots[ii].line.setPos(self.ltaus[self.itau])
 
+    @profiled
     def updateCrosshairs(self):
-        self.updateStatus()
         for ii in range(len(self.cwimages)):
             self.cwimages[ii].vLine.setPos(self.xx+0.5) # +0.5: place mid-pixel
             self.cwimages[ii].hLine.setPos(self.yy+0.5)
 
+    @profiled
     def updateStokes(self):
         self.istokes = self.bgroup_stokes.checkedId()
-        self.drawObs()
-        self.drawSynth()
-        self.updateStatus()
+        self.scheduler.mark(DIRTY_SPECTRAL | DIRTY_STATUS)
 
+    @profiled
     def updateStatus(self):
+        self.status.showMessage(self.formatStatus())
+
+    @profiled
+    def formatStatus(self):
         coords = 'Position: (x,y)=({0:>3},{1:>3})'.format(self.xx, self.yy)
+        pixel = self.pixelData()
         model = 'Model: T[kK]={0:>6.2f}, vlos[km/s]={1:>6.2f}, vturb[km/s]={2:>6.2f}, Bln[kG]={3:>6.2f}, Bho[kG]={4:>6.2f}, azi[deg]={5:>5.1f})'.\
-                format(self.m.temp[self.tt, self.yy, self.xx, self.itau],
-                        self.m.vlos[self.tt, self.yy, self.xx, self.itau],
-                        self.m.vturb[self.tt, self.yy, self.xx, self.itau],
-                        self.m.Bln[self.tt, self.yy, self.xx, self.itau],
-                        self.m.Bho[self.tt, self.yy, self.xx, self.itau],
-                        self.m.azi[self.tt, self.yy, self.xx, self.itau])
+                format(*[pixel[name][self.itau] for name in MODEL_IMAGES])
         profs = 'Profile: Iobs={0:>6.3f}, Isyn={1:>6.3f}, Chi2={2:>5.2f} [(I, Q, U, V)=({3:>5.2f},{4:>5.2f},{5:>5.2f},{6:>5.2f})]'.\
-                format(self.obsprof[self.tt, self.yy, self.xx, self.ww, self.istokes],
-                    self.synprof[self.tt, self.yy, self.xx, self.ww, self.istokes],
+                format(pixel['obs'][self.ww, self.istokes],
+                    pixel['syn'][self.ww, self.istokes],
                     self.chi2[self.tt, self.yy, self.xx],
                     self.chi2_stokes[self.tt, self.yy, self.xx, 0],
                     self.chi2_stokes[self.tt, self.yy, self.xx, 1],
                     self.chi2_stokes[self.tt, self.yy, self.xx, 2],
                     self.chi2_stokes[self.tt, self.yy, self.xx, 3])
-        self.status.showMessage(coords+' | '+model+' | '+profs)
+        status = coords+' | '+model+' | '+profs
+        if self.mapname is not None:
+            maps = [self.slices.peek(self.mapSlice(kind, self.tt)[0]) for
+                    kind in ('obs', 'syn')]
+            if all(mapset is not None for mapset in maps):
+                status += ' | {0}: obs={1:.3g}, syn={2:.3g}'.format(
+                        DERIVED_TITLES[self.mapname], *[mapset.pyramids[
+                            self.mapname].levels[0][self.yy,self.xx] for
+                            mapset in maps])
+        if self.region_chi2 is not None:
+            n, mean, std = self.region_chi2
+            status += ' | Region: {0:.0f} pixels, Chi2={1:>5.2f}+-{2:.2f}'.\
+                    format(n, mean, std)
+        return status
 
     def showFname(self):
         filenames = 'Observed: {0} | Synthetic: {1} | Model: {2}'.\
                 format(os.path.basename(self.fname_obs),
                         os.path.basename(self.fname_synth),
                         os.path.basename(self.fname_atmos))
+        if len(self.runs) > 1:
+            filenames += ' | Run {0} of {1}'.format(self.irun+1,
+                    len(self.runs))
+            if self.jrun is not None:
+                filenames += ', compared with {0}'.format(os.path.basename(
+                    self.runs[self.jrun].fname_synth))
         self.status.showMessage(filenames)
 
+    def changeRun(self, irun):
+        self.selectRun(irun)
+        # The depth scale of the new run in the depth slider's label
+        self.zslider.values = self.ltaus
+        self.zslider.setLabelValue(intslider=True)
+        self.scheduler.mark(DIRTY_ALL)
+
+    def changeCompareRun(self, index):
+        self.jrun = index-1 if index > 0 else None
+        self.diffbox.setEnabled(self.jrun is not None)
+        if self.jrun is None:
+            self.showdiff = False
+            for cwplot in self.cwplots:
+                cwplot.cmpplot.setData([], [])
+        else:
+            self.showdiff = self.diffbox.isChecked()
+        self.scheduler.mark(DIRTY_ALL)
+
+    def toggleDiff(self, checked):
+        self.showdiff = checked and self.jrun is not None
+        self.scheduler.mark(DIRTY_MODEL | DIRTY_SPECTRAL)
+
+    def togglePlay(self):
+        if self.player.isPlaying():
+            self.player.stop()
+            self.playbutton.setText('Play')
+        else:
+            self.player.start()
+            self.playbutton.setText('Pause')
+
+    def updatePlayAxis(self):
+        self.player.axis = self.labels_axis[self.bgroup_axis.checkedId()]
+        if self.player.isPlaying():
+            self.player.start()
+
+    def updateFps(self):
+        self.player.setFps(self.fpsslider.sval)
+
+    def showFrame(self, axis, index):
+        index %= self.axisLength(axis)
+        if axis == 'time':
+            self.tt = index
+            self.tslider.setValue(self.tt)
+        elif axis == 'depth':
+            self.itau = index
+            self.zslider.setValue(self.itau)
+        else:
+            self.ww = index
+            self.wslider.setValue(self.ww)
+        self.fpslabel.setText('Achieved: {0:.1f} fps ({1} dropped)'.format(
+            self.player.achievedFps(), self.player.dropped))
+
+    def toggleAutoLevels(self, checked):
+        self.autolevels = checked
+        self.scheduler.mark(DIRTY_MODEL | DIRTY_SPECTRAL | DIRTY_MAPS)
+
+    def toggleProfiling(self, checked):
+        PROFILER.enabled = checked
+        self.profdock.setVisible(checked)
+        if checked:
+            self.proftimer.start(500)
+        else:
+            self.proftimer.stop()
+
+    def updateProfiling(self):
+        lines = ['{0:<36} {1:>6} {2:>10} {3:>10}'.format('stage', 'calls',
+            'mean [ms]', 'max [ms]')]
+        for name, ncall, mean, vmax in PROFILER.summary():
+            lines.append('{0:<36} {1:>6} {2:>10.2f} {3:>10.2f}'.format(name,
+                ncall, mean, vmax))
+        self.proflabel.setText('\n'.join(lines))
+
+    def exportTrace(self):
+        options = QFileDialog.Options()
+        options |= QFileDialog.DontUseNativeDialog
+        filename, _ = QFileDialog.getSaveFileName(self,
+            "Export profiling trace", os.path.join(self.cwd,
+                'sticviewer-trace.json'), "Chrome trace (*.json)",
+            options=options)
+        if filename:
+            PROFILER.export(filename)
+
+    def showCacheStats(self):
+        stats = 'Slice cache: {0} hits, {1} misses, {2} slices ({3:.1f} MB)'.\
+                format(self.slices.hits, self.slices.misses,
+                        len(self.slices.items), self.slices.nbytes/2.**20)
+        self.status.showMessage(stats)
+
     def incWave(self):
         self.ww += 1
         if (self.ww >= self.nw): self.ww = 0
-        self.changeWave()
+        self.changeWave(1)
 
     def decWave(self):
         self.ww -= 1
         if (self.ww < 0): self.ww = self.nw-1
-        self.changeWave()
+        self.changeWave(-1)
 
-    def changeWave(self):
+    @profiled
+    def changeWave(self, step):
         self.wslider.setValue(self.ww)
-        self.drawSynth()
-        self.drawObs()
-        self.updateWMarker()
-        self.updateStatus()
+        self.scheduler.mark(DIRTY_SPECTRAL | DIRTY_MARKERS | DIRTY_STATUS)
+        self.prefetch('wave', (step, 2*step))
 
     def incTime(self):
         self.tt += 1
         if (self.tt >= self.nt): self.tt = 0
-        self.changeTime()
+        self.changeTime(1)
 
     def decTime(self):
         self.tt -= 1
         if (self.tt < 0): self.tt = self.nt-1
-        self.changeTime()
+        self.changeTime(-1)
 
-    def changeTime(self):
+    @profiled
+    def changeTime(self, step):
         self.tslider.setValue(self.tt)
-        self.drawModel()
-        self.drawSynth()
-        self.drawObs()
-        self.plotModel()
-        self.plotSynth()
-        self.plotObs()
-        self.updateWMarker()
-        self.updateStatus()
+        self.scheduler.mark(DIRTY_MODEL | DIRTY_SPECTRAL | DIRTY_MAPS |
+                DIRTY_MODELPROF | DIRTY_SPECPROF | DIRTY_REGION | DIRTY_STATUS)
+        self.prefetch('time', (step, 2*step))
 
     def incDepth(self):
         self.itau += 1
         if (self.itau >= self.ndep): self.itau = 0
-        self.changeDepth()
+        self.changeDepth(1)
 
     def decDepth(self):
         self.itau -= 1
         if (self.itau < 0): self.itau = self.ndep-1
-        self.changeDepth()
+        self.changeDepth(-1)
 
-    def changeDepth(self):
+    @profiled
+    def changeDepth(self, step):
         self.zslider.setValue(self.itau)
-        self.drawModel()
-        self.drawSynth()
-        self.drawObs()
-        self.plotModel()
-        self.plotSynth()
-        self.plotObs()
-        self.updateWMarker()
-        self.updateStatus()
+        self.scheduler.mark(DIRTY_MODEL | DIRTY_MARKERS | DIRTY_STATUS)
+        self.prefetch('depth', (step, 2*step))
+
+
+class BatchRenderer(CubeData):
+    def __init__(self, args):
+        # Headless rendering of the image grid and profile plots to PNG files,
+        # without a QApplication or display
+        self.dtype = 'float32' if args.compact else None
+        self.cache = None if args.no_cache else DerivedCache(self.dtype)
+        self.depthgrid = args.depth_grid
+        self.fname_obs, self.fname_synth, self.fname_atmos = args.files
+        self.loadData()
+        if self.chi2engine is not None:
+            self.chi2engine.wait()
+            self.saveChi2()
+            self.vminmaxImage()
+        self.outdir = args.render
+        self.axis = args.axis
+        self.dpi = args.dpi
+        self.tt = args.time % self.nt
+        self.itau = args.depth % self.ndep
+        self.ww = args.wave % self.nw
+        self.istokes = 'IQUV'.index(args.stokes)
+        if args.pixel is not None:
+            self.xx, self.yy = args.pixel
+        self.wunit = 'index' if self.plot_iwav else u'Å'
+
+    def __getstate__(self):
+        # Worker processes reopen the (lazily read) input files themselves
+        state = self.__dict__.copy()
+        for key in ('m', 'o', 's', 'obsprof', 'synprof', 'chi2', 'chi2_stokes',
+                'chi2engine', 'mstats', 'stats_obs', 'stats_syn', 'runs',
+                'chi2runs'):
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.m = read_model(self.fname_atmos, dtype=self.dtype)
+        if self.depthgrid is not None:
+            # Memory-mapped from the cache written by the parent process
+            self.m = ResampledModel(self.m, self.depthgrid[0], self.ltaus,
+                    cache=self.cache, fnames=(self.fname_atmos,),
+                    dtype=self.dtype)
+        self.o = read_profile(self.fname_obs, dtype=self.dtype)
+        self.s = read_profile(self.fname_synth, dtype=self.dtype)
+        self.obsprof = self.o.dat.take(self.wsel)
+        self.synprof = self.s.dat.take(self.wsel)
+
+    def frameIndices(self, frames=None):
+        n = {'time': self.nt, 'depth': self.ndep, 'wave': self.nw}[self.axis]
+        if frames is None:
+            return list(range(n))
+        start, _, stop = frames.partition(':')
+        return list(range(n))[slice(int(start) if start else None,
+            int(stop) if stop else None)]
+
+    def run(self, frames=None, nproc=None, movie=None, fps=10):
+        os.makedirs(self.outdir, exist_ok=True)
+        tasks = []
+        for seq, index in enumerate(self.frameIndices(frames)):
+            tt = index if self.axis == 'time' else self.tt
+            fname = os.path.join(self.outdir, '{0}_{1:04d}.png'.format(
+                self.axis, seq))
+            tasks.append((fname, index, np.array(self.chi2[tt])))
+        self.levels = self.movieLevels([task[1] for task in tasks])
+        # Workers are spawned rather than forked, so that each one reopens the
+        # input files (__setstate__) instead of inheriting the open HDF5 and
+        # netCDF handles of this process, which are not fork-safe
+        with ProcessPoolExecutor(max_workers=nproc, initializer=init_batch_worker,
+                initargs=(self,), mp_context=multiprocessing.get_context(
+                    'spawn')) as pool:
+            for fname in pool.map(render_batch_frame, tasks):
+                print("BatchRenderer: wrote {0}".format(fname))
+        if movie is not None:
+            self.makeMovie(movie, fps)
+
+    def makeMovie(self, movie, fps):
+        ffmpeg = shutil.which('ffmpeg')
+        if ffmpeg is None:
+            print("BatchRenderer [error]: ffmpeg is required to write {0}".format(
+                movie))
+            return
+        subprocess.check_call([ffmpeg, '-y', '-loglevel', 'error', '-framerate',
+            str(fps), '-i', os.path.join(self.outdir, self.axis+'_%04d.png'),
+            '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2', '-pix_fmt', 'yuv420p',
+            movie])
+        print("BatchRenderer: wrote {0}".format(movie))
+
+    def frameIndex(self, index):
+        # Time step, depth and wavelength of frame index
+        if self.axis == 'time':
+            return index, self.itau % self.ndep, self.ww
+        elif self.axis == 'depth':
+            return self.tt, index % self.ndep, self.ww
+        return self.tt, self.itau % self.ndep, index
+
+    def frameImages(self, index, chi2=None):
+        # Images of the grid of frame index, as shown by drawModel, drawObs
+        # and drawSynth
+        tt, itau, ww = self.frameIndex(index)
+        images = [getattr(self.m, name)[tt,:,:,itau] for name in MODEL_IMAGES]
+        images += [self.obsprof[tt,:,:,ww,self.istokes],
+                self.synprof[tt,:,:,ww,self.istokes],
+                self.chi2[tt] if chi2 is None else chi2]
+        return images
+
+    def movieLevels(self, indices):
+        # Levels of the images common to all frames, so that the contrast does
+        # not jump from one frame to the next: the widest percentile levels of
+        # a few frames spread over the movie, shared by the observed and
+        # synthetic images
+        picks = np.unique(np.linspace(0, len(indices)-1, min(len(indices),
+            MOVIE_LEVEL_FRAMES)).round().astype(int))
+        levels = np.array([[sample_levels(dat) for dat in
+            self.frameImages(indices[ii])] for ii in picks])
+        if levels.size == 0:
+            return None
+        levels = np.stack([levels[:,:,0].min(axis=0), levels[:,:,1].max(
+            axis=0)], axis=-1)
+        levels[6] = levels[7] = (levels[6:8,0].min(), levels[6:8,1].max())
+        return levels
+
+    def renderFrame(self, fname, index, chi2):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.colors import ListedColormap
+
+        self.tt, itau, self.ww = self.frameIndex(index)
+        if self.axis == 'depth':
+            self.itau = index
+
+        # Same panels and colour tables as drawModel/drawObs/drawSynth, with
+        # the levels of the whole movie
+        images = self.frameImages(index, chi2)
+        levels = list(self.levels)
+        cmaps = list(IMAGE_CMAPS)
+        levels[1] = self.minmax_vlos[:,itau]
+        cmaps[1] = ListedColormap(self.lutcache.get('bwr', itau)/255.)
+        levels[3] = self.minmax_Bln[:,itau]
+        cmaps[3] = ListedColormap(self.lutcache.get('RdGy_r', itau)/255.)
+
+        fig = Figure(figsize=(16, 9), dpi=self.dpi)
+        FigureCanvasAgg(fig)
+        grid = fig.add_gridspec(3, 5)
+        for ii, dat in enumerate(images):
+            ax = fig.add_subplot(grid[IMAGE_ROWS[ii], IMAGE_COLS[ii]])
+            vmin, vmax = levels[ii]
+            ax.imshow(dat, origin='lower', cmap=cmaps[ii], vmin=vmin,
+                    vmax=vmax, interpolation='nearest')
+            ax.axvline(self.xx, color=IMAGE_CH_COLORS[ii], lw=0.5)
+            ax.axhline(self.yy, color=IMAGE_CH_COLORS[ii], lw=0.5)
+            ax.set_title(IMAGE_TITLES[ii], fontsize='small')
+
+        # Profile plots as in plotModel/plotObs/plotSynth
+        ax = fig.add_subplot(grid[0, 3])
+        ax.plot(self.ltaus, self.m.temp[self.tt,self.yy,self.xx,:], 'r')
+        ax.set_ylabel('T [kK]')
+        ax = [ax, fig.add_subplot(grid[0, 4])]
+        ax[1].plot(self.ltaus, self.m.vlos[self.tt,self.yy,self.xx,:], 'r')
+        ax[1].plot(self.ltaus, self.m.vturb[self.tt,self.yy,self.xx,:], 'b')
+        ax[1].set_ylabel('v [km/s]')
+        for axis in ax:
+            axis.axvline(self.ltaus[itau], color='b')
+            axis.set_xlabel(DEPTH_AXES[self.depthaxis][2])
+        obs = self.obsprof[self.tt,self.yy,self.xx,:,:]
+        syn = self.synprof[self.tt,self.yy,self.xx,:,:]
+        for ii in range(4):
+            ax = fig.add_subplot(grid[1+ii//2, 3+ii%2])
+            ax.plot(self.plot_wav, obs[:,ii], 'ko', ms=3)
+            ax.plot(self.plot_wav, syn[:,ii], 'r')
+            ax.axvline(self.plot_wav[self.ww], color='b')
+            ax.set_xlabel('wavelength [{0}]'.format(self.wunit))
+            ax.set_ylabel('Stokes '+'IQUV'[ii])
+        fig.suptitle('t={0}, {1}={2:.2f}, wavelength={3:.3f}{4}, Stokes '
+                '{5}'.format(self.tt, DEPTH_AXES[self.depthaxis][2],
+                    self.ltaus[itau], self.wav[self.ww], u'Å',
+                    'IQUV'[self.istokes]))
+        fig.tight_layout()
+        fig.savefig(fname)
+        return fname
+
+
+class SliceServer(CubeData):
+    def __init__(self, args):
+        # Loads the cubes once, completes chi2 and the image ranges, and serves
+        # slices and pixel profiles to viewer windows started with --server
+        self.dtype = 'float32' if args.compact else None
+        self.cache = None if args.no_cache else DerivedCache(self.dtype)
+        self.depthgrid = args.depth_grid
+        self.fname_obs = args.files[0]
+        self.fname_runs = list(zip(args.files[1::2], args.files[2::2]))
+        self.loadData()
+        if self.chi2engine is not None:
+            self.chi2engine.wait()
+            self.saveChi2()
+        self.cubes = {'obs': self.obsprof}
+        self.shm = []
+        runs = []
+        for irun, run in enumerate(self.runs):
+            self.cubes[('syn', irun)] = run.synprof
+            mshapes = {}
+            for key in MODEL_VARS:
+                if hasattr(run.m, key):
+                    self.cubes[('m', irun, key)] = getattr(run.m, key)
+                    mshapes[key] = getattr(run.m, key).shape
+            runstate = dict((name, getattr(run, name)) for name in
+                    ('fname_synth', 'fname_atmos', 'ltaus', 'dims',
+                        'minmax_vlos', 'minmax_vlos_all', 'absmax_vlos',
+                        'minmax_Bln', 'minmax_Bln_all', 'absmax_Bln'))
+            # Plain data only: the classes of this module cannot be unpickled
+            # by clients when the server runs as __main__
+            runstate.update({'mshapes': mshapes, 'synshape':
+                run.synprof.shape, 'luts': run.lutcache.toArrays(),
+                'stats_syn': run.stats_syn.toArray(),
+                'chi2': self.share(run.chi2), 'chi2_stokes':
+                self.share(run.chi2_stokes)})
+            runs.append(runstate)
+        self.state = {'fname_obs': self.fname_obs, 'depthaxis':
+                self.depthaxis, 'wsel': self.wsel,
+                'wav': self.wav, 'plot_iwav': self.plot_iwav, 'plot_wav':
+                self.plot_wav, 'obsshape': self.obsprof.shape, 'stats_obs':
+                self.stats_obs.toArray(), 'runs': runs}
+
+    def share(self, arr):
+        shm, spec = share_array(arr)
+        self.shm.append(shm)
+        return spec
+
+    def terminate(self, signum, frame):
+        # Leave serve() through its cleanup on SIGTERM as on Ctrl-C
+        raise KeyboardInterrupt
+
+    def serve(self, address):
+        remove_server_files(address)
+        key = os.urandom(32)
+        listener = Listener(address, family='AF_UNIX', authkey=key)
+        handler = signal.signal(signal.SIGTERM, self.terminate)
+        try:
+            fd = os.open(address+'.key', os.O_WRONLY | os.O_CREAT |
+                    os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(key)
+            print("SliceServer: serving {0} run(s) on {1}".format(
+                len(self.runs), address))
+            while True:
+                try:
+                    conn = listener.accept()
+                except (AuthenticationError, EOFError, OSError) as err:
+                    print("SliceServer: refused connection: {0}".format(err))
+                    continue
+                threading.Thread(target=self.handle, args=(conn,),
+                        daemon=True).start()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            # Not interrupted by a repeated SIGTERM
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            listener.close()
+            remove_server_files(address)
+            for shm in self.shm:
+                shm.close()
+                shm.unlink()
+            signal.signal(signal.SIGTERM, handler)
+
+    def handle(self, conn):
+        try:
+            while True:
+                request = conn.recv()
+                try:
+                    if request[0] == 'state':
+                        reply = self.state
+                    elif request[0] == 'get':
+                        reply = np.asarray(self.cubes[request[1]][request[2]])
+                    else:
+                        raise ValueError('unknown request {0}'.format(
+                            request[0]))
+                except Exception as err:
+                    reply = err
+                conn.send(reply)
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+
+# Renderer of the current batch worker process
+batch_renderer = None
+
+def init_batch_worker(renderer):
+    global batch_renderer
+    batch_renderer = renderer
+
+def render_batch_frame(task):
+    return batch_renderer.renderFrame(*task)
+
+
+def depth_grid(spec):
+    # AXIS[:MIN:MAX:N] of --depth-grid
+    parts = spec.split(':')
+    if parts[0] not in DEPTH_AXES or len(parts) not in (1, 4):
+        raise argparse.ArgumentTypeError('expected ltau or z, optionally '
+                'followed by :MIN:MAX:N')
+    if len(parts) == 1:
+        return (parts[0], None)
+    try:
+        vmin, vmax, n = float(parts[1]), float(parts[2]), int(parts[3])
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid grid {0}'.format(spec))
+    if n < 2:
+        raise argparse.ArgumentTypeError('the grid needs at least 2 points')
+    return (parts[0], np.linspace(vmin, vmax, n))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='STiC Viewer')
+    parser.add_argument('files', nargs='*', metavar='file',
+            help='observed, synthetic and atmosphere model files (in that '
+            'order), optionally followed by further synthetic and model '
+            'pairs of other runs to compare; a file dialog is shown when '
+            'omitted')
+    parser.add_argument('--no-cache', action='store_true',
+            help='do not read or write the cache of derived products '
+            '(kept in {0}/ next to the input files)'.format(CACHE_DIR))
+    parser.add_argument('--compact', action='store_true',
+            help='hold slices and derived maps as float32 instead of float64, '
+            'halving memory use')
+    parser.add_argument('--depth-grid', type=depth_grid,
+            metavar='AXIS[:MIN:MAX:N]', help='resample the model of every '
+            'pixel onto a common grid of log tau (AXIS ltau) or height in km '
+            '(AXIS z), of N points from MIN to MAX (default: the range of the '
+            'centre pixel); the result is cached per grid')
+    parser.add_argument('--pixel-cache', action='store_true',
+            help='build pixel-major copies of the cubes in the cache '
+            'directory in the background, for fast profile updates on hover '
+            'with chunked or compressed files')
+    parser.add_argument('--watch', nargs='?', type=float, metavar='SECONDS',
+            const=WATCH_INTERVAL, help='check the synthetic and model files '
+            'for pixels written by a running inversion every SECONDS '
+            '(default: {0:g}) and update the display'.format(WATCH_INTERVAL))
+    parser.add_argument('--profile', action='store_true',
+            help='time handlers and draw calls and show the latencies in a '
+            'dock (also available from the View menu)')
+    parser.add_argument('--profile-trace', metavar='FILE',
+            help='write a Chrome trace of the profiled calls to FILE on exit '
+            '(implies --profile)')
+    server = parser.add_argument_group('shared slice server')
+    server.add_argument('--serve', metavar='SOCKET',
+            help='load the files once and serve them to viewers started with '
+            '--server SOCKET (a local socket path)')
+    server.add_argument('--server', metavar='SOCKET',
+            help='show the files served on SOCKET instead of opening them')
+    batch = parser.add_argument_group('headless batch rendering')
+    batch.add_argument('--render', metavar='OUTDIR',
+            help='render PNG frames of all panels to OUTDIR without a display '
+            'and exit')
+    batch.add_argument('--axis', choices=('time', 'wave', 'depth'),
+            default='time', help='axis stepped through by the frames')
+    batch.add_argument('--frames', metavar='START:STOP',
+            help='range of frame indices along the axis (default: all)')
+    batch.add_argument('--time', type=int, default=0, help='time index')
+    batch.add_argument('--wave', type=int, default=0, help='wavelength index')
+    batch.add_argument('--depth', type=int, default=-1, help='depth index')
+    batch.add_argument('--stokes', choices=tuple('IQUV'), default='I')
+    batch.add_argument('--pixel', type=int, nargs=2, metavar=('X', 'Y'),
+            help='pixel of the profile plots (default: centre)')
+    batch.add_argument('--nproc', type=int, help='number of worker processes '
+            '(default: number of cores)')
+    batch.add_argument('--dpi', type=int, default=100)
+    batch.add_argument('--movie', metavar='FILE',
+            help='also assemble the frames into a movie (requires ffmpeg)')
+    batch.add_argument('--fps', type=int, default=10, help='movie frame rate')
+    # Leave options meant for Qt alone
+    args, _ = parser.parse_known_args(argv)
+    if args.profile_trace is not None:
+        args.profile = True
+    return args
 
 
 if __name__ == '__main__':
+    args = parse_args()
+    if args.serve is not None:
+        if len(args.files) < 3 or len(args.files) % 2 != 1:
+            raise SystemExit('Error: --serve requires the observed file and '
+                    'one or more synthetic and atmosphere model file pairs')
+        # Before loading the files, to fail early
+        remove_server_files(args.serve)
+        SliceServer(args).serve(args.serve)
+        sys.exit()
+    if args.render is not None:
+        if len(args.files) != 3:
+            raise SystemExit('Error: --render requires the observed, synthetic '
+                    'and atmosphere model files')
+        BatchRenderer(args).run(frames=args.frames, nproc=args.nproc,
+                movie=args.movie, fps=args.fps)
+        sys.exit()
+
     app = QApplication(sys.argv)
-    main = Window()
+    main = Window(args)
 
     sys.exit(app.exec_())
@@ -0,0 +1,58 @@
+# -*- coding: utf8 -*-
+
+import os
+import sys
+import shutil
+
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE = os.path.join(REPO, 'sample')
+SAMPLE_FILES = ('observed', 'synthetic', 'atmosout')
+sys.path.insert(0, REPO)
+
+# Qt without a display, for the tests that create widgets
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+
+@pytest.fixture
+def sample_files(tmp_path):
+    # Copies of the sample observed, synthetic and model files, which can be
+    # written to
+    fnames = []
+    for name in SAMPLE_FILES:
+        fnames.append(str(tmp_path / (name+'.nc')))
+        shutil.copy(os.path.join(SAMPLE, name+'.nc'), fnames[-1])
+    return fnames
+
+
+@pytest.fixture
+def load_sample(sample_files, tmp_path):
+    # CubeData of the sample files. With second set, a second run has the
+    # synthetic profiles halved
+    import sticviewer as sv
+    def load(second=False, cache=None, dtype=None):
+        data = sv.CubeData()
+        data.cache = cache
+        data.dtype = dtype
+        data.loadStage = lambda name: None
+        data.fname_obs, data.fname_synth, data.fname_atmos = sample_files
+        if second:
+            import h5py
+            fname = str(tmp_path / 'synthetic2.nc')
+            shutil.copy(sample_files[1], fname)
+            with h5py.File(fname, 'r+') as f:
+                f['profiles'][...] *= 0.5
+            data.fname_runs = [tuple(sample_files[1:]), (fname,
+                sample_files[2])]
+        data.loadData()
+        if data.chi2engine is not None:
+            data.chi2engine.wait()
+        return data
+    return load
+
+
+@pytest.fixture
+def qapp():
+    from sticviewer import QApplication
+    return QApplication.instance() or QApplication([sys.argv[0]])
@@ -0,0 +1,661 @@
+# -*- coding: utf8 -*-
+
+import os
+import sys
+import subprocess
+import time
+
+import numpy as np
+import pytest
+
+pytest.importorskip('PyQt5')
+pytest.importorskip('pyqtgraph')
+
+import sticviewer as sv
+from conftest import SAMPLE, SAMPLE_FILES
+
+# The sample files are netCDF4 (HDF5) files, read lazily
+lazy = pytest.mark.skipif(sv.h5py is None and sv.netCDF4 is None,
+        reason='h5py or netCDF4 is required to read the sample files')
+
+
+@lazy
+def test_read_model_sample():
+    # All model variables shown in the images are found in a STiC atmosphere
+    m = sv.read_model(os.path.join(SAMPLE, 'atmosout.nc'))
+    for key in ('ltau', 'temp', 'vlos', 'vturb', 'Bln', 'Bho', 'azi'):
+        cube = getattr(m, key)
+        assert cube.shape == m.temp.shape
+        assert np.all(np.isfinite(cube[0]))
+    assert np.any(m.Bln[0] != 0.)
+
+
+@lazy
+def test_read_model_sparsetools(monkeypatch):
+    # Without the lazy backends the files are read in full through
+    # sparsetools, to the same cubes
+    pytest.importorskip('sparsetools')
+    fname = os.path.join(SAMPLE, 'atmosout.nc')
+    lazym = sv.read_model(fname)
+    monkeypatch.setattr(sv, 'h5py', None)
+    monkeypatch.setattr(sv, 'netCDF4', None)
+    m = sv.read_model(fname)
+    assert not isinstance(m, sv.LazyModel)
+    for key in ('temp', 'vlos', 'Bln', 'Bho'):
+        assert np.allclose(getattr(m, key)[0], getattr(lazym, key)[0])
+
+
+WRITER = '''
+import sys
+import h5py
+with h5py.File(sys.argv[1], 'r+') as f:
+    f['profiles'][0,5:8] *= 0.5
+'''
+
+def test_reload_run_sees_other_process(monkeypatch, load_sample):
+    # Rows written by another process (as by a running STiC) are picked up
+    # although the files are still open for reading
+    pytest.importorskip('h5py')
+    monkeypatch.setattr(sv.CubeFile, 'locking', False)
+    data = load_sample()
+    data.probeRun(data.runs[0])
+    before = np.array(data.runs[0].synprof[0,6])
+    subprocess.check_call([sys.executable, '-c', WRITER, data.fname_synth])
+    keys = data.reloadRun(0)
+    assert sorted(set(row for tt, rows in keys for row in range(rows.start,
+        rows.stop))) == [5, 6, 7]
+    assert np.allclose(data.runs[0].synprof[0,6], 0.5*before)
+
+
+class FailingCube(sv.LazyCube):
+    def __getitem__(self, key):
+        key = self.normKey(key)
+        if key[0] == 1:
+            raise IOError('truncated')
+        return super(FailingCube, self).__getitem__(key)
+
+def test_chi2_engine_reports_failed_chunks():
+    # A chunk that cannot be read fails its time step instead of leaving it
+    # pending for ever
+    rng = np.random.default_rng(0)
+    obs = sv.LazyCube(rng.normal(size=(3, 4, 5, 6, 4)))
+    syn = FailingCube(rng.normal(size=(3, 4, 5, 6, 4)))
+    engine = sv.Chi2Engine(obs, [syn], np.ones((6, 4)), nthreads=2)
+    called = []
+    engine.start(callback=called.append)
+    with pytest.raises(RuntimeError, match='truncated'):
+        engine.wait()
+    assert sorted(called) == [0, 1, 2]
+    assert list(engine.done) == [True, False, True]
+    assert list(engine.failed) == [False, True, False]
+    assert engine.finished()
+
+
+def test_summed_area_memory_mapped(tmp_path):
+    # Tables memory-mapped from temporary files give the same statistics
+    rng = np.random.default_rng(1)
+    dat = rng.normal(size=(2, 9, 7, 3))
+    dat[1,4,2,1] = np.nan
+    cube = sv.LazyCube(dat)
+    boxes = sv.region_boxes(('rect', 1., 2., 4., 5.), 9, 7)
+    for tt in range(2):
+        area = sv.SummedArea(cube, tt, tmpdir=str(tmp_path))
+        assert isinstance(area.sum, np.memmap)
+        for ref, val in zip(sv.region_stats(cube, tt, boxes),
+                area.stats(boxes)):
+            assert np.allclose(ref, val)
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_map_slice_of_run_at_request(load_sample):
+    # A slice requested before a switch of run is that of the run then active
+    pytest.importorskip('h5py')
+    data = load_sample(second=True)
+    key, load = data.mapSlice('syn', 0)
+    data.selectRun(1)
+    core = load().pyramids['core'].levels[0]
+    data.selectRun(0)
+    assert np.allclose(core, data.derivedMaps(data.synprof, (data.fname_obs,
+        data.fname_synth), 0)[0], equal_nan=True)
+
+
+def test_chi2_slice_of_run_at_request(load_sample):
+    pytest.importorskip('h5py')
+    data = load_sample(second=True)
+    key, load = data.chi2Slice(0)
+    chi2 = np.array(data.chi2[0])
+    data.selectRun(1)
+    assert not np.allclose(data.chi2[0], chi2)
+    assert np.allclose(load().levels[0], chi2)
+
+
+def test_pixel_cache_keeps_precision(tmp_path):
+    # Without --compact the cached pixels are those of the cube itself
+    rng = np.random.default_rng(2)
+    dat = rng.normal(size=(2, 5, 4, 3, 4))
+    fname = str(tmp_path / 'input.nc')
+    with open(fname, 'wb') as f:
+        f.write(dat.tobytes())
+    for dtype in ('float64', 'float32'):
+        cache = sv.DerivedCache(None if dtype == 'float64' else dtype)
+        pixels = sv.PixelCache(cache, 'pixels', (fname,), [('obs',
+            sv.LazyCube(dat))], dtype=dtype)
+        pixels.thread.join()
+        rec = pixels.pixel(1, 3, 2)['obs']
+        assert rec.dtype == np.dtype(dtype)
+        assert np.array_equal(rec, dat[1,3,2].astype(dtype))
+
+
+@lazy
+def test_cancel_load_returns_to_event_loop(monkeypatch, qapp):
+    # Cancelling stops the loader at the end of a stage and quits through Qt
+    # instead of ending the process
+    exits = []
+    monkeypatch.setattr(sv.qApp, 'exit', exits.append)
+    win = sv.Window(sv.parse_args([os.path.join(SAMPLE, name+'.nc') for name
+        in SAMPLE_FILES] + ['--no-cache']))
+    win.cancelLoad()
+    t0 = time.time()
+    while win.loaderror is None and not win.ready and time.time()-t0 < 60:
+        qapp.processEvents()
+        time.sleep(1.e-3)
+    assert win.loaderror == 'Window: loading cancelled'
+    assert exits == [1]
+    win.close()
+
+
+@pytest.fixture
+def slice_server(sample_files, tmp_path):
+    # SliceServer of the sample files run as a script, as with --serve
+    address = str(tmp_path / 'server')
+    proc = subprocess.Popen([sys.executable, sv.__file__, '--no-cache',
+        '--serve', address] + sample_files)
+    t0 = time.time()
+    while not os.path.exists(address+'.key') and proc.poll() is None and \
+            time.time()-t0 < 60:
+        time.sleep(0.05)
+    assert os.path.exists(address+'.key')
+    time.sleep(0.1)
+    yield address, proc
+    if proc.poll() is None:
+        proc.kill()
+        proc.wait()
+
+
+@lazy
+def test_slice_server(slice_server, load_sample):
+    # The state and slices of a server started as __main__ are unpickled by
+    # clients as plain data, and equal those loaded locally
+    address, proc = slice_server
+    data = load_sample()
+    remote = sv.CubeData()
+    remote.loadStage = lambda name: None
+    remote.loadRemote(address)
+    run, local = remote.runs[0], data.runs[0]
+    assert isinstance(run.lutcache, sv.LUTCache)
+    assert np.array_equal(run.lutcache.get('bwr', 3),
+            local.lutcache.get('bwr', 3))
+    assert np.array_equal(remote.wsel, data.wsel)
+    assert np.array_equal(remote.obsprof[0,:,4], data.obsprof[0,:,4])
+    assert np.array_equal(run.synprof[0,2:5,...,1], local.synprof[0,2:5,...,1])
+    assert np.array_equal(run.m.vlos[0,:,3], local.m.vlos[0,:,3])
+    assert np.allclose(run.chi2, local.chi2, equal_nan=True)
+    assert np.allclose(run.chi2_stokes, local.chi2_stokes, equal_nan=True)
+    assert np.array_equal(remote.stats_obs.toArray(),
+            data.stats_obs.toArray())
+    with pytest.raises(IndexError):
+        remote.client.request('get', 'obs', (data.nt,))
+    # Clients without the key are refused
+    with pytest.raises(sv.AuthenticationError):
+        sv.Client(address, family='AF_UNIX', authkey=os.urandom(32))
+    assert proc.poll() is None
+    # SIGTERM removes the socket, the key file and the shared memory
+    names = [spec[0] for spec in (remote.client.request('state')['runs'][0][
+        name] for name in ('chi2', 'chi2_stokes'))]
+    proc.terminate()
+    assert proc.wait(timeout=30) == 0
+    assert not os.path.exists(address)
+    assert not os.path.exists(address+'.key')
+    for name in names:
+        with pytest.raises(FileNotFoundError):
+            sv.attach_array((name, (1,), 'f8'))
+
+
+def test_chi2_engine_matches_full_cube():
+    # chi2 streamed in row blocks by several threads equals the formula on
+    # the full cubes, also for a wavelength selection that is no range
+    rng = np.random.default_rng(3)
+    shape = (3, 7, 5, 11, 4)
+    obs, syn1, syn2 = (rng.normal(size=shape) for ii in range(3))
+    weights = rng.uniform(0.5, 2., size=shape[3:])
+    for wsel in (np.array([0, 2, 3, 7, 10]), np.arange(1, 9, 2)):
+        cubes = [sv.LazyCube(dat).take(wsel) for dat in (obs, syn1, syn2)]
+        # Blocks of two rows
+        cubes[0].chunks = lambda: sv.cube_chunks(cubes[0].shape,
+                2*int(np.prod(cubes[0].shape[2:])))
+        engine = sv.Chi2Engine(cubes[0], cubes[1:], weights[wsel],
+                nthreads=3)
+        engine.start()
+        engine.wait()
+        assert engine.done.all()
+        for ii, syn in enumerate((syn1, syn2)):
+            wts = np.zeros(obs[...,wsel,:].shape)
+            wts[:,:,:] = weights[wsel,:]
+            chi2_stokes = np.sum(((obs[...,wsel,:] - syn[...,wsel,:])/wts)**2,
+                    axis=3) / wsel.size
+            chi2 = np.sum(chi2_stokes, axis=3) / shape[4]
+            assert np.allclose(engine.chi2_stokes[ii], chi2_stokes)
+            assert np.allclose(engine.chi2[ii], chi2)
+
+
+def test_derived_cache_invalidated(tmp_path):
+    # An entry is dropped when the size, modification time or sampled
+    # content of an input changes (each program run has a new DerivedCache)
+    fname = str(tmp_path / 'input.nc')
+    with open(fname, 'wb') as f:
+        f.write(bytes(range(256)) * 64)
+    arr = np.arange(12.).reshape(3, 4)
+    sv.DerivedCache().save('entry', (fname,), arr)
+    assert np.array_equal(sv.DerivedCache().load('entry', (fname,)), arr)
+    st = os.stat(fname)
+
+    def content(f):
+        # Same size and modification time
+        f.seek(100)
+        f.write(b'\0')
+    for change in (lambda f: f.write(b'\0'), content):
+        sv.DerivedCache().save('entry', (fname,), arr)
+        with open(fname, 'r+b') as f:
+            f.seek(0, 2)
+            change(f)
+        os.utime(fname, ns=(st.st_atime_ns, st.st_mtime_ns))
+        assert sv.DerivedCache().load('entry', (fname,)) is None
+    sv.DerivedCache().save('entry', (fname,), arr)
+    os.utime(fname, ns=(st.st_atime_ns, st.st_mtime_ns+10**9))
+    assert sv.DerivedCache().load('entry', (fname,)) is None
+
+
+@lazy
+def test_no_cache_bypasses_cache(sample_files, tmp_path):
+    def render(*options):
+        return sv.BatchRenderer(sv.parse_args(sample_files + ['--render',
+            str(tmp_path / 'frames')] + list(options)))
+    cachedir = os.path.join(os.path.dirname(sample_files[0]), sv.CACHE_DIR)
+    assert render('--no-cache').chi2engine is not None
+    assert not os.path.exists(cachedir)
+    # chi2 is cached by the first run and read by the next
+    assert render().chi2engine is not None
+    assert os.listdir(cachedir)
+    assert render().chi2engine is None
+    assert render('--no-cache').chi2engine is not None
+
+
+def test_compute_maps_dtype():
+    # Maps are held in the precision of the slices (float32 with --compact)
+    rng = np.random.default_rng(4)
+    dat = rng.uniform(1., 2., size=(2, 6, 5, 7, 4))
+    wav = np.linspace(6300., 6303., 7)
+    ref = sv.derived_maps(dat[1], wav)
+    for dtype in ('float64', 'float32'):
+        maps = sv.compute_maps(sv.LazyCube(dat, dtype=dtype), wav, 1,
+                nthreads=2, dtype=dtype)
+        assert maps.dtype == np.dtype(dtype)
+        assert np.allclose(maps, ref, rtol=1.e-5)
+
+
+@lazy
+def test_batch_renderer_frame(sample_files, tmp_path):
+    # One frame of the image grid and profile plots, drawn with Agg by a
+    # spawned worker process that reopens the input files
+    pytest.importorskip('matplotlib')
+    from matplotlib.image import imread
+    outdir = str(tmp_path / 'frames')
+    renderer = sv.BatchRenderer(sv.parse_args(sample_files + ['--render',
+        outdir, '--axis', 'wave', '--dpi', '20', '--no-cache']))
+    renderer.run(frames='2:3', nproc=1)
+    assert os.listdir(outdir) == ['wave_0000.png']
+    img = imread(os.path.join(outdir, 'wave_0000.png'))
+    assert img.shape[:2] == (9*20, 16*20)
+    assert img[...,:3].std() > 0.
+
+
+class FakeLoader(object):
+    # Loader of slices of 100 float64 (800 bytes), recording its calls
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, key, size=100, event=None):
+        def load():
+            if event is not None:
+                event.wait(10)
+            self.calls.append(key)
+            return np.full(size, float(len(self.calls)))
+        return load
+
+def test_slice_cache_lru():
+    # Byte-bounded, least recently used slices are evicted first
+    loader = FakeLoader()
+    cache = sv.SliceCache(maxbytes=3*800)
+    for key in 'abc':
+        cache.get(key, loader(key))
+    cache.get('a', loader('a'))
+    cache.get('d', loader('d'))
+    assert list(cache.items) == ['c', 'a', 'd']
+    assert cache.nbytes == 3*800
+    assert loader.calls == ['a', 'b', 'c', 'd']
+    assert (cache.hits, cache.misses) == (1, 4)
+    # A slice larger than the cache is returned but not kept, and does not
+    # evict the others
+    dat = cache.get('big', loader('big', size=400))
+    assert dat.size == 400
+    assert list(cache.items) == ['c', 'a', 'd']
+    assert cache.nbytes == 3*800
+    cache.put('big', dat)
+    assert cache.peek('big') is None
+    cache.shutdown()
+
+def test_slice_cache_prefetch():
+    # Predictions not yet started are dropped by the next prefetch, and a
+    # slice being prefetched is waited for instead of loaded again
+    loader = FakeLoader()
+    cache = sv.SliceCache(maxbytes=10*800)
+    event = sv.threading.Event()
+    running = loader('x', event=event)
+    cache.prefetch([('x', running), ('p1', loader('p1')), ('p2',
+        loader('p2'))])
+    cache.prefetch([('x', running), ('p3', loader('p3'))])
+    assert sorted(cache.pending) == ['p3', 'x']
+    event.set()
+    assert cache.get('x', loader('again')) is not None
+    cache.pool.shutdown(wait=True)
+    assert loader.calls == ['x', 'p3']
+    assert cache.ready(['x', 'p3'])
+    assert cache.pending == {}
+    assert (cache.hits, cache.misses) == (1, 0)
+
+
+def test_resample_depth():
+    # Per-pixel linear interpolation as np.interp, NaN outside the range of
+    # each pixel, for increasing and decreasing depth axes
+    rng = np.random.default_rng(5)
+    coord = np.cumsum(rng.uniform(0.1, 1., size=(2, 3, 4, 9)), axis=-1)
+    coord += rng.uniform(-2., 0., size=(2, 3, 4, 1))
+    cubes = [rng.normal(size=coord.shape) for ii in range(2)]
+    grid = np.linspace(-2., 9., 23)
+    for flip in (False, True):
+        c = coord[...,::-1] if flip else coord
+        out = sv.resample_depth(c, grid, [cube[...,::-1] if flip else cube
+            for cube in cubes])
+        for cube, res in zip(cubes, out):
+            assert res.shape == coord.shape[:-1] + grid.shape
+            for pix in np.ndindex(coord.shape[:-1]):
+                ref = np.interp(grid, coord[pix], cube[pix], left=np.nan,
+                        right=np.nan)
+                assert np.allclose(res[pix], ref, equal_nan=True)
+            assert np.isnan(res[...,0]).all()
+            assert np.isfinite(res).any()
+
+
+def test_binned_cube_density():
+    # Counts over a region equal np.histogram of its samples on the same
+    # levels (values outside in the outer bins, NaN left out), with the whole
+    # time step binned and with a window only
+    rng = np.random.default_rng(6)
+    dats = [rng.normal(size=(2, 10, 8, 3)) for ii in range(2)]
+    dats[1][1,4,5,2] = np.nan
+    cubes = [sv.LazyCube(dat) for dat in dats]
+    vmin = np.array([[-1., -2.], [-1.5, -1.], [-2., -0.5]])
+    vmax = vmin + 3.
+    mask = rng.uniform(size=(5, 4)) > 0.3
+    mask[2,2] = True
+    for rows, cols in ((None, None), (slice(1, 8), slice(2, 8))):
+        binned = sv.BinnedCube(cubes, 1, vmin, vmax, rows=rows, cols=cols,
+                nbins=16)
+        counts = binned.density(mask, 2, 3)
+        assert counts.shape == (3, 2, 16)
+        for ii, dat in enumerate(dats):
+            region = dat[1,2:7,3:7][mask]
+            for k in range(3):
+                sel = region[:,k]
+                sel = np.clip(sel[np.isfinite(sel)], vmin[k,ii], vmax[k,ii])
+                ref, _ = np.histogram(sel, bins=np.linspace(vmin[k,ii],
+                    vmax[k,ii], 17))
+                assert np.array_equal(counts[k,ii], ref)
+
+
+def test_fit_ranking():
+    # The partial sort gives the k largest chi2 as a full argsort does,
+    # leaving out NaN and pixels outside the mask
+    rng = np.random.default_rng(7)
+    chi2 = rng.exponential(size=(12, 9))
+    chi2[3,4] = chi2[0,0] = np.nan
+    order = np.argsort(np.where(np.isfinite(chi2), chi2, -np.inf).ravel())[
+            ::-1][:chi2.size-2]
+    ranking = sv.FitRanking(chi2, 10)
+    assert np.array_equal(ranking.yy*9+ranking.xx, order[:10])
+    assert np.array_equal(ranking.values, chi2.ravel()[order[:10]])
+    assert ranking.total == chi2.size-2 and not ranking.complete()
+    threshold = chi2.ravel()[order[6]]
+    assert ranking.count(threshold) == 7
+    assert ranking.count(threshold+1.e-9) == 6
+    assert ranking.count() == 10
+    ranking = sv.FitRanking(chi2, 1000)
+    assert ranking.complete()
+    assert np.array_equal(ranking.yy*9+ranking.xx, order)
+    mask = rng.uniform(size=(5, 4)) > 0.5
+    ranking = sv.FitRanking(chi2, 1000, mask=mask, y0=2, x0=3)
+    region = np.full(chi2.shape, np.nan)
+    region[2:7,3:7][mask] = chi2[2:7,3:7][mask]
+    assert np.array_equal(ranking.values, np.sort(region[np.isfinite(
+        region)])[::-1])
+    assert np.allclose(chi2[ranking.yy,ranking.xx], ranking.values)
+
+
+@lazy
+def test_worst_fits_grow_ranking(monkeypatch, qapp):
+    # Stepping past the end of the ranking extends it fourfold, in the order
+    # of a full sort
+    monkeypatch.setattr(sv, 'WORST_FITS', 4)
+    win = sv.Window(sv.parse_args([os.path.join(SAMPLE, name+'.nc') for name
+        in SAMPLE_FILES] + ['--no-cache']))
+    t0 = time.time()
+    while win.loaderror is None and not win.ready and time.time()-t0 < 60:
+        qapp.processEvents()
+        time.sleep(1.e-3)
+    assert win.ready
+    chi2 = np.array(win.chi2[win.tt])
+    order = np.argsort(chi2.ravel())[::-1]
+    for ii in range(6):
+        win.nextWorst()
+    assert win.worstk == 16
+    assert win.worstpos == 5
+    assert win.yy*chi2.shape[1]+win.xx == order[5]
+    win.close()
+
+
+def test_cube_stats(monkeypatch):
+    # Ranges found over row blocks equal nanmin/nanmax of the full cubes, also
+    # when the time steps are traversed in several calls
+    monkeypatch.setattr(sv, 'CHUNK_ELEMENTS', 2*7*5*2)
+    rng = np.random.default_rng(8)
+    dats = {'temp': rng.normal(size=(3, 8, 7, 5)), 'vlos': rng.normal(
+        size=(3, 8, 7, 5))}
+    dats['vlos'][1,2:5,3] = np.nan
+    dats['vlos'][2,...,4] = np.nan
+    cubes = dict((name, sv.LazyCube(dat)) for name, dat in dats.items())
+    stats = sv.cube_stats(cubes, times=(1,))
+    for name, dat in dats.items():
+        assert np.array_equal(stats[name].tmin[1], np.nanmin(dat[1], axis=(0,
+            1)))
+        assert np.isinf(stats[name].tmin[[0,2]]).all()
+    sv.cube_stats(cubes, stats=stats, times={0, 2})
+    full = sv.cube_stats(cubes)
+    for name, dat in dats.items():
+        for st in (stats[name], full[name]):
+            assert np.array_equal(st.minmax(), [np.nanmin(dat, axis=(0, 1,
+                2)), np.nanmax(dat, axis=(0, 1, 2))])
+            assert st.minmaxAll() == (np.nanmin(dat), np.nanmax(dat))
+            assert st.absmax() == np.nanmax(np.abs(dat))
+            restored = sv.CubeStats.fromArray(st.toArray())
+            assert np.array_equal(restored.tmax, st.tmax)
+
+
+def test_table_colormap_matches_matplotlib():
+    # The bundled colour tables are those of matplotlib
+    matplotlib = pytest.importorskip('matplotlib')
+    x = np.linspace(0., 1., 1001)
+    for base in list(sv.CMAP_COLORS) + list(sv.CMAP_SEGMENTS):
+        for name in (base, base+'_r'):
+            cmap = matplotlib.colormaps[name] if hasattr(matplotlib,
+                    'colormaps') else matplotlib.cm.get_cmap(name)
+            assert np.allclose(sv.TableColormap(name)(x), cmap(x))
+
+
+def test_truncated_luts_match_matplotlib():
+    # The LUTs of all depths built in one pass equal those of the colormap
+    # truncated to the range of each depth through matplotlib
+    matplotlib = pytest.importorskip('matplotlib')
+    from matplotlib.colors import LinearSegmentedColormap
+    absmax = 3.
+    minmax = np.array([[-3., -1., 0.5], [2., 1., 3.]])
+    for name in ('bwr', 'RdGy_r'):
+        luts = sv.cmap_truncate_luts(sv.get_cmap(name), absmax=absmax,
+                minmax=minmax)
+        cmap = matplotlib.colormaps[name] if hasattr(matplotlib,
+                'colormaps') else matplotlib.cm.get_cmap(name)
+        for ii in range(minmax.shape[1]):
+            minval = (minmax[0,ii]+absmax)/(2.*absmax)
+            maxval = 1.-(absmax-minmax[1,ii])/(2.*absmax)
+            ref = LinearSegmentedColormap.from_list('trunc', cmap(np.linspace(
+                minval, maxval, 256)))
+            assert np.allclose(luts[ii], sv.mplcm_to_pglut(ref))
+
+
+def test_render_scheduler_coalesces(qapp):
+    # Dirty flags marked by several handlers in one tick give one repaint
+    renders = []
+    scheduler = sv.RenderScheduler(renders.append)
+    for flags in (sv.DIRTY_MODEL, sv.DIRTY_MARKERS, sv.DIRTY_MODEL):
+        scheduler.mark(flags)
+    assert renders == []
+    t0 = time.time()
+    while not renders and time.time()-t0 < 5:
+        qapp.processEvents()
+    for ii in range(10):
+        qapp.processEvents()
+    assert renders == [sv.DIRTY_MODEL | sv.DIRTY_MARKERS]
+    scheduler.mark(sv.DIRTY_STATUS)
+    t0 = time.time()
+    while len(renders) < 2 and time.time()-t0 < 5:
+        qapp.processEvents()
+    assert renders[1:] == [sv.DIRTY_STATUS]
+
+
+def test_image_pyramid_levels():
+    # 2x2 block means down to the minimum size, and the coarsest level with
+    # at least one image pixel per screen pixel for a zoom
+    rng = np.random.default_rng(9)
+    dat = rng.normal(size=(1030, 601))
+    pyr = sv.ImagePyramid(dat)
+    assert [level.shape for level in pyr.levels] == [(1030, 601),
+            (515, 300), (257, 150), (128, 75)]
+    assert np.allclose(pyr.levels[1], dat[:,:600].reshape(515, 2, 300,
+        2).mean(axis=(1,3)))
+    assert np.allclose(pyr.levels[2], pyr.levels[1][:514].reshape(257, 2,
+        150, 2).mean(axis=(1,3)))
+    for ratio, level in ((0.3, 0), (1., 0), (1.9, 0), (2., 1), (3.9, 1),
+            (4., 2), (8., 3), (100., 3)):
+        assert pyr.level(ratio) == level
+    assert len(sv.ImagePyramid(dat[:200,:100]).levels) == 1
+
+
+def test_sample_levels():
+    # Images smaller than the sample give the percentiles of all finite
+    # pixels; larger ones those of the sample, close to them
+    rng = np.random.default_rng(10)
+    dat = rng.normal(size=(100, 80))
+    dat[3,4] = np.nan
+    dat[5,6] = 1.e6
+    assert np.allclose(sv.sample_levels(dat), np.nanpercentile(dat,
+        sv.AUTOLEVEL_PERCENTILES))
+    dat = rng.uniform(size=(1000, 700))
+    dat[::7] = np.nan
+    assert np.allclose(sv.sample_levels(dat), np.nanpercentile(dat,
+        sv.AUTOLEVEL_PERCENTILES), atol=2.e-3)
+    assert sv.sample_levels(np.full((5, 5), 2.)) == (1.5, 2.5)
+    assert sv.sample_levels(np.full((5, 5), np.nan)) == (0., 1.)
+
+
+class Profiled(object):
+    @sv.profiled
+    def handler(self, *args, **kwargs):
+        return self, args, kwargs
+
+def test_profiled_passes_arguments(monkeypatch):
+    # Arguments and results pass through unchanged with profiling on or off,
+    # and calls are timed only when it is on
+    profiler = sv.Profiler()
+    monkeypatch.setattr(sv, 'PROFILER', profiler)
+    obj = Profiled()
+    for enabled in (False, True):
+        profiler.enabled = enabled
+        assert obj.handler(1, None, key='value') == (obj, (1, None),
+                {'key': 'value'})
+        assert obj.handler() == (obj, (), {})
+    assert Profiled.handler.__name__ == 'handler'
+    assert [row[:2] for row in profiler.summary()] == [('Profiled.handler',
+        2)]
+
+
+class FakePlayerWindow(object):
+    # Axis of 20 frames of which those in ready are in the slice cache
+    def __init__(self):
+        self.slices = sv.SliceCache(maxbytes=8*800)
+        self.ready = set(range(20))
+        self.frames = []
+        self.prefetched = []
+
+    def axisIndex(self, axis):
+        return 0
+
+    def axisLength(self, axis):
+        return 20
+
+    def frameBytes(self, axis):
+        return 800
+
+    def prefetch(self, axis, steps):
+        self.prefetched.append(steps)
+
+    def frameReady(self, axis, frame):
+        return frame in self.ready
+
+    def showFrame(self, axis, frame):
+        self.frames.append(frame)
+
+def test_player_drops_frames(monkeypatch, qapp):
+    # Each tick shows the newest due frame that is ready, counting the frames
+    # skipped, and prefetches at most half of the slice cache ahead
+    clock = [100.]
+    monkeypatch.setattr(sv, 'time', type('Clock', (), {'perf_counter':
+        staticmethod(lambda: clock[0])}))
+    window = FakePlayerWindow()
+    player = sv.Player(window)
+    player.setFps(10)
+    player.start()
+    player.stop()
+    assert window.prefetched == [range(1, 5)]
+    clock[0] += 0.05
+    player.tick()
+    assert window.frames == []
+    window.ready.discard(3)
+    clock[0] += 0.3
+    player.tick()
+    assert window.frames == [2]
+    assert player.dropped == 1
+    clock[0] += 0.2
+    player.tick()
+    assert window.frames == [2, 5]
+    assert player.dropped == 3
+    assert len(window.prefetched) == 3
+    assert player.achievedFps() == pytest.approx(1./0.2)